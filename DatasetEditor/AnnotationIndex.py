@@ -0,0 +1,92 @@
+# Author:      Adam Robinson
+# Description: This class maintains an in memory inverted index over the
+#              entries of a dataset, so that questions like "which images
+#              contain class X" can be answered without scanning every entry.
+
+import numpy as np
+
+# The index is built once when a dataset is loaded and is then updated one
+# entry at a time (see updateEntry) whenever an entry's contours change.
+#
+#   class_entries  - class index -> set of keys of entries containing it
+#   entry_classes  - key -> set of class indices in that entry
+#   contour_counts - key -> number of contours in that entry
+#   count_buckets  - number of contours -> set of keys with that many
+#
+# The count buckets allow filtering and sorting by the number of contours
+# by looking at each distinct count, rather than at every entry.
+class AnnotationIndex:
+	def __init__(self, entries=None):
+		self.class_entries  = {}
+		self.entry_classes  = {}
+		self.contour_counts = {}
+		self.count_buckets  = {}
+
+		if entries is not None:
+			for key, contours in entries.items():
+				self.updateEntry(key, contours)
+
+	# Brings the index up to date with the current contours of an entry.
+	def updateEntry(self, key, contours):
+		self.removeEntry(key)
+
+		classes = set(np.unique(contours.class_idx).tolist())
+		count   = len(contours)
+
+		self.entry_classes[key]  = classes
+		self.contour_counts[key] = count
+
+		for class_idx in classes:
+			self.class_entries.setdefault(class_idx, set()).add(key)
+
+		self.count_buckets.setdefault(count, set()).add(key)
+
+	def removeEntry(self, key):
+		if key not in self.contour_counts:
+			return
+
+		for class_idx in self.entry_classes.pop(key):
+			self.class_entries[class_idx].discard(key)
+
+		count = self.contour_counts.pop(key)
+		self.count_buckets[count].discard(key)
+		if len(self.count_buckets[count]) == 0:
+			del self.count_buckets[count]
+
+	def entriesWithClass(self, class_idx):
+		return set(self.class_entries.get(class_idx, ()))
+
+	def labeledEntries(self):
+		return set(self.contour_counts.keys()) - self.count_buckets.get(0, set())
+
+	def unlabeledEntries(self):
+		return set(self.count_buckets.get(0, ()))
+
+	# Returns the keys of entries with at least minimum and at most maximum
+	# contours.
+	def entriesWithCount(self, minimum=0, maximum=None):
+		keys = set()
+		for count, bucket in self.count_buckets.items():
+			if count >= minimum and (maximum is None or count <= maximum):
+				keys.update(bucket)
+
+		return keys
+
+	def contourCount(self, key):
+		return self.contour_counts.get(key, 0)
+
+	def allEntries(self):
+		return set(self.contour_counts.keys())
+
+	# Orders the given keys by their number of contours.
+	def sortByCount(self, keys, descending=False):
+		keys = set(keys)
+		ordered = []
+		for count in sorted(self.count_buckets.keys(), reverse=descending):
+			bucket = self.count_buckets[count]
+			if len(bucket) < len(keys):
+				ordered.extend(sorted(k for k in bucket if k in keys))
+			else:
+				ordered.extend(sorted(k for k in keys if k in bucket))
+
+		return ordered
@@ -0,0 +1,228 @@
+# Author:      Adam Robinson
+# Description: This file contains the augmentation applied to batches of
+#              images and their class masks (see MaskRasterizer.classMask)
+#              during training. It doesn't depend on kivy.
+#
+#              The geometric augmentations (flips, rotations, scaling and
+#              cropping) of each sample are composed into a single affine
+#              matrix, so every image and mask is warped exactly once. Masks
+#              are warped with nearest neighbour interpolation, so they
+#              never contain class indices that weren't in the original.
+#              The random parameters of a whole batch are drawn at once, and
+#              the intensity augmentations (brightness, contrast, gamma and
+#              noise) are applied to the whole batch with numpy.
+#
+#              Every batch gets its own random generator, derived from the
+#              seed and the position of the batch in the stream (see
+#              augmentBatches), so the results are the same no matter how
+#              many worker processes are used.
+
+import cv2
+import numpy as np
+
+from collections import deque
+
+class Augmenter:
+	# output_size is the (width, height) of the augmented samples.
+	#
+	#     flip         - Randomly mirror samples horizontally and vertically.
+	#     rotation     - Rotate by up to this many degrees either way.
+	#     right_angles - Also rotate by a random multiple of 90 degrees.
+	#     scale        - The (min, max) zoom factor. Values above one zoom in.
+	#     brightness   - The most the brightness changes, as a fraction of
+	#                    the range of the dtype.
+	#     contrast     - The most the contrast changes, as a fraction.
+	#     gamma        - The most the gamma changes, as a fraction.
+	#     noise        - The standard deviation of added gaussian noise, as
+	#                    a fraction of the range of the dtype.
+	def __init__(self, output_size, flip=True, rotation=15.0, right_angles=True,
+		         scale=(0.8, 1.25), brightness=0.1, contrast=0.2, gamma=0.2,
+		         noise=0.0):
+		self.output_size  = tuple(output_size)
+		self.flip         = flip
+		self.rotation     = rotation
+		self.right_angles = right_angles
+		self.scale        = scale
+		self.brightness   = brightness
+		self.contrast     = contrast
+		self.gamma        = gamma
+		self.noise        = noise
+
+	# Returns a (N, 2, 3) array with the affine matrix that maps each of the
+	# source images (with the given (height, width) shapes) to its output
+	# sample. All of the parameters are drawn at once.
+	def sampleTransforms(self, shapes, rng):
+		shapes = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+		n      = shapes.shape[0]
+
+		angle = rng.uniform(-self.rotation, self.rotation, n)
+		if self.right_angles:
+			angle += rng.integers(0, 4, n) * 90.0
+		angle = np.radians(angle)
+
+		scale = np.exp(rng.uniform(np.log(self.scale[0]), np.log(self.scale[1]), n))
+
+		flip_x = np.ones(n)
+		flip_y = np.ones(n)
+		if self.flip:
+			flip_x[rng.random(n) < 0.5] = -1
+			flip_y[rng.random(n) < 0.5] = -1
+
+		# The part of the source image covered by the output. The center of
+		# the crop is chosen so that it stays inside the image when it fits.
+		out_w, out_h  = self.output_size
+		half_w        = out_w / (2 * scale)
+		half_h        = out_h / (2 * scale)
+		height, width = shapes[:, 0], shapes[:, 1]
+
+		cx = np.where(
+			width > 2 * half_w,
+			half_w + rng.random(n) * np.maximum(width - 2 * half_w, 0),
+			width / 2
+		)
+		cy = np.where(
+			height > 2 * half_h,
+			half_h + rng.random(n) * np.maximum(height - 2 * half_h, 0),
+			height / 2
+		)
+
+		# A = scale * rotation * flip. The translation moves the center of
+		# the crop to the center of the output.
+		cos, sin = np.cos(angle) * scale, np.sin(angle) * scale
+
+		matrices = np.empty((n, 2, 3), dtype=np.float64)
+		matrices[:, 0, 0] = cos * flip_x
+		matrices[:, 0, 1] = -sin * flip_y
+		matrices[:, 1, 0] = sin * flip_x
+		matrices[:, 1, 1] = cos * flip_y
+		matrices[:, 0, 2] = out_w / 2 - (matrices[:, 0, 0] * cx + matrices[:, 0, 1] * cy)
+		matrices[:, 1, 2] = out_h / 2 - (matrices[:, 1, 0] * cx + matrices[:, 1, 1] * cy)
+
+		return matrices
+
+	# Warps every image and mask with its matrix. images is a (N, H, W, C)
+	# array or a list of images, and masks is the matching (N, H, W) array or
+	# list, or None. Returns arrays of the output size.
+	def transformBatch(self, images, masks, matrices):
+		out_w, out_h = self.output_size
+		n            = len(images)
+
+		out_images = np.empty((n, out_h, out_w) + images[0].shape[2:], dtype=images[0].dtype)
+		out_masks  = None
+		if masks is not None:
+			out_masks = np.empty((n, out_h, out_w), dtype=masks[0].dtype)
+
+		for i in range(n):
+			# Reflecting the border avoids black corners after rotating.
+			out_images[i] = cv2.warpAffine(
+				images[i], matrices[i], (out_w, out_h),
+				flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101
+			).reshape(out_images.shape[1:])
+
+			# The reflected part of the image has no labels.
+			if masks is not None:
+				out_masks[i] = cv2.warpAffine(
+					masks[i], matrices[i], (out_w, out_h),
+					flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT,
+					borderValue=0
+				)
+
+		return out_images, out_masks
+
+	# Applies brightness, contrast, gamma and noise to a (N, H, W, C) batch,
+	# with the parameters of every sample drawn at once. Integer images are
+	# clipped to the range of their dtype. Float images are assumed to be in
+	# [0, 1].
+	def jitterIntensity(self, images, rng):
+		n     = images.shape[0]
+		dtype = images.dtype
+		shape = (n,) + (1,) * (images.ndim - 1)
+
+		if dtype.kind in 'ui':
+			max_value = float(np.iinfo(dtype).max)
+		else:
+			max_value = 1.0
+
+		brightness = rng.uniform(-self.brightness, self.brightness, n).reshape(shape)
+		contrast   = 1 + rng.uniform(-self.contrast, self.contrast, n).reshape(shape)
+		gamma      = 1 + rng.uniform(-self.gamma, self.gamma, n).reshape(shape)
+
+		out  = images.astype(np.float32)
+		out *= 1 / max_value
+
+		# Gamma is only defined for values in [0, 1].
+		np.clip(out, 0, None, out=out)
+		np.power(out, gamma.astype(np.float32), out=out)
+
+		# Contrast scales around the mean of each sample.
+		mean = out.mean(axis=tuple(range(1, out.ndim)), keepdims=True)
+		out -= mean
+		out *= contrast.astype(np.float32)
+		out += mean + brightness.astype(np.float32)
+
+		if self.noise > 0:
+			out += rng.standard_normal(out.shape, dtype=np.float32) * self.noise
+
+		out *= max_value
+		if dtype.kind in 'ui':
+			np.clip(out, 0, max_value, out=out)
+			np.rint(out, out=out)
+
+		return out.astype(dtype)
+
+	# Augments a batch of images and masks (masks can be None) with the
+	# given random generator. Returns (images, masks) arrays.
+	def augmentBatch(self, images, masks, rng):
+		shapes   = [img.shape[:2] for img in images]
+		matrices = self.sampleTransforms(shapes, rng)
+
+		images, masks = self.transformBatch(images, masks, matrices)
+		images        = self.jitterIntensity(images, rng)
+
+		return images, masks
+
+# Returns the random generator for the batch at the given position in a
+# stream of batches.
+def batchGenerator(seed, batch_idx):
+	return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(batch_idx,)))
+
+# Augments one batch in a worker process.
+def _augmentWorker(augmenter, images, masks, seed, batch_idx):
+	return augmenter.augmentBatch(images, masks, batchGenerator(seed, batch_idx))
+
+# Only one thread per process, since there is already a process per core.
+def _initWorker():
+	cv2.setNumThreads(1)
+
+# Augments a stream of (images, masks) batches, such as the one produced
+# by PatchExporter.readBatches, and yields the augmented batches in the
+# same order. If processes is greater than zero, the batches are augmented
+# by that many worker processes, with at most prefetch batches in flight at
+# once. The same seed always produces the same batches.
+def augmentBatches(batches, augmenter, seed=0, processes=0, prefetch=None):
+	if processes <= 0:
+		for batch_idx, (images, masks) in enumerate(batches):
+			yield augmenter.augmentBatch(
+				images, masks, batchGenerator(seed, batch_idx)
+			)
+		return
+
+	from concurrent.futures import ProcessPoolExecutor
+
+	prefetch = 2 * processes if prefetch is None else prefetch
+	batches  = enumerate(batches)
+	pending  = deque()
+
+	with ProcessPoolExecutor(processes, initializer=_initWorker) as pool:
+		while True:
+			for batch_idx, (images, masks) in batches:
+				pending.append(pool.submit(
+					_augmentWorker, augmenter, images, masks, seed, batch_idx
+				))
+				if len(pending) >= prefetch:
+					break
+
+			if len(pending) == 0:
+				return
+
+			yield pending.popleft().result()
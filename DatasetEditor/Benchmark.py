@@ -0,0 +1,270 @@
+# Author:      Adam Robinson
+# Description: This file benchmarks the dataset loading path and the hot
+#              paths of the editor on a synthetic dataset. The editor parts
+#              run against kivy's mock OpenGL backend, so no display or GPU
+#              is needed. Results are written as json and can be compared
+#              against a saved baseline to catch regressions.
+#
+#              python Benchmark.py --output results.json
+#              python Benchmark.py --baseline results.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+
+import cv2
+import numpy as np
+
+# Writes a dataset of random images, each with contours_per_image random
+# polygons spread over a few classes, to path.
+def generateDataset(path, n_images, width, height, contours_per_image,
+                    points_per_contour, seed=0):
+	rng = np.random.default_rng(seed)
+	os.makedirs(path, exist_ok=True)
+
+	classes = [
+		{'name': 'class_%d'%i, 'color': [rng.random(), rng.random(), rng.random(), 1.0]}
+		for i in range(4)
+	]
+
+	entries = {}
+	for i in range(n_images):
+		key = 'image_%05d.png'%i
+
+		# Smooth gradients with some noise compress and decode more like real
+		# micrographs than pure noise does.
+		y, x = np.mgrid[0:height, 0:width]
+		img  = np.stack([
+			(x * 255 // max(width - 1, 1)),
+			(y * 255 // max(height - 1, 1)),
+			rng.integers(0, 32, (height, width))
+		], axis=2).astype(np.uint8)
+		cv2.imwrite(os.path.join(path, key), img)
+
+		contours = []
+		for j in range(contours_per_image):
+			center = rng.random(2) * 0.8 + 0.1
+			angles = np.sort(rng.random(points_per_contour)) * 2 * np.pi
+			radius = 0.02 + rng.random() * 0.05
+			points = center + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+			contours.append({
+				'geometry'  : np.float32(points).astype(np.float64).tolist(),
+				'class_idx' : int(rng.integers(0, len(classes))),
+				'name'      : '',
+				'comment'   : ''
+			})
+		entries[key] = contours
+
+	with open(os.path.join(path, 'meta.json'), 'w') as file:
+		file.write(json.dumps({'classes': classes, 'entries': entries}))
+
+# Calls function repeat times and returns the duration of each call.
+# setup is called before each call, outside of the timed region.
+def _timeCalls(function, repeat, setup=None):
+	durations = []
+	for i in range(repeat):
+		if setup is not None:
+			setup()
+
+		start = time.perf_counter()
+		function()
+		durations.append(time.perf_counter() - start)
+
+	return durations
+
+def _summarize(durations):
+	durations = np.array(durations)
+	return {
+		'n'      : int(durations.shape[0]),
+		'min'    : float(durations.min()),
+		'median' : float(np.median(durations)),
+		'mean'   : float(durations.mean()),
+		'max'    : float(durations.max())
+	}
+
+# The benchmarks that don't need kivy.
+def _datasetBenchmarks(path, repeat):
+	from Dataset import Dataset, setupThumbnailBuffer, thumbnailSizeForWidth
+
+	thumbnail_size = thumbnailSizeForWidth(200)
+	cache_path     = os.path.join(path, '.cache')
+	results        = {}
+
+	def clear_cache():
+		shutil.rmtree(cache_path, ignore_errors=True)
+
+	def load():
+		Dataset().loadDirectory(path, thumbnail_size, lambda p: None)
+
+	results['load_directory'] = _timeCalls(load, repeat, clear_cache)
+
+	# The last load left the cache populated, so this measures a warm load.
+	results['load_directory_cached'] = _timeCalls(load, repeat)
+
+	img = cv2.imread(
+		os.path.join(path, sorted(f for f in os.listdir(path) if f.endswith('.png'))[0])
+	)
+	results['setup_thumbnail_buffer'] = _timeCalls(
+		lambda: setupThumbnailBuffer(img, thumbnail_size), repeat * 10
+	)
+
+	return results
+
+# The benchmarks that exercise the editor. These need a kivy window, which
+# is created with the mock OpenGL backend unless another one was chosen.
+def _editorBenchmarks(path, repeat, points_per_contour):
+	os.environ.setdefault('KIVY_GL_BACKEND', 'mock')
+	os.environ.setdefault('KIVY_NO_ARGS', '1')
+	os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+
+	from Dataset      import Dataset, thumbnailSizeForWidth
+	from ImageDisplay import ImageDisplay
+
+	dataset = Dataset().loadDirectory(
+		path, thumbnailSizeForWidth(200), lambda p: None
+	)
+	key = next(iter(dataset.meta_structure['entries']))
+
+	display = ImageDisplay(orientation='vertical', size=(1280, 770))
+	manager = display.image_manager
+	manager.size = (1280, 720)
+	display.setImage(key, dataset)
+
+	results = {}
+
+	def zoom():
+		w, h = manager.display_width, manager.display_height
+		manager.zoomTo(w * 0.25, w * 0.75, h * 0.25, h * 0.75)
+
+	results['zoom_to'] = _timeCalls(zoom, repeat, manager.reset)
+	manager.reset()
+
+	results['update_contours_for_zoom'] = _timeCalls(
+		manager.updateContoursForZoom, repeat
+	)
+
+	# The time taken to place every point of a contour, one at a time, the
+	# way a user would.
+	rng    = np.random.default_rng(0)
+	points = rng.random((points_per_contour, 2))
+
+	def draw_contour():
+		for x, y in points:
+			display.addPointToContour(x, y)
+
+	def start_contour():
+		if display.contour_on_stack:
+			manager.popLine()
+		display.contour_on_stack = False
+		display.newContour()
+
+	results['add_point_to_contour'] = [
+		d / points_per_contour
+		for d in _timeCalls(draw_contour, repeat, start_contour)
+	]
+
+	return results
+
+# Returns the benchmarks whose median got slower than the baseline by more
+# than the given fraction.
+def findRegressions(results, baseline, threshold):
+	regressions = []
+	for name, summary in results['benchmarks'].items():
+		if name not in baseline['benchmarks']:
+			continue
+
+		base  = baseline['benchmarks'][name]['median']
+		ratio = summary['median'] / base if base > 0 else 1.0
+		if ratio > 1.0 + threshold:
+			regressions.append({
+				'benchmark' : name,
+				'baseline'  : base,
+				'median'    : summary['median'],
+				'ratio'     : ratio
+			})
+
+	return regressions
+
+def main(argv):
+	parser = argparse.ArgumentParser(
+		description='Benchmark dataset loading and the editor hot paths.'
+	)
+	parser.add_argument('--images', type=int, default=50)
+	parser.add_argument('--width', type=int, default=1920)
+	parser.add_argument('--height', type=int, default=1080)
+	parser.add_argument('--contours', type=int, default=200,
+		help='The number of contours in each image.')
+	parser.add_argument('--points', type=int, default=32,
+		help='The number of points in each contour.')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--no-editor', action='store_true',
+		help='Skip the benchmarks that need kivy.')
+	parser.add_argument('--output', help='Write the results to this file.')
+	parser.add_argument('--baseline',
+		help='Compare against results previously written with --output.')
+	parser.add_argument('--threshold', type=float, default=0.1,
+		help='The fractional slowdown that counts as a regression.')
+	args = parser.parse_args(argv)
+
+	path = tempfile.mkdtemp(prefix='segmentation_kit_benchmark_')
+	try:
+		generateDataset(
+			path, args.images, args.width, args.height,
+			args.contours, args.points
+		)
+
+		durations = _datasetBenchmarks(path, args.repeat)
+		if not args.no_editor:
+			durations.update(_editorBenchmarks(path, args.repeat, args.points))
+	finally:
+		shutil.rmtree(path, ignore_errors=True)
+
+	results = {
+		'parameters' : {
+			'images'   : args.images,
+			'width'    : args.width,
+			'height'   : args.height,
+			'contours' : args.contours,
+			'points'   : args.points,
+			'repeat'   : args.repeat
+		},
+		'machine'    : {
+			'platform' : platform.platform(),
+			'python'   : platform.python_version(),
+			'cpus'     : os.cpu_count()
+		},
+		'benchmarks' : {k: _summarize(v) for k, v in durations.items()}
+	}
+
+	code = 0
+	if args.baseline is not None:
+		with open(args.baseline, 'r') as file:
+			baseline = json.loads(file.read())
+
+		results['regressions'] = findRegressions(results, baseline, args.threshold)
+		if len(results['regressions']) > 0:
+			code = 1
+
+	if args.output is not None:
+		with open(args.output, 'w') as file:
+			file.write(json.dumps(results, indent=4))
+
+	for name, summary in results['benchmarks'].items():
+		print('%-26s median %10.6fs  min %10.6fs'%(
+			name, summary['median'], summary['min']
+		))
+
+	for regression in results.get('regressions', []):
+		print('REGRESSION: %s is %1.2fx slower than the baseline'%(
+			regression['benchmark'], regression['ratio']
+		))
+
+	return code
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
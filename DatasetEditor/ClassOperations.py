@@ -0,0 +1,70 @@
+# Author:      Adam Robinson
+# Description: This file contains operations that change the classes of an
+#              entire dataset at once (renaming, merging and deleting). They
+#              only touch meta.json, so no images are decoded and kivy isn't
+#              needed. They are run from the command line by the
+#              rename-class, merge-classes and delete-classes commands in
+#              DatasetCLI.py.
+
+import numpy as np
+
+# Returns the index of the class with the given name. Class names don't
+# have to be unique, and a name shared by several classes is an error
+# rather than a guess at which one was meant.
+def _getClassIndex(dataset, name):
+	indices = [
+		i for i, c in enumerate(dataset.meta_structure['classes'])
+		if c['name'] == name
+	]
+
+	if len(indices) == 0:
+		raise Exception("The dataset has no class named \'%s\'"%name)
+
+	if len(indices) > 1:
+		raise Exception(
+			"The dataset has %d classes named \'%s\'"%(len(indices), name)
+		)
+
+	return indices[0]
+
+def renameClass(dataset, old_name, new_name):
+	names = [c['name'] for c in dataset.meta_structure['classes']]
+	if new_name in names:
+		raise Exception("The dataset already has a class named \'%s\'"%new_name)
+
+	idx = _getClassIndex(dataset, old_name)
+	dataset.meta_structure['classes'][idx]['name'] = new_name
+
+# Removes the given classes from the class table. Contours of those classes
+# are moved to the class given by targets (a dictionary of class index ->
+# class index), or deleted if they aren't in it. The remaining classes are
+# renumbered and every contour is updated with a single lookup table.
+# Returns the number of contours that were deleted.
+def _removeClasses(dataset, removed, targets):
+	classes = dataset.meta_structure['classes']
+	kept    = [i for i in range(len(classes)) if i not in removed]
+
+	lut       = np.full(len(classes), -1, dtype=np.int64)
+	lut[kept] = np.arange(len(kept))
+	for source, target in targets.items():
+		lut[source] = lut[target]
+
+	n_removed = dataset.remapClasses(lut)
+	dataset.meta_structure['classes'] = [classes[i] for i in kept]
+
+	return n_removed
+
+# Moves every contour of the source classes into the target class and
+# removes the source classes.
+def mergeClasses(dataset, target_name, source_names):
+	target  = _getClassIndex(dataset, target_name)
+	sources = set(_getClassIndex(dataset, n) for n in source_names) - {target}
+
+	return _removeClasses(dataset, sources, {s: target for s in sources})
+
+# Removes the given classes along with every contour that belongs to them.
+# Returns the number of contours that were deleted.
+def deleteClasses(dataset, names):
+	removed = set(_getClassIndex(dataset, n) for n in names)
+
+	return _removeClasses(dataset, removed, {})
@@ -4,22 +4,19 @@
 #              user to edit properties of the currently selected contour.
 
 from kivy.uix.label        import Label
-from kivy.uix.image        import Image
-from kivy.uix.gridlayout   import GridLayout
 from kivy.uix.behaviors    import ButtonBehavior
-from kivy.graphics.texture import Texture
 from kivy.uix.button       import Button
-from kivy.graphics         import Rectangle, Color, Line
-from kivy.uix.scrollview   import ScrollView
 from kivy.uix.dropdown     import DropDown
 from kivy.uix.textinput    import TextInput
+from kivy.uix.recycleview  import RecycleView
+
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
 from kivy.utils import get_color_from_hex as hex_color
 
-from Dataset         import Dataset
 from CustomBoxLayout import CustomBoxLayout
-
-import numpy as np
+from Tracing         import traced
 
 
 # This contains the interface components that allow the user to select
@@ -31,8 +28,7 @@ class ClassSummary(CustomBoxLayout):
 
 		# The first item in this panel should be a dropdown containing
 		# all of the contours in the current image.
-		self.contour_select_dropdown = DropDown()
-		self.contour_select_dropdown.auto_dismiss = False
+		self.contour_select_dropdown = ContourList(self.setCurrentContour)
 
 		self.editor_box = CustomBoxLayout(
 			orientation='vertical',
@@ -40,8 +36,7 @@ class ClassSummary(CustomBoxLayout):
 			spacing=5
 		)
 
-		self.class_select_dropdown = DropDown()
-		self.class_select_dropdown.auto_dismiss = False
+		self.class_select_dropdown = ClassPicker(self._class_selected)
 
 		self.class_select_button = Button(
 			text='Select Class',
@@ -82,97 +77,90 @@ class ClassSummary(CustomBoxLayout):
 		self.add_widget(self.dropdown_activator)
 		self.add_widget(self.editor_box)
 
-		self.dropdown_open = False
-		self.current_entry = None
-		self.dataset       = None
-		self.contours               = []
-		self.contour_dropdown_items = []
-		self.current_contour        = None
-		self.class_names            = []
-		self.class_buttons          = []
+		self.dropdown_open   = False
+		self.current_entry   = None
+		self.dataset         = None
+		self.contours        = None
+		self.current_contour = None
+
+		# The class table that the class dropdown was last built from. The
+		# dropdown is only rebuilt when this changes.
+		self.class_table = None
 
 	def _name_text_changed(self, inst, val):
-		self.current_contour['name'] = val
+		if self.current_contour is not None:
+			if self.contours.names[self.current_contour] != val:
+				self.contours.setName(self.current_contour, val)
 
 	def _comment_text_changed(self, inst, val):
-		self.current_contour['comment'] = val
+		if self.current_contour is not None:
+			if self.contours.comments[self.current_contour] != val:
+				self.contours.setComment(self.current_contour, val)
 
-	def writeChangesToMemory(self):
-		if self.current_entry is None:
-			raise Exception("Nothing is currently being edited.")
+	def clearCurrentEntry(self):
+		self.contour_select_dropdown.setRows([])
 
-		entry = self.dataset.meta_structure['entries'][self.current_key]
-		for idx, contour in enumerate(self.contours):
-			entry[idx]['class_idx'] = contour['class_idx']
-			entry[idx]['name']      = contour['name']
-			entry[idx]['comment']   = contour['comment']
+		self.contours        = None
+		self.current_contour = None
 
-	def clearCurrentEntry(self):
-		if self.current_entry is not None:
-			for item in self.contour_dropdown_items:
-				self.contour_select_dropdown.remove_widget(item)
+	# The name displayed for a contour is its own name, if it has one, 
+	# otherwise the name of its class.
+	def _getDisplayName(self, idx):
+		class_idx = self.contours.class_idx[idx]
+		name      = self.contours.names[idx]
 
-		self.contours               = []
-		self.contour_dropdown_items = []
+		if name != '' and not name.isspace():
+			return name
 
-	def addContour(self, contour):
-		item_class_idx   = contour['class_idx']
-		item_class_color = self.dataset.meta_structure['classes'][item_class_idx]['color']
-		item_class_name  = self.dataset.meta_structure['classes'][item_class_idx]['name']
+		return self.dataset.meta_structure['classes'][class_idx]['name']
 
-		proper_name = item_class_name
-		if contour['name'] != '':
-			if not contour['name'].isspace():
-				proper_name = self.current_contour['name']
+	# The data displayed in the dropdown for contour idx of the current entry.
+	def _getContourRow(self, idx):
+		item_class_idx = int(self.contours.class_idx[idx])
 
-		dropdown_item = DropDownContourItem(
-			class_color=item_class_color,
-			index=item_class_idx,
-			class_name=proper_name
-		)
-		self.contour_select_dropdown.add_widget(dropdown_item)
-		dropdown_item.bind(on_press=self._item_selected)
+		return {
+			'class_color' : self.dataset.meta_structure['classes'][item_class_idx]['color'],
+			'index'       : item_class_idx,
+			'class_name'  : self._getDisplayName(idx),
+			'contour_idx' : idx
+		}
 
-		self.contours.append(contour)
-		self.contour_dropdown_items.append(dropdown_item)
+	# Adds an item to the dropdown for contour idx of the current entry.
+	def addContour(self, idx):
+		self.contour_select_dropdown.addRow(self._getContourRow(idx))
 
-	def setCurrentContour(self, contour):
-		self.current_contour = contour
-		item_class_idx   = contour['class_idx']
+	@traced('ClassSummary.setCurrentContour')
+	def setCurrentContour(self, idx):
+		self.current_contour = idx
+		item_class_idx   = int(self.contours.class_idx[idx])
 		item_class_color = self.dataset.meta_structure['classes'][item_class_idx]['color']
 		item_class_name  = self.dataset.meta_structure['classes'][item_class_idx]['name']
 
-		proper_name = item_class_name
-		if self.current_contour['name'] != '':
-			if not self.current_contour['name'].isspace():
-				proper_name = self.current_contour['name']
-
 		self.dropdown_activator.setProperties(
-			item_class_color, item_class_idx, proper_name
+			item_class_color, item_class_idx, self._getDisplayName(idx)
 		)
 
-		self.name_input.text          = contour['name']
-		self.comment_input.text       = contour['comment']
+		self.name_input.text          = self.contours.names[idx]
+		self.comment_input.text       = self.contours.comments[idx]
 		self.class_select_button.text = item_class_name
 
 		self.contour_select_dropdown.dismiss()
 		self.dropdown_open = False
 
+	@traced('ClassSummary.populateClassDropdown')
 	def populateClassDropdown(self):
-		for button in self.class_buttons:
-			self.class_select_dropdown.remove_widget(button)
-
-		self.class_names   = []
-		self.class_buttons = []
-		for _class in self.dataset.meta_structure['classes']:
-			self.class_names.append(_class['name'])
-			button = Button(
-				text=_class['name'], size_hint_y=None, height=30
+		class_table = [
+			(c['name'], tuple(c['color'])) 
+			for c in self.dataset.meta_structure['classes']
+		]
+
+		if class_table != self.class_table:
+			self.class_table = class_table
+			self.class_select_dropdown.setClasses(
+				[name for name, color in class_table]
 			)
-			self.class_buttons.append(button)
-			self.class_select_dropdown.add_widget(button)
-			button.bind(on_press=self._class_selected)
 
+	@traced('ClassSummary.setCurrentEntry')
 	def setCurrentEntry(self, key, dataset):
 		if self.current_entry is not None:
 			self.clearCurrentEntry()
@@ -181,16 +169,16 @@ class ClassSummary(CustomBoxLayout):
 		self.dataset       = dataset
 		self.current_entry = self.dataset.meta_structure['entries'][key]
 		self.current_key   = key
+		self.contours      = self.current_entry
 
 		self.populateClassDropdown()
 
-		# Add each of these to the internal structure, and therefore the
-		# image display.
-		for contour in self.current_entry:
-			self.addContour(contour)
+		self.contour_select_dropdown.setRows([
+			self._getContourRow(idx) for idx in range(len(self.contours))
+		])
 
-		if len(self.current_entry) > 0:
-			self.setCurrentContour(self.current_entry[0])
+		if len(self.contours) > 0:
+			self.setCurrentContour(0)
 
 	def _activator_pressed(self, inst):
 		if not self.dropdown_open:
@@ -203,52 +191,175 @@ class ClassSummary(CustomBoxLayout):
 	def _class_select_pressed(self, inst):
 		self.class_select_dropdown.open(inst)
 
-	def _class_selected(self, inst):
-		self.class_select_button.text = inst.text
-		self.current_contour['class_idx'] = self.class_names.index(inst.text)
+	def _class_selected(self, class_idx):
 		self.class_select_dropdown.dismiss()
 
+		if self.current_contour is None:
+			return
+
+		self.class_select_button.text = self.class_table[class_idx][0]
+
 		# We need to change the item in the dropdown list of contours to match.
-		class_idx   = self.class_names.index(inst.text)
-		contour_idx = self.contours.index(self.current_contour)
-		item_class_color = self.dataset.meta_structure['classes'][class_idx]['color']
-		item_class_name  = self.dataset.meta_structure['classes'][class_idx]['name']
+		contour_idx = self.current_contour
+		self.contours.setClass(contour_idx, class_idx)
 
-		proper_name = item_class_name
-		if self.current_contour['name'] != '':
-			if not self.current_contour['name'].isspace():
-				proper_name = self.current_contour['name']
+		item_class_color = self.dataset.meta_structure['classes'][class_idx]['color']
+		proper_name      = self._getDisplayName(contour_idx)
 
-		self.contour_dropdown_items[contour_idx].setProperties(
-			item_class_color, self.class_names.index(inst.text), proper_name
+		self.contour_select_dropdown.updateRow(
+			contour_idx, self._getContourRow(contour_idx)
 		)
 
 		self.dropdown_activator.setProperties(
-			item_class_color, self.class_names.index(inst.text), proper_name
+			item_class_color, class_idx, proper_name
 		)
 
 		self.parent.display.image_display.setContourColor(contour_idx, item_class_color)
 
-	def _item_selected(self, inst):
-		idx = self.contour_dropdown_items.index(inst)
-		contour = self.contours[idx]
 
-		self.setCurrentContour(contour)
 
-		
+# A dropdown for picking a class, with a search box at the top. Only the
+# rows that are visible are turned into widgets, so it stays responsive no
+# matter how many classes there are. Rows are identified by class index,
+# since class names aren't required to be unique.
+class ClassPicker(DropDown):
+	def __init__(self, callback, *args, **kwargs):
+		super(ClassPicker, self).__init__(*args, **kwargs)
 
-# This is a custom listbox item that displays the necessary information
-# about a contour in the list box.
-class DropDownContourItem(ButtonBehavior, CustomBoxLayout):
+		self.auto_dismiss = False
+		self.callback     = callback
+
+		self.box = CustomBoxLayout(
+			orientation='vertical',
+			size_hint_y=None,
+			height=330,
+			spacing=5
+		)
+
+		self.search_input = TextInput(
+			hint_text='Search',
+			multiline=False,
+			size_hint_y=None,
+			height=30
+		)
+		self.search_input.bind(text=self._search_changed)
+
+		self.list_view   = RecycleView(do_scroll_x=False)
+		self.list_layout = RecycleBoxLayout(
+			orientation='vertical',
+			default_size=(None, 30),
+			default_size_hint=(1, None),
+			size_hint_y=None
+		)
+		self.list_layout.bind(minimum_height=self.list_layout.setter('height'))
+		self.list_view.add_widget(self.list_layout)
+		self.list_view.viewclass = ClassPickerItem
+
+		self.box.add_widget(self.search_input)
+		self.box.add_widget(self.list_view)
+		self.add_widget(self.box)
+
+		self.rows        = []
+		self.lower_names = []
+
+	def setClasses(self, names):
+		self.rows = [
+			{'text': name, 'class_idx': idx, 'picker': self}
+			for idx, name in enumerate(names)
+		]
+		self.lower_names = [name.lower() for name in names]
+		self._search_changed(self.search_input, self.search_input.text)
+
+	def _search_changed(self, inst, val):
+		val = val.lower()
+		if val == '':
+			self.list_view.data = self.rows
+		else:
+			self.list_view.data = [
+				row for row, name in zip(self.rows, self.lower_names)
+				if val in name
+			]
+
+	def _item_selected(self, class_idx):
+		self.callback(class_idx)
+
+class ClassPickerItem(Button):
 	def __init__(self, *args, **kwargs):
-		self.class_color = kwargs['class_color']
-		self.index       = kwargs['index']
-		self.class_name  = kwargs['class_name']
+		super(ClassPickerItem, self).__init__(*args, **kwargs)
+
+		self.class_idx = -1
+		self.picker    = None
+
+	def on_release(self):
+		if self.picker is not None:
+			self.picker._item_selected(self.class_idx)
+
+# The dropdown list of contours in the current image. Like ClassPicker, only
+# the visible rows are turned into widgets, which are reused as the list is
+# scrolled. Row i always describes contour i of the current entry, so 
+# selecting or updating a contour doesn't require a search.
+class ContourList(DropDown):
+	def __init__(self, callback, *args, **kwargs):
+		super(ContourList, self).__init__(*args, **kwargs)
+
+		self.auto_dismiss = False
+		self.callback     = callback
+		self.row_height   = 36
+		self.max_height   = 400
+
+		self.list_view   = RecycleView(
+			do_scroll_x=False,
+			size_hint_y=None,
+			height=0
+		)
+		self.list_layout = RecycleBoxLayout(
+			orientation='vertical',
+			default_size=(None, self.row_height),
+			default_size_hint=(1, None),
+			size_hint_y=None
+		)
+		self.list_layout.bind(minimum_height=self.list_layout.setter('height'))
+		self.list_view.add_widget(self.list_layout)
+		self.list_view.viewclass = DropDownContourItem
+
+		self.add_widget(self.list_view)
+
+	def _updateHeight(self):
+		self.list_view.height = min(
+			self.row_height * len(self.list_view.data), 
+			self.max_height
+		)
+
+	def setRows(self, rows):
+		for row in rows:
+			row['contour_list'] = self
+
+		self.list_view.data = rows
+		self._updateHeight()
 
-		del kwargs['class_color']
-		del kwargs['index']
-		del kwargs['class_name']
+	def addRow(self, row):
+		row['contour_list'] = self
+		self.list_view.data.append(row)
+		self._updateHeight()
 
+	def updateRow(self, idx, row):
+		row['contour_list'] = self
+		self.list_view.data[idx] = row
+
+	def _item_selected(self, contour_idx):
+		self.callback(contour_idx)
+
+# This is a custom listbox item that displays the necessary information
+# about a contour in the list box. When used as the view class of a 
+# ContourList, these are created without any properties, which are then set
+# by refresh_view_attrs.
+class DropDownContourItem(RecycleDataViewBehavior, ButtonBehavior, CustomBoxLayout):
+	def __init__(self, *args, **kwargs):
+		self.class_color  = kwargs.pop('class_color', hex_color('#000000'))
+		self.index        = kwargs.pop('index', -1)
+		self.class_name   = kwargs.pop('class_name', '')
+		self.contour_idx  = None
+		self.contour_list = None
 
 		kwargs['orientation'] = 'horizontal'
 		kwargs['size_hint_y'] = None
@@ -297,6 +408,15 @@ class DropDownContourItem(ButtonBehavior, CustomBoxLayout):
 		self.add_widget(self.index_box)
 		self.add_widget(self.class_label_box)
 
+	def refresh_view_attrs(self, rv, index, data):
+		self.contour_idx  = data['contour_idx']
+		self.contour_list = data['contour_list']
+		self.setProperties(data['class_color'], data['index'], data['class_name'])
+
+	def on_press(self):
+		if self.contour_list is not None:
+			self.contour_list._item_selected(self.contour_idx)
+
 	def setProperties(self, color, index, name):
 		self.color_box.updateColor(color)
 		self.index_label.text = str(index)
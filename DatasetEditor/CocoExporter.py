@@ -0,0 +1,220 @@
+# Author:      Adam Robinson
+# Description: This file exports the contours in a dataset as COCO style
+#              json, for use with tools outside of SegmentationKit. Every
+#              contour becomes an annotation with its polygon in pixel
+#              coordinates, its bounding box and its area. Contours can also
+#              be run length encoded (RLE), the way pycocotools encodes
+#              masks. It doesn't depend on kivy, so it is run headlessly
+#              (see the export-coco command in DatasetCLI.py).
+#
+#              Images are processed in parallel, and the json is written
+#              out as each image is finished, so the whole document is never
+#              held in memory. Since COCO lists every image before any of the
+#              annotations, the annotations are written to a temporary file
+#              and copied to the end of the output once all of the images
+#              are done.
+
+import os
+import json
+import shutil
+import numpy as np
+
+from collections import deque
+
+# Run length encodes a mask covering the rectangle of an image with its top
+# left corner at (x0, y0), in the column major order used by COCO. Returns
+# the run lengths, starting with a run of zeros, and the number of pixels
+# that are set. The runs are found with numpy for the whole mask at once.
+def encodeRLE(mask, x0, y0, width, height):
+	# Each column of the mask, padded with a zero at both ends so that every
+	# run of ones starts and ends inside its column.
+	columns = np.zeros((mask.shape[1], mask.shape[0] + 2), dtype=np.int8)
+	columns[:, 1:-1] = mask.T != 0
+
+	edges        = np.diff(columns, axis=1)
+	s_col, s_row = np.nonzero(edges == 1)
+	e_col, e_row = np.nonzero(edges == -1)
+
+	# Positions in the flattened (column major) image. Ends are exclusive.
+	starts = (x0 + s_col) * height + y0 + s_row
+	ends   = (x0 + e_col) * height + y0 + e_row
+
+	# A run that reaches the bottom of the image continues at the top of the
+	# next column.
+	joined = np.nonzero(ends[:-1] == starts[1:])[0]
+	starts = np.delete(starts, joined + 1)
+	ends   = np.delete(ends, joined)
+
+	counts         = np.empty(2 * starts.shape[0] + 1, dtype=np.int64)
+	counts[0:-1:2] = starts - np.concatenate([[0], ends[:-1]])
+	counts[1::2]   = ends - starts
+	counts[-1]     = width * height - (ends[-1] if ends.shape[0] > 0 else 0)
+
+	return counts.tolist(), int(counts[1::2].sum())
+
+# Builds the annotations of a single image. Runs in a worker process.
+# Returns (width, height, annotations) or raises if the image can't be read.
+# The annotations don't have their ids or image ids yet.
+def _imageAnnotations(path, contours, rle):
+	from ImageDecoders     import readImageShape, decodeImage
+	from DatasetStatistics import computeGeometry
+	from MaskRasterizer    import contourMasks
+
+	shape = readImageShape(path)
+	if shape is None:
+		img = decodeImage(path)
+		if img is None:
+			raise Exception("Could not load file \'%s\'"%path)
+		shape = img.shape
+
+	height, width = shape[:2]
+	if len(contours) == 0:
+		return width, height, []
+
+	vertices = contours.vertices.astype(np.float64)
+	sizes    = np.repeat([[width, height]], len(contours), axis=0)
+	geometry = computeGeometry(vertices, contours.offsets, sizes)
+
+	# Pixel coordinates with the origin at the top left of the image.
+	pixels       = np.empty_like(vertices)
+	pixels[:, 0] = vertices[:, 0] * width
+	pixels[:, 1] = (1.0 - vertices[:, 1]) * height
+	pixels       = np.round(pixels, 2)
+
+	masks = {}
+	if rle:
+		for i, x0, y0, mask in contourMasks(contours, width, height):
+			masks[i] = encodeRLE(mask, x0, y0, width, height)
+
+	annotations = []
+	offsets     = contours.offsets
+	for i in range(len(contours)):
+		# COCO polygons need at least three points.
+		if offsets[i + 1] - offsets[i] < 3:
+			continue
+
+		x_min, y_min = geometry['x_min'][i], geometry['y_min'][i]
+		x_max, y_max = geometry['x_max'][i], geometry['y_max'][i]
+
+		annotation = {
+			'category_id' : int(contours.class_idx[i]) + 1,
+			'iscrowd'     : 0,
+			'bbox'        : [
+				float(x_min), float(y_min),
+				float(x_max - x_min), float(y_max - y_min)
+			],
+			'area'        : float(geometry['area'][i])
+		}
+
+		if rle:
+			counts, area = masks[i]
+			annotation['segmentation'] = {
+				'size'   : [height, width],
+				'counts' : counts
+			}
+			annotation['area'] = float(area)
+		else:
+			annotation['segmentation'] = [
+				pixels[offsets[i]:offsets[i + 1]].ravel().tolist()
+			]
+
+		annotations.append(annotation)
+
+	return width, height, annotations
+
+# Writes the given images of a dataset (all images with an entry in
+# meta.json by default) to path as COCO json. If rle is True, segmentations
+# are run length encoded instead of polygons, and areas are pixel counts
+# instead of polygon areas. Returns a summary of what was written.
+# progress_callback(n_done, n_images) is called after each image.
+def exportCOCO(dataset, path, rle=False, processes=None, keys=None,
+	           progress_callback=None):
+	from concurrent.futures import ProcessPoolExecutor
+
+	from Contour import ContourSet
+
+	entries = dataset.meta_structure['entries']
+	keys    = list(entries) if keys is None else list(keys)
+
+	categories = [
+		{'id': i + 1, 'name': c['name'], 'supercategory': ''}
+		for i, c in enumerate(dataset.meta_structure['classes'])
+	]
+
+	tmp_path         = path + '.%d.tmp'%os.getpid()
+	annotations_path = path + '.%d.annotations.tmp'%os.getpid()
+
+	n_images      = 0
+	n_annotations = 0
+	failed        = []
+
+	with open(tmp_path, 'w') as file, open(annotations_path, 'w+') as annotations_file:
+		file.write('{"info": %s, "categories": %s, "images": ['%(
+			json.dumps({'description': os.path.basename(dataset.root_path)}),
+			json.dumps(categories)
+		))
+
+		with ProcessPoolExecutor(processes, initializer=_initWorker) as pool:
+			# Only a few images are in flight at once, so that finished
+			# results don't pile up in memory. Results are consumed in order,
+			# so the ids are the same on every run.
+			window   = 4 * (processes or os.cpu_count())
+			pending  = deque()
+			next_key = 0
+
+			for image_id, key in enumerate(keys, 1):
+				while next_key < len(keys) and len(pending) < window:
+					pending.append(pool.submit(
+						_imageAnnotations,
+						os.path.join(dataset.root_path, keys[next_key]),
+						entries.get(keys[next_key], ContourSet()), rle
+					))
+					next_key += 1
+
+				try:
+					width, height, annotations = pending.popleft().result()
+				except Exception as ex:
+					failed.append({'key': key, 'error': str(ex)})
+					annotations = None
+
+				if progress_callback is not None:
+					progress_callback(image_id, len(keys))
+
+				if annotations is None:
+					continue
+
+				image = {
+					'id'        : image_id,
+					'file_name' : key,
+					'width'     : width,
+					'height'    : height
+				}
+				file.write((', ' if n_images > 0 else '') + json.dumps(image))
+				n_images += 1
+
+				for annotation in annotations:
+					annotation['id']       = n_annotations + 1
+					annotation['image_id'] = image_id
+					annotations_file.write(
+						(', ' if n_annotations > 0 else '') + json.dumps(annotation)
+					)
+					n_annotations += 1
+
+		file.write('], "annotations": [')
+		annotations_file.seek(0)
+		shutil.copyfileobj(annotations_file, file)
+		file.write(']}')
+
+	os.remove(annotations_path)
+	os.replace(tmp_path, path)
+
+	return {
+		'n_images'      : n_images,
+		'n_annotations' : n_annotations,
+		'failed'        : failed
+	}
+
+# Only one thread per process, since there is already a process per core.
+def _initWorker():
+	import cv2
+	cv2.setNumThreads(1)
@@ -0,0 +1,232 @@
+# Author:      Adam Robinson
+# Description: This file contains the in memory representation of the
+#              contours in an image. The vertices of every contour in an
+#              image are stored in a single contiguous array, so that
+#              geometry can be computed on all of them at once.
+
+import numpy as np
+
+# The keys of a contour in meta.json that are stored as columns. Anything
+# else found in a contour is kept as is, so that it survives a round trip.
+_known_keys = ('geometry', 'class_idx', 'name', 'comment')
+
+# A single contour. Instances of this are returned when indexing into a
+# ContourSet, in which case points is a view into the vertex array of the
+# set. Modifying the set (appending, removing, etc.) may reallocate that
+# array, so these should not be held onto. Use the ContourSet methods to
+# make changes.
+class Contour:
+	__slots__ = ('points', 'class_idx', 'name', 'comment')
+
+	def __init__(self, points, class_idx=0, name='', comment=''):
+		if not isinstance(points, np.ndarray):
+			points = np.array(points, dtype=np.float64)
+
+		self.points    = points.reshape(-1, 2)
+		self.class_idx = class_idx
+		self.name      = name
+		self.comment   = comment
+
+	def __len__(self):
+		return self.points.shape[0]
+
+
+# Columnar storage for all of the contours in a single image. The points
+# of contour i are vertices[offsets[i]:offsets[i + 1]]. Coordinates are
+# relative coordinates (see ImageDisplay.py).
+#
+# Vertices are stored as float32 whenever every coordinate can be
+# represented exactly, which is always the case for contours created in the
+# editor. Coordinates that can't (contours from older meta.json files) are
+# stored as float64 instead, so that converting to and from the json schema
+# never changes a value.
+class ContourSet:
+	def __init__(self, dtype=np.float32):
+		self.vertices  = np.zeros((0, 2), dtype=dtype)
+		self.offsets   = np.zeros(1, dtype=np.int64)
+		self.class_idx = np.zeros(0, dtype=np.int32)
+		self.names     = []
+		self.comments  = []
+		self.extras    = []
+
+		# Incremented every time the set is modified. Anything derived from
+		# the contours can compare against this to know when to recompute.
+		self.version = 0
+
+	# Builds a set from the list of contour dictionaries stored for an
+	# entry in meta.json.
+	@classmethod
+	def fromEntry(cls, entry):
+		geometries = [
+			np.asarray(c['geometry'], dtype=np.float64).reshape(-1, 2)
+			for c in entry
+		]
+		lengths  = [g.shape[0] for g in geometries]
+		vertices = np.concatenate(geometries) if len(geometries) > 0 else None
+
+		contour_set = cls(dtype=_smallestExactDtype(vertices))
+		if vertices is not None:
+			contour_set.vertices = vertices.astype(contour_set.vertices.dtype)
+
+		contour_set.offsets   = np.zeros(len(entry) + 1, dtype=np.int64)
+		np.cumsum(lengths, out=contour_set.offsets[1:])
+		contour_set.class_idx = np.array(
+			[c.get('class_idx', 0) for c in entry], dtype=np.int32
+		)
+		contour_set.names    = [c.get('name', '')    for c in entry]
+		contour_set.comments = [c.get('comment', '') for c in entry]
+		contour_set.extras   = [
+			{k: v for k, v in c.items() if k not in _known_keys}
+			for c in entry
+		]
+
+		return contour_set
+
+	# Converts the set back into the list of dictionaries that is stored
+	# in meta.json.
+	def toEntry(self):
+		# Converting the arrays to lists once is much faster than converting
+		# each contour's points separately.
+		vertices  = self.vertices.tolist()
+		offsets   = self.offsets.tolist()
+		class_idx = self.class_idx.tolist()
+
+		entry = []
+		for i in range(len(self)):
+			contour = {
+				'geometry'  : vertices[offsets[i]:offsets[i + 1]],
+				'class_idx' : class_idx[i],
+				'name'      : self.names[i],
+				'comment'   : self.comments[i]
+			}
+			contour.update(self.extras[i])
+			entry.append(contour)
+
+		return entry
+
+	def copy(self):
+		contour_set           = ContourSet(dtype=self.vertices.dtype)
+		contour_set.vertices  = self.vertices.copy()
+		contour_set.offsets   = self.offsets.copy()
+		contour_set.class_idx = self.class_idx.copy()
+		contour_set.names     = list(self.names)
+		contour_set.comments  = list(self.comments)
+		contour_set.extras    = [dict(e) for e in self.extras]
+
+		return contour_set
+
+	def __len__(self):
+		return self.class_idx.shape[0]
+
+	def __getitem__(self, idx):
+		if idx < 0:
+			idx += len(self)
+
+		return Contour(
+			self.getPoints(idx),
+			int(self.class_idx[idx]),
+			self.names[idx],
+			self.comments[idx]
+		)
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	# Returns a view of the points of contour idx.
+	def getPoints(self, idx):
+		return self.vertices[self.offsets[idx]:self.offsets[idx + 1]]
+
+	# Returns the number of vertices in each contour.
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	# The number of bytes used by the arrays in the set. This doesn't include
+	# the names and comments.
+	@property
+	def nbytes(self):
+		return self.vertices.nbytes + self.offsets.nbytes + self.class_idx.nbytes
+
+	def append(self, contour):
+		points = np.asarray(contour.points, dtype=np.float64).reshape(-1, 2)
+
+		# Fall back to float64 if the new points can't be stored exactly.
+		if self.vertices.dtype == np.float32:
+			if _smallestExactDtype(points) != np.float32:
+				self.vertices = self.vertices.astype(np.float64)
+
+		self.vertices  = np.concatenate((
+			self.vertices, points.astype(self.vertices.dtype)
+		))
+		self.offsets   = np.append(self.offsets, self.vertices.shape[0])
+		self.class_idx = np.append(self.class_idx, np.int32(contour.class_idx))
+		self.names.append(contour.name)
+		self.comments.append(contour.comment)
+		self.extras.append({})
+		self.version += 1
+
+	def remove(self, idx):
+		start, end = self.offsets[idx], self.offsets[idx + 1]
+
+		self.vertices  = np.delete(self.vertices, np.s_[start:end], axis=0)
+		self.offsets   = np.delete(self.offsets, idx + 1)
+		self.offsets[idx + 1:] -= end - start
+		self.class_idx = np.delete(self.class_idx, idx)
+		del self.names[idx]
+		del self.comments[idx]
+		del self.extras[idx]
+		self.version += 1
+
+	def setClass(self, idx, class_idx):
+		self.class_idx[idx] = class_idx
+		self.version += 1
+
+	# Changes the class of every contour at once. lut is an integer array
+	# where lut[old] is the new class index, or -1 if contours of that class
+	# should be removed. Returns the number of contours that were removed.
+	def remapClasses(self, lut):
+		class_idx = lut[self.class_idx]
+		keep      = class_idx >= 0
+		n_removed = int(keep.shape[0] - np.count_nonzero(keep))
+
+		if n_removed > 0:
+			lengths = self.lengths()[keep]
+
+			self.vertices = self.vertices[np.repeat(keep, self.lengths())]
+			self.offsets  = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+			np.cumsum(lengths, out=self.offsets[1:])
+
+			kept          = np.nonzero(keep)[0].tolist()
+			self.names    = [self.names[i]    for i in kept]
+			self.comments = [self.comments[i] for i in kept]
+			self.extras   = [self.extras[i]   for i in kept]
+
+		self.class_idx = class_idx[keep].astype(np.int32)
+		self.version  += 1
+
+		return n_removed
+
+	def setName(self, idx, name):
+		self.names[idx] = name
+		self.version += 1
+
+	def setComment(self, idx, comment):
+		self.comments[idx] = comment
+		self.version += 1
+
+# Returns float32 if every value in the array survives a conversion to
+# float32 unchanged, otherwise float64.
+def _smallestExactDtype(values):
+	if values is None or values.size == 0:
+		return np.dtype(np.float32)
+
+	if np.array_equal(values.astype(np.float32).astype(np.float64), values):
+		return np.dtype(np.float32)
+
+	return np.dtype(np.float64)
+
+# Rounds a relative coordinate to the nearest value that can be stored
+# exactly as float32. Points placed in the editor go through this so that
+# their contours can be stored compactly.
+def snapCoordinate(value):
+	return float(np.float32(value))
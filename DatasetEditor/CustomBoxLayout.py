@@ -9,19 +9,23 @@ from kivy.graphics        import Rectangle, Color, Line, InstructionGroup
 
 from kivy.utils import get_color_from_hex as hex_color
 
+# Tuples, so that one instance can't change the default for every other one.
+_default_background_color = tuple(hex_color("#333333"))
+_default_border_color     = tuple(hex_color("#595959"))
+
 class CustomBoxLayout(BoxLayout):
 	def __init__(self, *args, **kwargs):
 		if 'color' in kwargs:
 			self.background_color = kwargs['color']
 			del kwargs['color']
 		else:
-			self.background_color = hex_color("#333333")
+			self.background_color = _default_background_color
 
 		if 'border_color' in kwargs:
 			self.border_color = kwargs['border_color']
 			del kwargs['border_color']
 		else:
-			self.border_color = hex_color("#595959")
+			self.border_color = _default_border_color
 
 		# left, top, right, bottom
 		if 'border' in kwargs:
@@ -42,45 +46,59 @@ class CustomBoxLayout(BoxLayout):
 			pos=self._update_rect
 		)
 
+	# The instructions are only created once. Changing the colors afterwards
+	# just modifies the existing Color instructions. When there is no border
+	# the background covers the whole widget, so the border instructions are
+	# skipped entirely.
 	def updateDraw(self):
 		if self.draw_instructions is not None:
 			self.canvas.before.remove(self.draw_instructions)
 
 		self.draw_instructions = InstructionGroup()
+		self.has_border        = any(w != 0 for w in self.border)
+
+		if self.has_border:
+			self.border_color_instruction = Color(*self.border_color)
+			self.border_rect = Rectangle(size=self.size, pos=self.pos)
+			self.draw_instructions.add(self.border_color_instruction)
+			self.draw_instructions.add(self.border_rect)
 
-		self.draw_instructions.add(Color(*self.border_color))
-		self.border_rect = Rectangle(size=self.size, pos=self.pos)
-		self.draw_instructions.add(self.border_rect)
-		self.draw_instructions.add(Color(*self.background_color))
+		self.background_color_instruction = Color(*self.background_color)
 		p, s = self._get_background_rect(self.pos, self.size)
 		self.rect = Rectangle(pos=p, size=s)
+		self.draw_instructions.add(self.background_color_instruction)
 		self.draw_instructions.add(self.rect)
 
 		self.canvas.before.add(self.draw_instructions)
 
 	def updateColor(self, color):
 		if color is None:
-			self.background_color = hex_color("#333333")
+			self.background_color = _default_background_color
 		else:
 			self.background_color = color
 
-		self.updateDraw()
+		self.background_color_instruction.rgba = self.background_color
 
 	def changeBorderColor(self, color):
 		if color is None:
-			self.border_color = hex_color("#595959")
+			self.border_color = _default_border_color
 		else:
 			self.border_color = color
 
-		self.updateDraw()
+		if self.has_border:
+			self.border_color_instruction.rgba = self.border_color
 
 	def _update_rect(self, instance, value):
-		self.border_rect.pos  = instance.pos
-		self.border_rect.size = instance.size
+		if self.has_border:
+			self.border_rect.pos  = instance.pos
+			self.border_rect.size = instance.size
 
-		p, s = self._get_background_rect(instance.pos, instance.size)
-		self.rect.pos  = p
-		self.rect.size = s
+			p, s = self._get_background_rect(instance.pos, instance.size)
+			self.rect.pos  = p
+			self.rect.size = s
+		else:
+			self.rect.pos  = instance.pos
+			self.rect.size = instance.size
 
 	def _get_background_rect(self, pos, size):
 		left, top, right, bottom = self.border
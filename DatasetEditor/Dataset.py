@@ -3,106 +3,525 @@
 #              of the dataset files and the dataset json file.
 
 import os
-import sys
-import code
 import cv2
 import json
 import numpy as np
 
+from collections import OrderedDict
+
+from ImagePyramid    import ImagePyramid
+from DecodeWorker    import FrameLease
+from Contour         import ContourSet
+from AnnotationIndex import AnnotationIndex
+from DatasetCache    import DatasetCache
+from ImageDecoders   import decodeImage, readImageShape
+from ImageHeader     import splitPage, pagePath, readTiffPages
+from DisplayWindow   import DisplayWindow
+from Tracing         import span, traced
+
+# The extensions of the files that are considered to be images when a
+# directory is loaded.
+image_extensions = ['bmp', 'jpg', 'png', 'tif', 'tiff']
+
 class Dataset:
-	def __init__(self, ext=None):
+	def __init__(self, ext=None, decode_worker=None, memory_budget=None):
 		if ext is None:
-			self.valid_extensions = ['bmp', 'jpg', 'png', 'tiff']
+			self.valid_extensions = list(image_extensions)
 		else:
 			self.valid_extensions = ext
 
-	def loadDirectory(self, path, thumbnail_size, update_callback):
-		self.root_path      = path
-		self.thumbnail_size = thumbnail_size
-
-		# Load a list of files and filter out anything that isn't
-		# an image.
-		files = [f for f in os.listdir(path)]
-		files = [f for f in files if os.path.isfile(os.path.join(path, f))]
-		files = [f for f in files if f.split('.')[-1] in self.valid_extensions]
+		# If a (started) DecodeWorker is provided, images are decoded in its
+		# processes. Only the thumbnails are kept in memory and full images
+		# are decoded into shared memory when they are requested.
+		self.decode_worker = decode_worker
 
-		n_files = len(files)
-		f_idx   = 0
+		# The maximum number of bytes that the in memory caches (see 
+		# memoryUsage) can hold, or None for no limit. Full images are 
+		# evicted, least recently used first, to stay under the budget. 
+		# Thumbnails can't be evicted, so loadDirectory refuses to load a 
+		# dataset whose thumbnails won't fit.
+		self.memory_budget = memory_budget
 
-		# Figure out if there is a meta.json file in the diretory.
+	# Loads only the meta.json file of a dataset, without reading any of the
+	# images. This is enough for anything that only works with the contours
+	# and classes (see ClassOperations.py).
+	@traced('Dataset.loadMetadata')
+	def loadMetadata(self, path):
+		self.root_path = path
 		self.meta_path = os.path.join(path, 'meta.json')
 
+		# Anything that can be regenerated from the images (pyramids, etc.)
+		# is stored here.
+		self.cache_path = os.path.join(path, '.cache')
+		self.cache      = DatasetCache(self.cache_path)
+
 		if os.path.isfile(self.meta_path):
 			self._loadMetaFile(self.meta_path)
 		else:
 			self.meta_structure = {'entries':{}, 'classes': []}
 
-		self.images     = {}
-		self.thumbnails = {}
+		self.index = AnnotationIndex(self.meta_structure['entries'])
+
+		# Each entry in the meta structure is a ContourSet. They are only 
+		# converted back into the json schema when the file is saved.
+
+		self.images       = OrderedDict()
+		self.thumbnails   = {}
+		self.pyramids     = {}
+		self.image_shapes = {}
+
+		# key -> DisplayWindow, which holds the histogram of the image and
+		# the brightness and contrast it is being displayed with.
+		self.display_windows = {}
+
+		# The number of bytes held by images and thumbnails. These are kept
+		# up to date by _storeImage, _evictImage and _storeThumbnail.
+		self.image_bytes     = 0
+		self.thumbnail_bytes = 0
+
+		return self
+
+	@traced('Dataset.loadDirectory')
+	def loadDirectory(self, path, thumbnail_size, update_callback):
+		self.thumbnail_size = thumbnail_size
+
+		# Load a list of files and filter out anything that isn't
+		# an image.
+		files = [f for f in os.listdir(path)]
+		files = [f for f in files if os.path.isfile(os.path.join(path, f))]
+		files = [f for f in files if f.split('.')[-1] in self.valid_extensions]
+
+		# This also builds the index, which is then kept up to date by 
+		# updateEntry, so that the preview pane can filter and sort without
+		# looking at every entry.
+		self.loadMetadata(path)
 
-		# Now we load everything that is in the meta structure.
-		# Once that is done, we load any additional files.
+		# Everything that is in the meta structure is loaded first, followed
+		# by any additional files.
+		keys = []
 		for k, v in self.meta_structure['entries'].items():
-			img_path = os.path.join(self.root_path, k)
+			img_path = splitPage(os.path.join(self.root_path, k))[0]
 
 			if not os.path.isfile(img_path):
 				raise Exception(
 					"File \'%s\' is missing from the directory"%img_path
 				)
 
-			try:
-				img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-			except Exception as ex:
+			keys.append(k)
+
+		for file in files:
+			for key in self.pageKeys(file):
+				if key not in self.meta_structure['entries']:
+					self.updateEntry(key, ContourSet())
+					keys.append(key)
+
+		n_files = len(keys)
+		f_idx   = 0
+
+		stamps = {
+			key: DatasetCache.fileStamp(os.path.join(self.root_path, key))
+			for key in keys
+		}
+
+		# Make sure that the dataset will fit before decoding anything. The 
+		# decoded images don't have to fit, older ones are evicted as newer
+		# ones are decoded.
+		if self.memory_budget is not None:
+			estimate = self.estimateMemory(keys, stamps, thumbnail_size)
+			if estimate['required'] > self.memory_budget:
 				raise Exception(
-					"Could not load file \'%s\'"%img_path
-				) from ex
+					"Loading \'%s\' needs %1.1f MB for %d thumbnails%s, which "
+					"is more than the memory budget of %1.1f MB. Raise the "
+					"budget or use a narrower preview pane."%(
+						path,
+						estimate['required'] / (1024 * 1024),
+						n_files,
+						'' if estimate['decode_slots'] == 0 else 
+						' and the decode buffers',
+						self.memory_budget / (1024 * 1024)
+					)
+				)
 
-			
-			self.images[k]     = img
-			self.thumbnails[k] = self._setupThumbnailBuffer(img)
+		# Thumbnails and image shapes that are already in the cache (see
+		# DatasetCache.py and the warm-cache command in DatasetCLI.py) are
+		# used as is. Only the remaining images have to be decoded.
+		missing = []
+		for key in keys:
+			thumbnail   = self.cache.loadThumbnail(key, stamps[key], thumbnail_size)
+			shape       = self.cache.getShape(key, stamps[key])
 
+			if thumbnail is None or shape is None:
+				missing.append(key)
+				continue
 
+			self._storeThumbnail(key, memoryview(thumbnail))
+			self.image_shapes[key] = shape
 
 			f_idx += 1
 			update_callback(f_idx / n_files)
 
-		# Now we load any files from the directory that aren't in the meta
-		# file and add an entry for them.
-		for file in files:
-			if file not in self.images:
-				img_path = os.path.join(self.root_path, file)
-				try:
-					img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-				except Exception as ex:
-					raise Exception(
-						"Could not load file \'%s\'"%img_path
-					) from ex
-
-				self.images[file]         = img
-				self.thumbnails[file]     = self._setupThumbnailBuffer(img)
-				self.meta_structure['entries'][file] = []
+		if self.decode_worker is None:
+			for key in missing:
+				img = self._readImage(key)
+
+				self._storeThumbnail(key, self._setupThumbnailBuffer(img))
+
+				# Stacks can have hundreds of pages, so pages are only kept in
+				# memory while they are being viewed.
+				if splitPage(key)[1] is None:
+					self._storeImage(key, img)
+				self.image_shapes[key] = img.shape
+				self._cacheThumbnail(key, stamps[key])
 
 				f_idx += 1
 				update_callback(f_idx / n_files)
+		else:
+			# Queue every thumbnail before waiting on any of them, so that all
+			# of the worker processes stay busy.
+			waits = []
+			for key in missing:
+				img_path = os.path.join(self.root_path, key)
+				waits.append((
+					key, 
+					self.decode_worker.submitThumbnail(img_path, thumbnail_size)
+				))
+
+			for key, wait in waits:
+				thumbnail, shape = wait()
 
-		# By this point all of the image files should be in memory and
+				self._storeThumbnail(key, memoryview(thumbnail))
+				self.image_shapes[key] = shape
+				self._cacheThumbnail(key, stamps[key])
+
+				f_idx += 1
+				update_callback(f_idx / n_files)
+
+		self.cache.save()
+
+		# By this point all of the thumbnails should be in memory and
 		# the meta structure should be setup.
 		return self
 
+	# Returns the keys of the entries for an image file. Every page of a 
+	# multi-page tiff is its own entry, keyed 'file.tif#page'. The page index
+	# of a file is cached, so the file is only parsed when it has changed. 
+	# An entry keyed by just the file name (from before the file was split
+	# into pages) is kept as the entry for the first page.
+	def pageKeys(self, file):
+		if file.split('.')[-1].lower() not in ('tif', 'tiff'):
+			return [file]
+
+		img_path = os.path.join(self.root_path, file)
+		stamp    = DatasetCache.fileStamp(img_path)
+		pages    = self.cache.getPages(file, stamp)
+
+		if pages is None:
+			pages = readTiffPages(img_path)
+			if pages is None:
+				return [file]
+			self.cache.putPages(file, stamp, pages)
+
+		if len(pages) <= 1:
+			return [file]
+
+		keys = [pagePath(file, page) for page in range(len(pages))]
+		if file in self.meta_structure['entries']:
+			keys[0] = file
+
+		return keys
+
+	# Stores a freshly computed thumbnail and image shape in the cache, so
+	# that the image doesn't need to be decoded the next time the dataset is
+	# loaded.
+	def _cacheThumbnail(self, key, stamp):
+		self.cache.putShape(key, stamp, self.image_shapes[key])
+		self.cache.saveThumbnail(
+			key, stamp, self.thumbnail_size, 
+			np.asarray(self.thumbnails[key])
+		)
+
+	# Replaces the contours of an entry and updates the index to match. 
+	# Anything that modifies the contours of an entry should call this when
+	# it is done.
+	def updateEntry(self, key, contours):
+		self.meta_structure['entries'][key] = contours
+		self.index.updateEntry(key, contours)
+
+	# Estimates the memory needed to load the given keys, using the image 
+	# shapes in the cache or, failing that, the image headers. The images are
+	# not decoded. 'required' is the memory that can't be evicted to stay 
+	# under the budget: the thumbnails and the decode worker's buffers.
+	def estimateMemory(self, keys, stamps, thumbnail_size):
+		thumbnails = len(keys) * thumbnail_size[0] * thumbnail_size[1] * 3
+
+		# Without a decode worker, every image that isn't in the thumbnail 
+		# cache is decoded in this process and kept until it is evicted. The
+		# headers don't give the bit depth, so 8 bits is assumed.
+		images = 0
+		if self.decode_worker is None:
+			for key in keys:
+				thumbnail_path = self.cache.thumbnailPath(
+					key, stamps[key], thumbnail_size
+				)
+				if os.path.isfile(thumbnail_path):
+					continue
+
+				shape = self.cache.getShape(key, stamps[key])
+				if shape is None:
+					shape = readImageShape(os.path.join(self.root_path, key))
+
+				if shape is not None:
+					images += shape[0] * shape[1] * 3
+
+		decode_slots = 0
+		if self.decode_worker is not None:
+			decode_slots = self.decode_worker.n_slots * self.decode_worker.slot_bytes
+
+		return {
+			'thumbnails'   : thumbnails,
+			'images'       : images,
+			'decode_slots' : decode_slots,
+			'required'     : thumbnails + decode_slots
+		}
+
+	# Returns the number of bytes currently held by each in memory cache, 
+	# their total and the memory budget (None if there isn't one).
+	def memoryUsage(self):
+		# Pyramid levels are built lazily, so they are counted here instead
+		# of as they are built. Only the levels held in memory count (see
+		# ImagePyramid.residentBytes).
+		pyramids = sum(p.residentBytes() for p in self.pyramids.values())
+
+		decode_slots = 0
+		if self.decode_worker is not None:
+			decode_slots = self.decode_worker.n_slots * self.decode_worker.slot_bytes
+
+		usage = {
+			'images'       : self.image_bytes,
+			'thumbnails'   : self.thumbnail_bytes,
+			'pyramids'     : pyramids,
+			'decode_slots' : decode_slots
+		}
+		usage['total']  = sum(usage.values())
+		usage['budget'] = self.memory_budget
+
+		return usage
+
+	def _storeThumbnail(self, key, thumbnail):
+		if key in self.thumbnails:
+			self.thumbnail_bytes -= self.thumbnails[key].nbytes
+
+		self.thumbnails[key]  = thumbnail
+		self.thumbnail_bytes += thumbnail.nbytes
+
+		if not self._fitBudget(0):
+			raise Exception(
+				"The thumbnails need more memory than the budget of %1.1f MB"%(
+					self.memory_budget / (1024 * 1024)
+				)
+			)
+
+	# Keeps a decoded image in memory, evicting older images if needed. An
+	# image that doesn't fit in the budget at all isn't kept, it will just be
+	# decoded again when it is needed.
+	def _storeImage(self, key, img):
+		if key in self.images:
+			self._evictImage(key)
+
+		if not self._fitBudget(img.nbytes):
+			return
+
+		self.images[key]  = img
+		self.image_bytes += img.nbytes
+
+	def _evictImage(self, key):
+		img = self.images.pop(key)
+		self.image_bytes -= img.nbytes
+
+		# The first level of the pyramid is the image.
+		self.pyramids.pop(key, None)
+
+	# Evicts images, least recently used first, until n_bytes more can be 
+	# held without going over the budget. Returns False if that isn't 
+	# possible.
+	def _fitBudget(self, n_bytes):
+		if self.memory_budget is None:
+			return True
+
+		def _total():
+			return self.memoryUsage()['total'] + n_bytes
+
+		while _total() > self.memory_budget and len(self.images) > 0:
+			self._evictImage(next(iter(self.images)))
+
+		return _total() <= self.memory_budget
+
+	# Returns a FrameLease (see DecodeWorker.py) for the full image of an 
+	# entry. The caller must call release() on it once it is no longer using
+	# the array.
+	@traced('Dataset.acquireImage')
+	def acquireImage(self, key):
+		if key in self.images:
+			self.images.move_to_end(key)
+			return FrameLease(self.images[key])
+
+		img_path = os.path.join(self.root_path, key)
+		if self.decode_worker is not None:
+			return self.decode_worker.decode(img_path)
+
+		# Without a worker the image was decoded here, so it is kept, the same
+		# way as the images decoded while loading.
+		img = self._readImage(key)
+		self._storeImage(key, img)
+		self.image_shapes[key] = img.shape
+
+		return FrameLease(img)
+
+	# Returns the (height, width, channels) of the full image of an entry.
+	# This is known for every image once the directory has been loaded.
+	# Otherwise it is read from the image header, and the image is only 
+	# decoded if none of the decoders can read the header.
+	def getImageShape(self, key):
+		if key not in self.image_shapes:
+			img_path = os.path.join(self.root_path, key)
+			stamp    = DatasetCache.fileStamp(img_path)
+			shape    = self.cache.getShape(key, stamp)
+
+			if shape is None:
+				shape = readImageShape(img_path)
+				if shape is None:
+					shape = self._readImage(key).shape
+				self.cache.putShape(key, stamp, shape)
+
+			self.image_shapes[key] = shape
+
+		return self.image_shapes[key]
+
+	def _readImage(self, key):
+		img_path = os.path.join(self.root_path, key)
+		try:
+			with span('Dataset.imread'):
+				img = decodeImage(img_path)
+		except Exception as ex:
+			raise Exception(
+				"Could not load file \'%s\'"%img_path
+			) from ex
+
+		if img is None:
+			raise Exception("Could not decode file \'%s\'"%img_path)
+
+		return img
+
 	# Buffers have to have a specific layout in memory for opengl to 
 	# display them. This function will set that up.
+	@traced('Dataset.setupThumbnailBuffer')
 	def _setupThumbnailBuffer(self, img):
-		thumbnail = cv2.resize(
-			img, 
-			tuple(self.thumbnail_size), 
-			interpolation=cv2.INTER_NEAREST
+		return memoryview(setupThumbnailBuffer(img, self.thumbnail_size))
+
+	# Returns a tiled multi-resolution pyramid for the given entry. The
+	# downsampled levels are cached on disk, so they only need to be built
+	# the first time a large image is viewed.
+	#
+	# If the image isn't resident in memory, the array it was acquired with
+	# has to be provided. That pyramid is not kept, since its first level 
+	# is only valid until the image is released.
+	def getPyramid(self, key, tile_size=512, img=None):
+		if key in self.pyramids:
+			return self.pyramids[key]
+
+		if key not in self.images:
+			return ImagePyramid(
+				img, tile_size, self._pyramidCachePath(key, tile_size)
+			)
+
+		self.pyramids[key] = ImagePyramid(
+			self.images[key],
+			tile_size,
+			self._pyramidCachePath(key, tile_size)
 		)
-		thumbnail = np.fliplr(np.rot90(np.rot90(thumbnail)))
 
-		thumbnail = memoryview(thumbnail.flatten())
+		return self.pyramids[key]
+
+	# Returns the DisplayWindow for an entry. The histogram is only computed
+	# the first time, from the array the image was acquired with.
+	def getDisplayWindow(self, key, img):
+		if key not in self.display_windows:
+			self.display_windows[key] = DisplayWindow.fromImage(img)
+
+		return self.display_windows[key]
 
-		return thumbnail
+	# The modification time and size of the file are part of the path, so
+	# levels built from an older version of an image are never used.
+	def _pyramidCachePath(self, key, tile_size):
+		stamp = DatasetCache.fileStamp(os.path.join(self.root_path, key))
+		return self.cache.pyramidPath(key, stamp, tile_size)
+
+	# Changes the class of every contour in the dataset. See 
+	# ContourSet.remapClasses for the meaning of lut. Class indices that are
+	# past the end of lut are left alone. Returns the number of contours that
+	# were removed.
+	def remapClasses(self, lut):
+		entries   = self.meta_structure['entries']
+		n_classes = max(
+			[len(lut)] + [int(v.class_idx.max(initial=-1)) + 1 for v in entries.values()]
+		)
+
+		full_lut = np.arange(n_classes, dtype=np.int64)
+		full_lut[:len(lut)] = lut
+
+		n_removed = 0
+		for key, contours in entries.items():
+			if len(contours) > 0:
+				n_removed += contours.remapClasses(full_lut)
+				self.index.updateEntry(key, contours)
+
+		return n_removed
+
+	# Writes the meta structure back to meta.json (or the specified path),
+	# converting every entry back into the json schema.
+	@traced('Dataset.saveMetaFile')
+	def saveMetaFile(self, path=None):
+		if path is None:
+			path = self.meta_path
+
+		structure            = dict(self.meta_structure)
+		structure['entries'] = {
+			k: v.toEntry() for k, v in self.meta_structure['entries'].items()
+		}
+
+		# The file is written next to the original and then moved over it,
+		# so that an interrupted save never leaves a truncated meta.json.
+		tmp_path = path + '.%d.tmp'%os.getpid()
+		with open(tmp_path, 'w') as file:
+			file.write(json.dumps(structure))
+		os.replace(tmp_path, path)
 
 	def _loadMetaFile(self, path):
 		with open(path, 'r') as file:
-			self.meta_structure = json.loads(file.read())
\ No newline at end of file
+			self.meta_structure = json.loads(file.read())
+
+		for k, v in self.meta_structure['entries'].items():
+			self.meta_structure['entries'][k] = ContourSet.fromEntry(v)
+
+# Returns the thumbnail size that the editor uses when its preview pane is
+# the given width (see PreviewPane.getCorrectImageWidth). The images are
+# assumed to be 16:9, which is the most common format.
+def thumbnailSizeForWidth(preview_width):
+	thumbnail_width = int(preview_width - 22)
+	return [thumbnail_width, int((9 / 16) * thumbnail_width)]
+
+# Resizes an image to the thumbnail size and lays it out the way opengl 
+# expects. This is a function, rather than a method, so that the decode 
+# worker processes can use it without a Dataset. Images that aren't 8 bit 
+# are displayed with the default window for the thumbnail.
+def setupThumbnailBuffer(img, thumbnail_size):
+	thumbnail = cv2.resize(
+		img, 
+		tuple(thumbnail_size), 
+		interpolation=cv2.INTER_NEAREST
+	)
+	if thumbnail.dtype != np.uint8:
+		thumbnail = DisplayWindow.fromImage(thumbnail).apply(thumbnail)
+	thumbnail = np.fliplr(np.rot90(np.rot90(thumbnail)))
+
+	return thumbnail.flatten()
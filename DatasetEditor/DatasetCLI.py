@@ -0,0 +1,646 @@
+# Author:      Adam Robinson
+# Description: This file is a command line entry point for the batch tasks
+#              that can be performed on a dataset without the editor. It
+#              never imports kivy, so it can be run on machines without a
+#              display. Run it with --help for a list of commands. Every
+#              command can print its results as json (--json) for use in
+#              pipelines.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+# Everything else is imported by the commands that need it, so that the
+# program starts quickly.
+
+# Returns the keys of every image in a dataset, in the order the editor
+# loads them in (entries in meta.json first, followed by any other images).
+# Each page of a multi-page tiff has its own key (see Dataset.pageKeys).
+def _datasetKeys(dataset):
+	from Dataset     import image_extensions
+	from ImageHeader import splitPage
+
+	path    = dataset.root_path
+	entries = dataset.meta_structure['entries']
+	keys    = [
+		k for k in entries 
+		if os.path.isfile(splitPage(os.path.join(path, k))[0])
+	]
+
+	for f in sorted(os.listdir(path)):
+		if f.split('.')[-1] in image_extensions:
+			if os.path.isfile(os.path.join(path, f)):
+				keys.extend(k for k in dataset.pageKeys(f) if k not in entries)
+
+	return keys
+
+# Checks a dataset for problems. Errors are problems that will prevent the
+# dataset from being loaded or used. Warnings are things that are probably
+# mistakes. If decode is True, every image is also decoded to make sure it
+# isn't corrupt.
+def validateDataset(path, decode=False):
+	import numpy as np
+
+	from Dataset       import Dataset, image_extensions
+	from ImageDecoders import decodeImage
+
+	errors   = []
+	warnings = []
+
+	try:
+		dataset = Dataset().loadMetadata(path)
+	except Exception as ex:
+		return {
+			'valid'    : False,
+			'errors'   : ['Could not read meta.json: %s'%ex],
+			'warnings' : []
+		}
+
+	classes   = dataset.meta_structure['classes']
+	entries   = dataset.meta_structure['entries']
+	n_classes = len(classes)
+
+	files = set()
+	for f in os.listdir(path):
+		if f.split('.')[-1] in image_extensions:
+			if os.path.isfile(os.path.join(path, f)):
+				files.update(dataset.pageKeys(f))
+
+	for key, contours in entries.items():
+		if key not in files:
+			errors.append("File '%s' is missing from the directory"%key)
+			continue
+
+		if len(contours) > 0:
+			bad_class = (contours.class_idx < 0) | (contours.class_idx >= n_classes)
+			for idx in np.nonzero(bad_class)[0]:
+				errors.append(
+					"Contour %d of '%s' has an invalid class index (%d)"%(
+						idx, key, contours.class_idx[idx]
+					)
+				)
+
+			for idx in np.nonzero(contours.lengths() < 3)[0]:
+				warnings.append(
+					"Contour %d of '%s' has fewer than 3 points"%(idx, key)
+				)
+
+			outside = (contours.vertices < 0) | (contours.vertices > 1)
+			if outside.any():
+				warnings.append(
+					"'%s' has contours with points outside of the image"%key
+				)
+
+		if decode:
+			img = decodeImage(os.path.join(path, key))
+			if img is None:
+				errors.append("File '%s' could not be decoded"%key)
+
+	for key in sorted(files - set(entries.keys())):
+		warnings.append("File '%s' has no entry in meta.json"%key)
+
+	return {
+		'valid'     : len(errors) == 0,
+		'n_entries' : len(entries),
+		'n_files'   : len(files),
+		'errors'    : errors,
+		'warnings'  : warnings
+	}
+
+def _validate(args):
+	report = validateDataset(args.dataset, args.decode)
+
+	if not args.json:
+		for error in report['errors']:
+			print('error: %s'%error)
+		for warning in report['warnings']:
+			print('warning: %s'%warning)
+		print('%s is %s'%(args.dataset, 'valid' if report['valid'] else 'invalid'))
+
+	return report, 0 if report['valid'] else 1
+
+def _stats(args):
+	from Dataset           import Dataset
+	from DatasetStatistics import DatasetStatistics
+
+	dataset    = Dataset().loadMetadata(args.dataset)
+	statistics = DatasetStatistics(dataset, pixel_units=not args.relative)
+
+	if args.csv is not None:
+		statistics.writeCSV(args.csv)
+
+	summary = statistics.summary()
+
+	if not args.json:
+		for unreadable in summary['unreadable']:
+			print("warning: '%s' could not be read, its contours were skipped: %s"%(
+				unreadable['key'], unreadable['error']
+			))
+		print('%d images (%d labeled), %d contours, %d vertices'%(
+			summary['n_images'], summary['n_labeled_images'],
+			summary['n_contours'], summary['n_vertices']
+		))
+		for _class in summary['classes']:
+			print('    %-20s %8d contours in %6d images, mean area %1.2f'%(
+				_class['name'], _class['count'],
+				_class['images'], _class['mean_area']
+			))
+
+	return summary, 0
+
+# Renames, merges or deletes classes across a whole dataset (see
+# ClassOperations.py) and saves meta.json. Nothing is changed if a name
+# doesn't match exactly one class.
+def _editClasses(args):
+	import ClassOperations
+
+	from Dataset import Dataset
+
+	dataset = Dataset().loadMetadata(args.dataset)
+
+	try:
+		if args.command == 'rename-class':
+			ClassOperations.renameClass(dataset, args.old_name, args.new_name)
+			n_deleted = 0
+		elif args.command == 'merge-classes':
+			n_deleted = ClassOperations.mergeClasses(
+				dataset, args.target, args.sources
+			)
+		else:
+			n_deleted = ClassOperations.deleteClasses(dataset, args.names)
+	except Exception as ex:
+		if not args.json:
+			print('error: %s'%ex)
+		return {'error': str(ex)}, 1
+
+	dataset.saveMetaFile()
+
+	classes = [c['name'] for c in dataset.meta_structure['classes']]
+	if not args.json:
+		print('Deleted %d contours, %d classes left'%(n_deleted, len(classes)))
+
+	return {'classes': classes, 'n_deleted': n_deleted}, 0
+
+# The file name of the mask of an entry. Every page of a multi-page tiff
+# gets its own mask, e.g. 'stack.tif#1' -> 'stack_p1.png'.
+def _maskName(key):
+	from ImageHeader import splitPage
+
+	path, page = splitPage(key)
+	name       = os.path.splitext(path)[0]
+	if page is not None:
+		name += '_p%d'%page
+
+	return name + '.png'
+
+def _exportMasks(args):
+	import cv2
+	import numpy as np
+
+	from Dataset        import Dataset
+	from Contour        import ContourSet
+	from MaskRasterizer import classMask
+
+	dataset = Dataset().loadMetadata(args.dataset)
+	entries = dataset.meta_structure['entries']
+
+	os.makedirs(args.output, exist_ok=True)
+
+	written = []
+	for key in _datasetKeys(dataset):
+		contours = entries.get(key, ContourSet())
+		if len(contours) == 0 and not args.include_empty:
+			continue
+
+		height, width = dataset.getImageShape(key)[:2]
+		mask = classMask(contours, width, height, dtype=np.uint16)
+
+		out_path = os.path.join(args.output, _maskName(key))
+		cv2.imwrite(out_path, mask)
+		written.append(out_path)
+
+	if not args.json:
+		print('Wrote %d masks to %s'%(len(written), args.output))
+
+	return {'n_masks': len(written), 'masks': written}, 0
+
+def _exportPatches(args):
+	from Dataset       import Dataset
+	from PatchExporter import exportPatches
+
+	dataset = Dataset().loadMetadata(args.dataset)
+	keys    = _datasetKeys(dataset) if args.include_empty else None
+
+	def progress(n_done, n_images):
+		if not args.json:
+			print('\r%d / %d'%(n_done, n_images), end='', flush=True)
+
+	index = exportPatches(
+		dataset, args.output, args.size, args.stride, args.min_foreground,
+		args.shard_size, args.processes, keys, progress
+	)
+
+	if not args.json:
+		print()
+		for failure in index['failed']:
+			print('error: %s'%failure['error'])
+		print('Wrote %d patches from %d images in %d shards to %s'%(
+			index['n_patches'], index['n_images'], len(index['shards']),
+			args.output
+		))
+
+	return {
+		'n_images'  : index['n_images'],
+		'n_patches' : index['n_patches'],
+		'n_shards'  : len(index['shards']),
+		'failed'    : index['failed']
+	}, 0 if len(index['failed']) == 0 else 1
+
+def _exportCOCO(args):
+	from Dataset      import Dataset
+	from CocoExporter import exportCOCO
+
+	dataset = Dataset().loadMetadata(args.dataset)
+	keys    = _datasetKeys(dataset) if args.include_empty else None
+
+	def progress(n_done, n_images):
+		if not args.json:
+			print('\r%d / %d'%(n_done, n_images), end='', flush=True)
+
+	result = exportCOCO(
+		dataset, args.output, args.rle, args.processes, keys, progress
+	)
+
+	if not args.json:
+		print()
+		for failure in result['failed']:
+			print('error: %s'%failure['error'])
+		print('Wrote %d annotations for %d images to %s'%(
+			result['n_annotations'], result['n_images'], args.output
+		))
+
+	return result, 0 if len(result['failed']) == 0 else 1
+
+# Builds the pyramids of the images that the editor displays with tiles.
+# Other images are skipped without being decoded.
+def _buildCaches(args):
+	from Dataset      import Dataset
+	from ImagePyramid import needsTiles
+
+	dataset = Dataset().loadMetadata(args.dataset)
+	keys    = _datasetKeys(dataset)
+	built   = 0
+
+	for i, key in enumerate(keys):
+		if needsTiles(dataset.getImageShape(key), args.max_texture_size):
+			lease = dataset.acquireImage(key)
+			try:
+				dataset.getPyramid(key, args.tile_size, lease.array).buildAll()
+			finally:
+				lease.release()
+			built += 1
+
+		if not args.json:
+			print('\r%d / %d'%(i + 1, len(keys)), end='', flush=True)
+
+	if not args.json:
+		print()
+
+	return {
+		'n_images'   : len(keys),
+		'n_pyramids' : built,
+		'cache_path' : dataset.cache_path
+	}, 0
+
+# Only one thread per process, since there is already a process per core.
+def _initWarmWorker():
+	import cv2
+	cv2.setNumThreads(1)
+
+# Precomputes the thumbnails, image shapes and (optionally) pyramids that
+# the editor would otherwise compute when a dataset is first opened. Images
+# whose cache entries are already up to date are skipped, so this can be
+# re-run as often as needed.
+def _warmCache(args):
+	from concurrent.futures import ProcessPoolExecutor, as_completed
+
+	from Dataset      import Dataset, thumbnailSizeForWidth
+	from DatasetCache import DatasetCache, warmImage
+	from ImagePyramid import ImagePyramid, needsTiles
+
+	thumbnail_size = thumbnailSizeForWidth(args.preview_width)
+	tile_size      = args.tile_size if args.pyramids else None
+	results        = []
+
+	with ProcessPoolExecutor(args.processes, initializer=_initWarmWorker) as pool:
+		for path in args.datasets:
+			dataset = Dataset().loadMetadata(path)
+			cache   = dataset.cache
+			keys    = _datasetKeys(dataset)
+			futures = {}
+
+			for key in keys:
+				img_path = os.path.join(path, key)
+				stamp    = DatasetCache.fileStamp(img_path)
+				shape    = cache.getShape(key, stamp)
+
+				thumbnail_path = cache.thumbnailPath(key, stamp, thumbnail_size)
+				if os.path.isfile(thumbnail_path) and shape is not None:
+					thumbnail_path = None
+
+				pyramid_path = None
+				if tile_size is not None:
+					pyramid_path = cache.pyramidPath(key, stamp, tile_size)
+					if shape is not None:
+						if not needsTiles(shape, args.max_texture_size):
+							pyramid_path = None
+						elif ImagePyramid.isCached(shape, tile_size, pyramid_path):
+							pyramid_path = None
+
+				if thumbnail_path is None and pyramid_path is None:
+					continue
+
+				future = pool.submit(
+					warmImage, img_path, thumbnail_size, thumbnail_path,
+					tile_size, pyramid_path, args.max_texture_size
+				)
+				futures[future] = (key, stamp)
+
+			failed = []
+			for i, future in enumerate(as_completed(futures)):
+				key, stamp = futures[future]
+
+				# One corrupt image or failed write shouldn't stop the rest
+				# of the run.
+				try:
+					shape = future.result()
+					if shape is None:
+						raise Exception(
+							"Could not load file \'%s\'"%os.path.join(path, key)
+						)
+				except Exception as ex:
+					failed.append({'key': key, 'error': str(ex)})
+					shape = None
+
+				if shape is not None:
+					cache.putShape(key, stamp, shape)
+
+				# Save the headers every so often, so that an interrupted run
+				# doesn't lose all of its progress.
+				if (i + 1) % 1000 == 0:
+					cache.save()
+
+				if not args.json:
+					print('\r%s: %d / %d'%(path, i + 1, len(futures)), end='', flush=True)
+
+			cache.save()
+
+			if not args.json and len(futures) > 0:
+				print()
+
+			results.append({
+				'dataset'   : path,
+				'n_images'  : len(keys),
+				'n_warmed'  : len(futures) - len(failed),
+				'n_skipped' : len(keys) - len(futures),
+				'failed'    : failed
+			})
+
+			if not args.json:
+				for failure in failed:
+					print('error: %s'%failure['error'])
+				print('%s: %d images, %d warmed, %d already cached, %d failed'%(
+					path, len(keys), len(futures) - len(failed),
+					len(keys) - len(futures), len(failed)
+				))
+
+	code = 0 if all(len(r['failed']) == 0 for r in results) else 1
+	return {'thumbnail_size': thumbnail_size, 'datasets': results}, code
+
+# Checks the output of every installed decoder (see ImageDecoders.py)
+# against cv2, on the given images or on a sample of the images in the given
+# datasets.
+def _verifyDecoders(args):
+	from Dataset       import image_extensions
+	from ImageDecoders import verifyDecoders, decodersFor
+
+	paths = []
+	for path in args.paths:
+		if not os.path.isdir(path):
+			paths.append(path)
+			continue
+
+		# A few images of each extension.
+		counts = {}
+		for f in sorted(os.listdir(path)):
+			ext = f.split('.')[-1]
+			if ext in image_extensions and counts.get(ext, 0) < args.samples:
+				counts[ext] = counts.get(ext, 0) + 1
+				paths.append(os.path.join(path, f))
+
+	results = verifyDecoders(paths, args.jpeg_tolerance)
+	failed  = [r for r in results if not r['passed']]
+
+	decoders = {}
+	for ext in sorted(set(p.split('.')[-1].lower() for p in paths)):
+		decoders[ext] = [d.name for d in decodersFor(ext)]
+
+	if not args.json:
+		for ext, names in decoders.items():
+			print('%-5s %s'%(ext, ', '.join(names)))
+		for result in failed:
+			print('FAILED: %s with %s at scale %s: %s'%(
+				result['path'], result['decoder'], result['scale'],
+				result['error'] or 'mean difference %1.2f, max %1.2f'%(
+					result.get('mean_difference', 0),
+					result.get('max_difference', 0)
+				)
+			))
+		print('%d checks, %d failed'%(len(results), len(failed)))
+
+	return {
+		'decoders' : decoders,
+		'n_checks' : len(results),
+		'failed'   : failed
+	}, 0 if len(failed) == 0 else 1
+
+def main(argv):
+	from ImagePyramid import default_max_texture_size
+
+	parser = argparse.ArgumentParser(
+		description='Batch tasks for SegmentationKit datasets.'
+	)
+	parser.add_argument(
+		'--json', action='store_true',
+		help='Print the results as json.'
+	)
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	validate = commands.add_parser('validate', help='Check a dataset for problems.')
+	validate.add_argument('dataset')
+	validate.add_argument(
+		'--decode', action='store_true',
+		help='Decode every image to make sure none are corrupt.'
+	)
+	validate.set_defaults(function=_validate)
+
+	stats = commands.add_parser('stats', help='Compute contour statistics.')
+	stats.add_argument('dataset')
+	stats.add_argument('--csv', help='Also write one row per contour to this file.')
+	stats.add_argument(
+		'--relative', action='store_true',
+		help='Report sizes relative to the image instead of in pixels.'
+	)
+	stats.set_defaults(function=_stats)
+
+	rename = commands.add_parser('rename-class', help='Rename a class.')
+	rename.add_argument('dataset')
+	rename.add_argument('old_name')
+	rename.add_argument('new_name')
+	rename.set_defaults(function=_editClasses)
+
+	merge = commands.add_parser(
+		'merge-classes', help='Move the contours of classes into another class.'
+	)
+	merge.add_argument('dataset')
+	merge.add_argument('target')
+	merge.add_argument('sources', nargs='+')
+	merge.set_defaults(function=_editClasses)
+
+	delete = commands.add_parser(
+		'delete-classes', help='Delete classes along with their contours.'
+	)
+	delete.add_argument('dataset')
+	delete.add_argument('names', nargs='+')
+	delete.set_defaults(function=_editClasses)
+
+	export = commands.add_parser(
+		'export-masks', help='Write a 16 bit class mask for every image.'
+	)
+	export.add_argument('dataset')
+	export.add_argument('output')
+	export.add_argument(
+		'--include-empty', action='store_true',
+		help='Also write masks for images without any contours.'
+	)
+	export.set_defaults(function=_exportMasks)
+
+	patches = commands.add_parser(
+		'export-patches',
+		help='Cut the images into fixed size patches and masks for training.'
+	)
+	patches.add_argument('dataset')
+	patches.add_argument('output')
+	patches.add_argument('--size', type=int, default=256)
+	patches.add_argument(
+		'--stride', type=int, default=None,
+		help='The distance between patches. Defaults to the patch size.'
+	)
+	patches.add_argument(
+		'--min-foreground', type=float, default=0.0,
+		help='Skip patches with less than this fraction covered by contours.'
+	)
+	patches.add_argument(
+		'--shard-size', type=int, default=1024,
+		help='The number of patches in each shard file.'
+	)
+	patches.add_argument(
+		'--include-empty', action='store_true',
+		help='Also cut patches from images without an entry in meta.json.'
+	)
+	patches.add_argument(
+		'--processes', type=int, default=os.cpu_count(),
+		help='The number of worker processes to use.'
+	)
+	patches.set_defaults(function=_exportPatches)
+
+	coco = commands.add_parser(
+		'export-coco', help='Write the contours as COCO style json.'
+	)
+	coco.add_argument('dataset')
+	coco.add_argument('output')
+	coco.add_argument(
+		'--rle', action='store_true',
+		help='Run length encode the masks instead of writing polygons.'
+	)
+	coco.add_argument(
+		'--include-empty', action='store_true',
+		help='Also list images without an entry in meta.json.'
+	)
+	coco.add_argument(
+		'--processes', type=int, default=os.cpu_count(),
+		help='The number of worker processes to use.'
+	)
+	coco.set_defaults(function=_exportCOCO)
+
+	caches = commands.add_parser(
+		'build-caches', help='Build the image pyramids used by the editor.'
+	)
+	caches.add_argument('dataset')
+	caches.add_argument('--tile-size', type=int, default=512)
+	caches.add_argument(
+		'--max-texture-size', type=int, default=default_max_texture_size,
+		help='Images larger than this are displayed with tiles.'
+	)
+	caches.set_defaults(function=_buildCaches)
+
+	warm = commands.add_parser(
+		'warm-cache',
+		help='Precompute the thumbnails and image headers the editor needs.'
+	)
+	warm.add_argument('datasets', nargs='+')
+	warm.add_argument(
+		'--preview-width', type=int, default=200,
+		help='The width of the preview pane in the editor.'
+	)
+	warm.add_argument(
+		'--pyramids', action='store_true',
+		help='Also build the image pyramids.'
+	)
+	warm.add_argument('--tile-size', type=int, default=512)
+	warm.add_argument(
+		'--max-texture-size', type=int, default=default_max_texture_size,
+		help='Only images larger than this get pyramids.'
+	)
+	warm.add_argument(
+		'--processes', type=int, default=os.cpu_count(),
+		help='The number of worker processes to use.'
+	)
+	warm.set_defaults(function=_warmCache)
+
+	verify = commands.add_parser(
+		'verify-decoders',
+		help='Check the installed image decoders against cv2.'
+	)
+	verify.add_argument(
+		'paths', nargs='+',
+		help='Images, or datasets to take a sample of images from.'
+	)
+	verify.add_argument(
+		'--samples', type=int, default=5,
+		help='The number of images of each type to take from a dataset.'
+	)
+	verify.add_argument(
+		'--jpeg-tolerance', type=float, default=4.0,
+		help='The mean difference from cv2 allowed for jpeg images.'
+	)
+	verify.set_defaults(function=_verifyDecoders)
+
+	args  = parser.parse_args(argv)
+	start = time.perf_counter()
+
+	result, code = args.function(args)
+
+	if args.json:
+		print(json.dumps({
+			'command' : args.command,
+			'seconds' : time.perf_counter() - start,
+			'result'  : result
+		}))
+
+	return code
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,201 @@
+# Author:      Adam Robinson
+# Description: This class manages the files in a dataset's cache directory
+#              (.cache). Anything stored here can be regenerated from the
+#              images, so it is always safe to delete. Cached data is keyed
+#              by the size and modification time of the image it came from,
+#              so nothing is ever used after the image has changed.
+
+import os
+import json
+import numpy as np
+
+from ImageHeader import splitPage
+
+# The layout of the cache directory is:
+#
+#   headers.json                       - key -> size, mtime and shape, or 
+#                                        file -> size, mtime and the shape
+#                                        of each page for multi-page tiffs
+#   thumbnails/<w>x<h>/<key>_<size>_<mtime>.npy
+#   pyramids/<key>_<size>_<mtime>_<tile size>/level_<n>.npy
+#
+# Every file is written to a temporary file and moved into place, so that
+# the editor and the warm up command (see DatasetCLI.py) can safely use the
+# same cache at the same time.
+#
+# The cache is optional. If it can't be written (e.g. the dataset is on a
+# read-only or shared drive), nothing more is written to it and datasets
+# are loaded without it.
+class DatasetCache:
+	def __init__(self, cache_path):
+		self.cache_path   = cache_path
+		self.headers_path = os.path.join(cache_path, 'headers.json')
+
+		self.headers = {}
+		if os.path.isfile(self.headers_path):
+			try:
+				with open(self.headers_path, 'r') as file:
+					self.headers = json.loads(file.read())
+			except Exception:
+				# A corrupt header cache just means that the headers will be
+				# read from the images again.
+				self.headers = {}
+
+		self.modified = False
+		self.writable = True
+
+	# The (size, mtime) of an image file. This is what identifies a version
+	# of an image in the cache. The pages of a multi-page tiff all have the
+	# stamp of the file.
+	@staticmethod
+	def fileStamp(img_path):
+		stat = os.stat(splitPage(img_path)[0])
+		return (stat.st_size, int(stat.st_mtime))
+
+	# Returns the cached (height, width, channels) of an image, or None if it
+	# isn't cached for this version of the file.
+	def getShape(self, key, stamp):
+		header = self.headers.get(key)
+		if header is None or (header['size'], header['mtime']) != tuple(stamp):
+			return None
+
+		if 'shape' not in header:
+			return None
+
+		return tuple(header['shape'])
+
+	def putShape(self, key, stamp, shape):
+		self._header(key, stamp)['shape'] = [int(s) for s in shape]
+		self.modified = True
+
+	# Returns the cached [(height, width)] of every page of a tiff file, or
+	# None if the file hasn't been indexed since it last changed.
+	def getPages(self, file, stamp):
+		header = self.headers.get(file)
+		if header is None or (header['size'], header['mtime']) != tuple(stamp):
+			return None
+
+		if 'pages' not in header:
+			return None
+
+		return [tuple(p) for p in header['pages']]
+
+	def putPages(self, file, stamp, pages):
+		self._header(file, stamp)['pages'] = [[int(h), int(w)] for h, w in pages]
+		self.modified = True
+
+	# Returns the header for key, replacing it if it belongs to an older
+	# version of the file.
+	def _header(self, key, stamp):
+		header = self.headers.get(key)
+		if header is None or (header['size'], header['mtime']) != tuple(stamp):
+			header = {'size': stamp[0], 'mtime': stamp[1]}
+			self.headers[key] = header
+
+		return header
+
+	def thumbnailPath(self, key, stamp, thumbnail_size):
+		return os.path.join(
+			self.cache_path,
+			'thumbnails',
+			'%dx%d'%tuple(thumbnail_size),
+			'%s_%d_%d.npy'%(key, stamp[0], stamp[1])
+		)
+
+	def pyramidPath(self, key, stamp, tile_size):
+		name = '%s_%d_%d_%d'%(key, stamp[0], stamp[1], tile_size)
+		return os.path.join(self.cache_path, 'pyramids', name)
+
+	# Returns the cached thumbnail buffer (see Dataset.setupThumbnailBuffer)
+	# for an image, or None if it isn't cached.
+	def loadThumbnail(self, key, stamp, thumbnail_size):
+		path = self.thumbnailPath(key, stamp, thumbnail_size)
+		if not os.path.isfile(path):
+			return None
+
+		try:
+			return np.load(path)
+		except Exception:
+			return None
+
+	def saveThumbnail(self, key, stamp, thumbnail_size, thumbnail):
+		if not self.writable:
+			return
+
+		try:
+			_saveArray(self.thumbnailPath(key, stamp, thumbnail_size), thumbnail)
+		except OSError:
+			self.writable = False
+
+	# Writes the headers back to disk, if any have changed. Headers that
+	# were written by another process since this one was loaded are kept.
+	def save(self):
+		if not self.modified or not self.writable:
+			return
+
+		headers = {}
+		if os.path.isfile(self.headers_path):
+			try:
+				with open(self.headers_path, 'r') as file:
+					headers = json.loads(file.read())
+			except Exception:
+				headers = {}
+		headers.update(self.headers)
+
+		try:
+			os.makedirs(self.cache_path, exist_ok=True)
+			tmp_path = self.headers_path + '.%d.tmp'%os.getpid()
+			with open(tmp_path, 'w') as file:
+				file.write(json.dumps(headers))
+			os.replace(tmp_path, self.headers_path)
+		except OSError:
+			self.writable = False
+			return
+
+		self.headers  = headers
+		self.modified = False
+
+def _saveArray(path, arr):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp_path = path + '.%d.tmp'%os.getpid()
+	with open(tmp_path, 'wb') as file:
+		np.save(file, arr)
+	os.replace(tmp_path, path)
+
+# Decodes an image once and writes whichever of its thumbnail and pyramid
+# levels are requested (a path of None skips that part). The pyramid is only
+# built if the editor would display the image with tiles (see
+# ImagePyramid.needsTiles). Returns the shape of the image, or None if it
+# couldn't be decoded. This is run in worker processes by the warm-cache
+# command in DatasetCLI.py.
+def warmImage(img_path, thumbnail_size, thumbnail_path, tile_size, pyramid_path,
+	          max_texture_size):
+	from Dataset       import setupThumbnailBuffer
+	from ImagePyramid  import ImagePyramid, needsTiles
+	from ImageDecoders import decodeImage, decodeThumbnail, readImageShape
+
+	# Most images are too small to need a pyramid, which the header alone is
+	# usually enough to tell.
+	if pyramid_path is not None:
+		shape = readImageShape(img_path)
+		if shape is not None and not needsTiles(shape, max_texture_size):
+			pyramid_path = None
+
+	# The pyramid needs the full image. The thumbnail alone can come from a
+	# reduced decode.
+	if pyramid_path is None:
+		img, shape = decodeThumbnail(img_path, thumbnail_size)
+	else:
+		img   = decodeImage(img_path)
+		shape = None if img is None else img.shape
+
+	if img is None:
+		return None
+
+	if thumbnail_path is not None:
+		_saveArray(thumbnail_path, setupThumbnailBuffer(img, thumbnail_size))
+
+	if pyramid_path is not None and needsTiles(shape, max_texture_size):
+		ImagePyramid(img, tile_size, pyramid_path).buildAll()
+
+	return shape
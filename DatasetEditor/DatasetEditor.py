@@ -3,32 +3,78 @@
 #              interface components. More complicated interface components
 #              are contained in other files.
 
+# This is taken before anything else is imported, so that the startup 
+# report (see StartupTimer) includes the time spent importing.
+import time
+_start_time = time.perf_counter()
+
 from kivy.app             import App
 from kivy.uix.boxlayout   import BoxLayout
-from kivy.uix.slider      import Slider
-from kivy.uix.widget      import Widget
-from kivy.graphics        import Rectangle, Color, Line
 from kivy.uix.button      import Button
-from kivy.uix.splitter    import Splitter
 from kivy.uix.label       import Label
-from kivy.uix.filechooser import FileChooserListView
-from kivy.uix.popup       import Popup
 from kivy.uix.progressbar import ProgressBar
+from kivy.uix.slider      import Slider
 from kivy.config          import Config
 from kivy.clock           import Clock
-from kivy.utils           import get_color_from_hex as hex_color
+from kivy.core.window     import Window, Keyboard
 
-import code
 import os
+import json
+import math
 import threading
 
 from CustomBoxLayout  import CustomBoxLayout
-from FileChooserPopup import FileChooserPopup
-from Dataset          import Dataset
 from PreviewPane      import PreviewPane
 from ImageDisplay     import ImageDisplay
 from ClassSummary     import ClassSummary
 
+import Tracing
+
+# FileChooserPopup and Dataset are imported when they are first needed, 
+# since neither is used until the user loads a dataset. DecodeWorker is
+# imported once the first frame has been drawn, and PerformanceHUD the 
+# first time it is shown.
+
+_import_time = time.perf_counter()
+
+# ---------------------------------------------------------
+# Startup Timing
+# ---------------------------------------------------------
+
+# Records how long each phase of startup takes, so that the time it takes
+# for the window to become usable can be kept to a budget. The report is
+# printed once the first frame has been drawn. If the 
+# DATASET_EDITOR_STARTUP_REPORT environment variable is set, the report is
+# also written to that path as json.
+class StartupTimer:
+	def __init__(self, start_time):
+		self.start_time = start_time
+		self.last_time  = start_time
+		self.phases     = []
+
+	# Ends the current phase, giving it the specified name.
+	def mark(self, name, now=None):
+		if now is None:
+			now = time.perf_counter()
+
+		self.phases.append((name, now - self.last_time))
+		self.last_time = now
+
+	def report(self):
+		total = self.last_time - self.start_time
+		lines = ['Startup took %1.3fs'%total]
+		for name, duration in self.phases:
+			lines.append('    %-12s %1.3fs'%(name, duration))
+		print('\n'.join(lines))
+
+		report_path = os.environ.get('DATASET_EDITOR_STARTUP_REPORT')
+		if report_path is not None:
+			with open(report_path, 'w') as file:
+				file.write(json.dumps({
+					'total'  : total,
+					'phases' : {name: duration for name, duration in self.phases}
+				}))
+
 # ---------------------------------------------------------
 # Simple Interface Components
 # ---------------------------------------------------------
@@ -58,27 +104,41 @@ class TopMenu(CustomBoxLayout):
 
 		# TODO: Encapsulate this kind of functionality in a reusable class.
 		def load_files(path):
-			thumbnail_width = self._parent_obj.interface.preview_pane.getCorrectImageWidth()
+			from Dataset import thumbnailSizeForWidth
 
-			# Assume the images are 16:9, which is the most common format.
 			# We need to resize them so their width matches the preview
-			# pane width.
-			thumbnail_size    = [int(thumbnail_width), 0]
-			thumbnail_size[1] = int((9 / 16) * thumbnail_size[0])
+			# pane width. The warm-cache command in DatasetCLI.py uses the
+			# same function, so that the thumbnails it caches are used here.
+			thumbnail_size = thumbnailSizeForWidth(
+				self._parent_obj.interface.preview_pane.width
+			)
 
 			self.load_progress.opacity = 1
 
 			def _inner_load(path):
+				from Dataset import Dataset
 
 				def progress_callback(n):
 					self.current_progress = int(n * 100)
 
-				dataset = Dataset().loadDirectory(
-					path, 
-					thumbnail_size, 
-					progress_callback
-				)
+				# A dataset that would go over the memory budget fails to 
+				# load, with a message saying why.
+				try:
+					dataset = Dataset(
+						decode_worker=self._parent_obj.decode_worker,
+						memory_budget=self._parent_obj.memory_budget
+					).loadDirectory(
+						path, 
+						thumbnail_size, 
+						progress_callback
+					)
+				except Exception as ex:
+					self.load_error = str(ex)
+					return
+
 				self._parent_obj.dataset = dataset
+
+			self.load_error = None
 				
 			t = threading.Thread(target=_inner_load, args=(path,))
 			t.start()
@@ -88,17 +148,22 @@ class TopMenu(CustomBoxLayout):
 				if not t.is_alive():
 					Clock.unschedule(_check_process)
 					self.load_progress.opacity = 0
+
+					if self.load_error is not None:
+						self._showLoadError(self.load_error)
+						return
+
 					self._parent_obj.interface.preview_pane.loadThumbnails(
 						self._parent_obj.dataset
 					)
 
 			Clock.schedule_interval(_check_process, .025)
 
-			
-
-		self.load_popup = FileChooserPopup(
-			title='Load File', callback=load_files
-		)
+		# The popup is only created the first time it is opened, since it 
+		# starts listing the contents of the home directory as soon as it is
+		# created.
+		self.load_files = load_files
+		self.load_popup = None
 
 		self.add_widget(self.open_button)
 		self.add_widget(self.save_button)
@@ -109,25 +174,100 @@ class TopMenu(CustomBoxLayout):
 
 		
 
+	def _showLoadError(self, message):
+		from kivy.uix.popup import Popup
+
+		label = Label(text=message, halign='center', valign='middle')
+		label.bind(size=label.setter('text_size'))
+		Popup(
+			title='Could not load the dataset',
+			content=label,
+			size_hint=(0.5, 0.3)
+		).open()
+
 	def _open_pressed(self, instance):
+		if self.load_popup is None:
+			from FileChooserPopup import FileChooserPopup
+			self.load_popup = FileChooserPopup(
+				title='Load File', callback=self.load_files
+			)
+
 		self.load_popup.open()
 
+# Brightness and contrast controls for the image being displayed. Contrast
+# is on a log scale, so the middle of the slider leaves it unchanged.
+class DisplayToolbar(CustomBoxLayout):
+	def __init__(self, *args, **kwargs):
+		self.image_display = kwargs['image_display']
+		del kwargs['image_display']
+
+		super(DisplayToolbar, self).__init__(*args, **kwargs)
+
+		self.brightness_slider = Slider(min=-0.5, max=0.5, value=0.0)
+		self.contrast_slider   = Slider(min=-2.0, max=2.0, value=0.0)
+		self.default_button    = Button(
+			text='Default',
+			size_hint_x=None,
+			width=90
+		)
+
+		self.add_widget(Label(text='Brightness', size_hint_x=None, width=90))
+		self.add_widget(self.brightness_slider)
+		self.add_widget(Label(text='Contrast', size_hint_x=None, width=80))
+		self.add_widget(self.contrast_slider)
+		self.add_widget(self.default_button)
+
+		# A slider can move several times per frame, so the image is only
+		# updated once per frame.
+		self._apply_trigger = Clock.create_trigger(self._apply)
+		self.brightness_slider.bind(value=self._slider_moved)
+		self.contrast_slider.bind(value=self._slider_moved)
+		self.default_button.bind(on_press=self._default_pressed)
+
+		# Set when the sliders are moved to match a newly displayed image, so
+		# that doing so doesn't redraw it.
+		self.updating = False
+
+	# Moves the sliders to the adjustment of the image being displayed.
+	def showAdjustment(self, window):
+		self.updating = True
+		self.brightness_slider.value = window.brightness
+		self.contrast_slider.value   = math.log2(window.contrast)
+		self.updating = False
+
+	def _slider_moved(self, inst, value):
+		if not self.updating:
+			self._apply_trigger()
+
+	def _apply(self, dt):
+		self.image_display.setDisplayAdjustment(
+			self.brightness_slider.value,
+			2 ** self.contrast_slider.value
+		)
+
+	def _default_pressed(self, inst):
+		self.brightness_slider.value = 0.0
+		self.contrast_slider.value   = 0.0
+
 # This is the interface item that displays the image that is
 # being edited, as well as some of the editing controls.
 class Display(CustomBoxLayout):
 	def __init__(self, *args, **kwargs):
 		super(Display, self).__init__(*args, **kwargs)
 
-		self.image_display       = ImageDisplay(
+		self.image_display = ImageDisplay(
 			orientation='vertical'
 		)
-		self.toolbar_placeholder = Label(
-			text='Toolbar Placeholder',
+		self.toolbar       = DisplayToolbar(
+			orientation='horizontal',
 			size_hint_y=None,
-			height=50
+			height=50,
+			padding=[5, 5, 5, 5],
+			spacing=5,
+			image_display=self.image_display
 		)
 		self.add_widget(self.image_display)
-		self.add_widget(self.toolbar_placeholder)
+		self.add_widget(self.toolbar)
 
 
 		
@@ -173,7 +313,31 @@ class DatasetEditor(App):
 	def __init__(self, *args, **kwargs):
 		super(DatasetEditor, self).__init__(*args, **kwargs)
 
+		self.startup_timer = StartupTimer(_start_time)
+		self.startup_timer.mark('import', _import_time)
+
+		# DATASET_EDITOR_MEMORY_BUDGET limits the memory used by the dataset
+		# (in MB). See Dataset.memoryUsage.
+		self.memory_budget = None
+		if 'DATASET_EDITOR_MEMORY_BUDGET' in os.environ:
+			budget = float(os.environ['DATASET_EDITOR_MEMORY_BUDGET'])
+			self.memory_budget = int(budget * 1024 * 1024)
+
+		# If DATASET_EDITOR_TRACE is set, spans are recorded while the editor
+		# runs and written to that path as a Chrome trace when it exits (see
+		# Tracing.py).
+		self.trace_path = os.environ.get('DATASET_EDITOR_TRACE')
+		if self.trace_path is not None:
+			Tracing.enable()
+
 	def build(self):
+		self.startup_timer.mark('window')
+
+		# Images are decoded in a separate process so that loading a dataset
+		# doesn't make the interface stutter. The process is created after
+		# the first frame is drawn, so that it doesn't delay the window.
+		self.decode_worker = None
+
 		self.root      = BoxLayout(orientation='vertical')
 		self.top_menu  = TopMenu(
 			orientation='horizontal', 
@@ -191,8 +355,43 @@ class DatasetEditor(App):
 		self.root.add_widget(self.top_menu)
 		self.root.add_widget(self.interface)
 
+		# F3 shows frame times and memory usage over the interface.
+		self.hud = None
+		Window.bind(on_key_down=self._key_down)
+
+		self.startup_timer.mark('build')
+
 		return self.root
 
+	def on_start(self):
+		Clock.schedule_once(self._first_frame, 0)
+
+	def _first_frame(self, dt):
+		self.startup_timer.mark('first_frame')
+		self.startup_timer.report()
+
+		from DecodeWorker import DecodeWorker
+		self.decode_worker = DecodeWorker().start()
+
+	def _key_down(self, window, key, scancode, codepoint, modifiers):
+		if key == Keyboard.keycodes['f3']:
+			if self.hud is None:
+				from PerformanceHUD import PerformanceHUD
+				self.hud = PerformanceHUD(self.interface)
+
+			self.hud.toggle()
+			return True
+
+		return False
+
+	def on_stop(self):
+		if self.decode_worker is not None:
+			self.decode_worker.stop()
+
+		if self.trace_path is not None:
+			Tracing.writeChromeTrace(self.trace_path)
+			Tracing.printSummary()
+
 
 if __name__ == '__main__':
 	# This disables multitouch emulation.
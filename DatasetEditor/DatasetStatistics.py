@@ -0,0 +1,301 @@
+# Author:      Adam Robinson
+# Description: This file computes geometry and summary statistics for the
+#              contours in a dataset. Everything is computed with numpy on
+#              whole vertex arrays at once and cached per entry. It doesn't
+#              depend on kivy, so it can be used headlessly.
+
+import csv
+import json
+import numpy as np
+
+# The per contour columns produced by computeGeometry.
+geometry_columns = (
+	'n_vertices', 'area', 'perimeter',
+	'x_min', 'y_min', 'x_max', 'y_max',
+	'centroid_x', 'centroid_y'
+)
+
+# Computes the geometry of many polygons at once. vertices is a (V, 2)
+# array of relative coordinates and offsets is a (C + 1) array, where the
+# points of polygon i are vertices[offsets[i]:offsets[i + 1]] (the layout of
+# a ContourSet). sizes is a (C, 2) array with the (width, height) of the
+# image each polygon belongs to. If it is None, results are in relative
+# units. Coordinates in the results have their origin at the top left of
+# the image, like array indices.
+#
+# Returns a dictionary mapping each of geometry_columns to a (C,) array.
+# Polygons without any points have NaN for their bounding box and centroid.
+def computeGeometry(vertices, offsets, sizes=None):
+	offsets = np.asarray(offsets, dtype=np.int64)
+	lengths = np.diff(offsets)
+	n       = lengths.shape[0]
+	ids     = np.repeat(np.arange(n), lengths)
+
+	if sizes is not None:
+		sizes = np.asarray(sizes, dtype=np.float64)
+		x     = vertices[:, 0] * sizes[ids, 0]
+		y     = (1.0 - vertices[:, 1]) * sizes[ids, 1]
+	else:
+		x = vertices[:, 0].astype(np.float64)
+		y = 1.0 - vertices[:, 1]
+
+	# The index of the next point in the same polygon, wrapping the last
+	# point of each polygon around to its first.
+	nonempty = lengths > 0
+	starts   = offsets[:-1][nonempty]
+	nxt      = np.arange(x.shape[0]) + 1
+	nxt[offsets[1:][nonempty] - 1] = starts
+
+	x_next = x[nxt]
+	y_next = y[nxt]
+
+	# Shoelace formula, summed separately for each polygon.
+	cross       = x * y_next - x_next * y
+	signed_area = 0.5 * np.bincount(ids, cross, minlength=n)
+	perimeter   = np.bincount(
+		ids, np.hypot(x_next - x, y_next - y), minlength=n
+	)
+
+	results = {
+		'n_vertices' : lengths,
+		'area'       : np.abs(signed_area),
+		'perimeter'  : perimeter
+	}
+
+	for column in geometry_columns[3:]:
+		results[column] = np.full(n, np.nan)
+
+	if starts.shape[0] > 0:
+		results['x_min'][nonempty] = np.minimum.reduceat(x, starts)
+		results['y_min'][nonempty] = np.minimum.reduceat(y, starts)
+		results['x_max'][nonempty] = np.maximum.reduceat(x, starts)
+		results['y_max'][nonempty] = np.maximum.reduceat(y, starts)
+
+		# The area weighted centroid is undefined for degenerate polygons,
+		# the mean of the points is used for those instead.
+		with np.errstate(divide='ignore', invalid='ignore'):
+			cx = np.bincount(ids, (x + x_next) * cross, minlength=n) / (6 * signed_area)
+			cy = np.bincount(ids, (y + y_next) * cross, minlength=n) / (6 * signed_area)
+			mx = np.bincount(ids, x, minlength=n) / lengths
+			my = np.bincount(ids, y, minlength=n) / lengths
+
+		degenerate = signed_area == 0
+		cx[degenerate] = mx[degenerate]
+		cy[degenerate] = my[degenerate]
+
+		results['centroid_x'][nonempty] = cx[nonempty]
+		results['centroid_y'][nonempty] = cy[nonempty]
+
+	return results
+
+
+# Computes and caches statistics for every entry in a Dataset. An entry's
+# cached results are reused until its ContourSet is replaced or modified
+# (see ContourSet.version).
+class DatasetStatistics:
+	def __init__(self, dataset, pixel_units=True):
+		self.dataset     = dataset
+		self.pixel_units = pixel_units
+
+		# key -> (contour set, version, geometry)
+		self.cache = {}
+
+		# key -> error, for entries with contours whose image couldn't be
+		# read to get its size. Their contours are left out of the results.
+		self.unreadable = {}
+
+	# Drops the cached results for one entry, or for every entry.
+	def invalidate(self, key=None):
+		if key is None:
+			self.cache      = {}
+			self.unreadable = {}
+		else:
+			self.cache.pop(key, None)
+			self.unreadable.pop(key, None)
+
+	# Returns the geometry (see computeGeometry) of every contour in the
+	# given entry, along with its class index.
+	def entryStatistics(self, key):
+		self._update([key])
+		return self.cache[key][2]
+
+	# Returns one table covering every contour in the dataset. The result
+	# maps column names to arrays (or lists, for the key column) of equal
+	# length.
+	def contourTable(self):
+		keys = list(self.dataset.meta_structure['entries'].keys())
+		self._update(keys)
+
+		tables = [self.cache[k][2] for k in keys]
+		table  = {
+			'key'     : [k for k, t in zip(keys, tables) for i in range(len(t['area']))],
+			'contour' : np.concatenate(
+				[np.arange(len(t['area'])) for t in tables] + [np.zeros(0, np.int64)]
+			)
+		}
+
+		for column in ('class_idx',) + geometry_columns:
+			table[column] = np.concatenate(
+				[t[column] for t in tables] + [np.zeros(0)]
+			)
+		table['class_idx']  = table['class_idx'].astype(np.int64)
+		table['n_vertices'] = table['n_vertices'].astype(np.int64)
+
+		return table
+
+	# Returns a dictionary with per class and dataset wide totals.
+	def summary(self):
+		table     = self.contourTable()
+		classes   = self.dataset.meta_structure['classes']
+		entries   = self.dataset.meta_structure['entries']
+		n_classes = max(len(classes), int(table['class_idx'].max(initial=-1)) + 1)
+
+		class_idx = table['class_idx']
+		counts    = np.bincount(class_idx, minlength=n_classes)
+		areas     = np.bincount(class_idx, table['area'], minlength=n_classes)
+
+		# The number of distinct images each class appears in.
+		image_ids = np.repeat(
+			np.arange(len(entries)),
+			[len(self.cache[k][2]['area']) for k in entries]
+		)
+		images = counts
+		if n_classes > 0:
+			pairs  = np.unique(image_ids * n_classes + class_idx)
+			images = np.bincount(pairs % n_classes, minlength=n_classes)
+
+		class_summaries = []
+		for idx in range(n_classes):
+			class_summaries.append({
+				'class_idx'  : idx,
+				'name'       : classes[idx]['name'] if idx < len(classes) else None,
+				'count'      : int(counts[idx]),
+				'images'     : int(images[idx]),
+				'total_area' : float(areas[idx]),
+				'mean_area'  : float(areas[idx] / counts[idx]) if counts[idx] > 0 else 0.0
+			})
+
+		return {
+			'units'            : 'pixels' if self.pixel_units else 'relative',
+			'n_images'         : len(entries),
+			'n_labeled_images' : int(sum(1 for k in entries if len(entries[k]) > 0)),
+			'n_contours'       : int(class_idx.shape[0]),
+			'n_vertices'       : int(table['n_vertices'].sum()),
+			'classes'          : class_summaries,
+			'unreadable'       : [
+				{'key': k, 'error': e} for k, e in sorted(self.unreadable.items())
+			]
+		}
+
+	# Writes one row per contour.
+	def writeCSV(self, path):
+		table   = self.contourTable()
+		classes = self.dataset.meta_structure['classes']
+		header  = ['key', 'contour', 'class_idx', 'class_name'] + list(geometry_columns)
+
+		with open(path, 'w', newline='') as file:
+			writer = csv.writer(file)
+			writer.writerow(header)
+			for i in range(len(table['key'])):
+				class_idx = table['class_idx'][i]
+				row = [
+					table['key'][i],
+					int(table['contour'][i]),
+					int(class_idx),
+					classes[class_idx]['name'] if class_idx < len(classes) else ''
+				]
+				row.extend(table[c][i].item() for c in geometry_columns)
+				writer.writerow(row)
+
+	# Writes the summary, and optionally the per contour table, as json.
+	def writeJSON(self, path, include_contours=False):
+		report = self.summary()
+		if include_contours:
+			table = self.contourTable()
+			report['contours'] = {
+				k: (v if isinstance(v, list) else _toJSONList(v))
+				for k, v in table.items()
+			}
+
+		with open(path, 'w') as file:
+			file.write(json.dumps(report))
+
+	# Recomputes any of the given entries that are stale. All of them are
+	# computed in a single vectorized pass.
+	def _update(self, keys):
+		entries = self.dataset.meta_structure['entries']
+		stale   = []
+		for key in keys:
+			contours = entries[key]
+			cached   = self.cache.get(key)
+			if cached is None or cached[0] is not contours or cached[1] != contours.version:
+				stale.append(key)
+
+		if len(stale) == 0:
+			return
+
+		# Only entries with contours need the size of their image. An image
+		# that can't be read doesn't stop the rest of the dataset from being
+		# measured, its entry is reported and measured as if it were empty.
+		image_sizes = {}
+		if self.pixel_units:
+			for key in list(stale):
+				if len(entries[key]) == 0:
+					continue
+
+				try:
+					image_sizes[key] = self.dataset.getImageShape(key)[1::-1]
+					self.unreadable.pop(key, None)
+				except Exception as ex:
+					self.unreadable[key] = str(ex)
+					self.cache[key] = (
+						entries[key], entries[key].version, _emptyGeometry()
+					)
+					stale.remove(key)
+
+			if len(stale) == 0:
+				return
+
+		sets     = [entries[k] for k in stale]
+		vertices = np.concatenate(
+			[s.vertices.astype(np.float64) for s in sets] + [np.zeros((0, 2))]
+		)
+		counts   = np.array([len(s) for s in sets], dtype=np.int64)
+		lengths  = np.concatenate([s.lengths() for s in sets] + [np.zeros(0, np.int64)])
+		offsets  = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+		np.cumsum(lengths, out=offsets[1:])
+
+		sizes = None
+		if self.pixel_units:
+			# Entries without contours take up no rows, so their size doesn't
+			# matter.
+			sizes = np.array(
+				[image_sizes.get(k, (1, 1)) for k in stale], dtype=np.float64
+			).reshape(-1, 2)
+			sizes = np.repeat(sizes, counts, axis=0)
+
+		geometry = computeGeometry(vertices, offsets, sizes)
+
+		# Split the results back up by entry.
+		bounds = np.zeros(len(stale) + 1, dtype=np.int64)
+		np.cumsum(counts, out=bounds[1:])
+		for i, key in enumerate(stale):
+			start, end = bounds[i], bounds[i + 1]
+
+			entry_geometry = {c: v[start:end] for c, v in geometry.items()}
+			entry_geometry['class_idx'] = sets[i].class_idx.copy()
+
+			self.cache[key] = (sets[i], sets[i].version, entry_geometry)
+
+def _emptyGeometry():
+	geometry = {c: np.zeros(0) for c in geometry_columns}
+	geometry['class_idx'] = np.zeros(0, dtype=np.int32)
+
+	return geometry
+
+# NaN isn't valid json, so it is written as null.
+def _toJSONList(arr):
+	if arr.dtype.kind == 'f':
+		return [None if np.isnan(v) else v for v in arr.tolist()]
+
+	return arr.tolist()
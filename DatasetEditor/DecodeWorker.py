@@ -0,0 +1,424 @@
+# Author:      Adam Robinson
+# Description: This file contains a decoder that runs in separate processes
+#              and writes decoded images into slots of a shared memory ring
+#              buffer. The interface can then use the pixel data directly
+#              without copying it or competing with the decoder for the GIL.
+
+import sys
+import threading
+import itertools
+import numpy as np
+import multiprocessing as mp
+
+from multiprocessing import shared_memory
+from collections     import deque
+
+from ImageDecoders import decodeImage, decodeThumbnail
+from DatasetCache  import DatasetCache
+
+# How long to wait for a reply before checking that the worker processes
+# are still running, in seconds.
+_reply_timeout = 1.0
+
+# Ownership protocol
+# ------------------
+# Every slot in the ring is in exactly one of three states:
+#
+#   free     - Owned by the DecodeWorker. It is in the free list and can be
+#              handed out for a new decode.
+#   decoding - A decode request for the slot has been sent to a worker
+#              process. The worker process owns the slot until it replies.
+#   leased   - The reply has arrived and the slot has been wrapped in a
+#              FrameLease. The holder of the lease owns the slot and may
+#              read the array view as long as it likes.
+#
+# The holder of a lease must call release() once nothing references the
+# array anymore (in the editor this is after the texture has been uploaded
+# and the image has been replaced by another one). Releasing puts the slot
+# back in the free list. Using the array after releasing it will read
+# whatever image is decoded into the slot next.
+#
+# A released slot keeps its image until it is handed out for another 
+# decode. Free slots are handed out least recently released first, so the
+# images that were viewed most recently stay in the ring the longest. 
+# Decoding a path whose image is still in a free slot leases that slot
+# again without decoding anything.
+#
+# Images that are larger than a slot are decoded into a shared memory block
+# of their own, which the worker process creates and the lease owns. 
+# Releasing the lease frees the block.
+
+# Wraps an array that is backed by a ring slot. Leases created without a
+# worker just wrap an ordinary array and releasing them does nothing. This
+# allows callers to treat images that are resident in memory and images
+# coming from the ring the same way.
+class FrameLease:
+	def __init__(self, array, worker=None, slot=None, shm=None):
+		self.array  = array
+		self.worker = worker
+		self.slot   = slot
+		self.shm    = shm
+
+	def release(self):
+		if self.shm is not None:
+			self.array = None
+			try:
+				self.shm.close()
+			except BufferError:
+				# Something still has a view of the array. The memory is 
+				# freed once that view is gone.
+				pass
+			self.shm.unlink()
+			self.shm = None
+
+		if self.worker is not None:
+			self.worker._releaseSlot(self.slot)
+			self.worker = None
+			self.array  = None
+
+	@property
+	def is_released(self):
+		return self.array is None
+
+
+class DecodeWorker:
+	def __init__(self, n_slots=4, slot_bytes=64 * 1024 * 1024, n_processes=1):
+		self.n_slots     = n_slots
+		self.slot_bytes  = slot_bytes
+		self.n_processes = n_processes
+
+		self.shm       = None
+		self.processes = []
+		self.running   = False
+
+		# The free list is shared between whatever threads are requesting
+		# decodes, so it is protected by a condition variable that is
+		# signalled every time a slot is released.
+		self.free_slots     = deque(range(n_slots))
+		self.slot_condition = threading.Condition()
+
+		# The images that are still in the ring. Maps path -> (slot, file
+		# stamp, shape, dtype) and slot -> path. Protected by slot_condition.
+		self.slot_images = {}
+		self.slot_paths  = {}
+
+		# Requests that have been sent to a worker process and haven't been
+		# answered yet. Maps request id -> [event, reply].
+		self.pending      = {}
+		self.pending_lock = threading.Lock()
+		self.request_ids  = itertools.count()
+
+	def start(self):
+		if self.running:
+			return self
+
+		# Spawn instead of fork. Forking a process that has an OpenGL context
+		# is not safe.
+		context = mp.get_context('spawn')
+
+		self.shm = shared_memory.SharedMemory(
+			create=True, size=self.n_slots * self.slot_bytes
+		)
+		self.request_queue = context.Queue()
+		self.reply_queue   = context.Queue()
+
+		# Spawned processes normally import the main script of the parent
+		# so that functions defined in it can be unpickled. The editor's main
+		# script imports kivy, which would open a second window, and the
+		# worker doesn't need anything from it. Hiding the main module while
+		# the processes start prevents that import.
+		main_module = sys.modules['__main__']
+		main_file   = getattr(main_module, '__file__', None)
+		main_spec   = getattr(main_module, '__spec__', None)
+
+		try:
+			if main_file is not None:
+				del main_module.__file__
+			main_module.__spec__ = None
+
+			for i in range(self.n_processes):
+				process = context.Process(
+					target=_workerMain,
+					args=(
+						self.shm.name,
+						self.slot_bytes,
+						self.request_queue,
+						self.reply_queue
+					),
+					daemon=True
+				)
+				process.start()
+				self.processes.append(process)
+		finally:
+			if main_file is not None:
+				main_module.__file__ = main_file
+			main_module.__spec__ = main_spec
+
+		self.running = True
+
+		self.reply_thread = threading.Thread(
+			target=self._readReplies, daemon=True
+		)
+		self.reply_thread.start()
+
+		return self
+
+	def stop(self):
+		if not self.running:
+			return
+
+		self.running = False
+		if all(process.is_alive() for process in self.processes):
+			for process in self.processes:
+				self.request_queue.put(None)
+
+			for process in self.processes:
+				process.join()
+
+			# This wakes up the reply thread so that it can exit.
+			self.reply_queue.put(None)
+			self.reply_thread.join()
+		else:
+			# A process that was killed can leave the locks of the queues
+			# held, so nothing can be sent through them anymore. The reply
+			# thread is a daemon and is left waiting.
+			for process in self.processes:
+				process.terminate()
+				process.join()
+
+		self.processes = []
+		self.shm.close()
+		self.shm.unlink()
+		self.shm = None
+
+	# Decodes the image at path into a ring slot and returns a FrameLease
+	# for it. This blocks until a slot is free and the decode has finished.
+	# If the image doesn't fit in a slot, the worker process decodes it into
+	# a dedicated block instead, and the lease doesn't hold a slot.
+	def decode(self, path):
+		stamp = DatasetCache.fileStamp(path)
+		lease = self._reuseSlot(path, stamp)
+		if lease is not None:
+			return lease
+
+		slot  = self._acquireSlot()
+		reply = self._request(path, slot, None)
+
+		if reply['error'] is not None:
+			self._releaseSlot(slot)
+			raise Exception(
+				"Could not load file \'%s\'"%path
+			) from Exception(reply['error'])
+
+		if reply['block'] is not None:
+			self._releaseSlot(slot)
+
+			shm  = shared_memory.SharedMemory(name=reply['block'])
+			view = np.ndarray(
+				reply['shape'], dtype=np.dtype(reply['dtype']), buffer=shm.buf
+			)
+			return FrameLease(view, shm=shm)
+
+		# If the path was already in another slot (which is still leased),
+		# the newest copy is the one that is kept track of.
+		with self.slot_condition:
+			if path in self.slot_images:
+				self.slot_paths.pop(self.slot_images[path][0], None)
+
+			self.slot_images[path] = (slot, stamp, reply['shape'], reply['dtype'])
+			self.slot_paths[slot]  = path
+
+		return self._slotLease(slot, reply['shape'], reply['dtype'])
+
+	def _slotLease(self, slot, shape, dtype):
+		view = np.ndarray(
+			shape,
+			dtype=np.dtype(dtype),
+			buffer=self.shm.buf,
+			offset=slot * self.slot_bytes
+		)
+
+		return FrameLease(view, self, slot)
+
+	# Leases the slot that still holds the image at path, if it is free and
+	# the file hasn't changed since it was decoded. Returns None otherwise.
+	def _reuseSlot(self, path, stamp):
+		with self.slot_condition:
+			entry = self.slot_images.get(path)
+			if entry is None:
+				return None
+
+			slot, slot_stamp, shape, dtype = entry
+			if slot_stamp != stamp or slot not in self.free_slots:
+				return None
+
+			self.free_slots.remove(slot)
+
+		return self._slotLease(slot, shape, dtype)
+
+	# Queues a request for just the thumbnail of an image. This doesn't use
+	# a slot, since thumbnails are small. Returns a function that blocks
+	# until the thumbnail is ready and then returns it, along with the shape
+	# of the full image. Submitting many of
+	# these before waiting on any allows all of the worker processes to run.
+	def submitThumbnail(self, path, thumbnail_size):
+		request_id, event = self._submit(path, -1, thumbnail_size)
+
+		def wait():
+			reply = self._wait(request_id, event)
+			if reply['error'] is not None:
+				raise Exception(
+					"Could not load file \'%s\'"%path
+				) from Exception(reply['error'])
+			return reply['thumbnail'], reply['shape']
+
+		return wait
+
+	def _request(self, path, slot, thumbnail_size):
+		request_id, event = self._submit(path, slot, thumbnail_size)
+		return self._wait(request_id, event)
+
+	def _submit(self, path, slot, thumbnail_size):
+		if not self.running:
+			raise Exception("The decode worker has not been started.")
+
+		request_id = next(self.request_ids)
+		event      = threading.Event()
+		with self.pending_lock:
+			self.pending[request_id] = [event, None]
+
+		self.request_queue.put((request_id, path, slot, thumbnail_size))
+		return request_id, event
+
+	# Waits for the reply to a request. A worker process that was killed
+	# (e.g. by running out of memory) never replies, so the processes are
+	# checked every so often while waiting.
+	def _wait(self, request_id, event):
+		while not event.wait(_reply_timeout):
+			for process in self.processes:
+				if not process.is_alive():
+					with self.pending_lock:
+						self.pending.pop(request_id, None)
+					raise Exception(
+						"The decode worker exited with code %s"%process.exitcode
+					)
+
+		with self.pending_lock:
+			return self.pending.pop(request_id)[1]
+
+	def _readReplies(self):
+		while True:
+			reply = self.reply_queue.get()
+			if reply is None:
+				return
+
+			# Requests that were given up on (see _wait) have no entry.
+			with self.pending_lock:
+				entry = self.pending.get(reply['request_id'])
+				if entry is None:
+					continue
+				entry[1] = reply
+			entry[0].set()
+
+	def _acquireSlot(self):
+		with self.slot_condition:
+			while len(self.free_slots) == 0:
+				self.slot_condition.wait()
+			slot = self.free_slots.popleft()
+
+			# The image in the slot is about to be overwritten.
+			path = self.slot_paths.pop(slot, None)
+			if path is not None and self.slot_images[path][0] == slot:
+				del self.slot_images[path]
+
+			return slot
+
+	def _releaseSlot(self, slot):
+		with self.slot_condition:
+			self.free_slots.append(slot)
+			self.slot_condition.notify()
+
+
+# Blocks created by a worker process are owned by the process that leases
+# them. Without this, the worker's resource tracker would unlink them when
+# the worker exits, or warn about them having leaked.
+def _unregisterBlock(block):
+	try:
+		from multiprocessing import resource_tracker
+		resource_tracker.unregister(block._name, 'shared_memory')
+	except Exception:
+		pass
+
+# This is the main loop of the worker processes. Requests are tuples of
+# (request_id, path, slot, thumbnail_size). A slot of -1 means that only a
+# thumbnail is wanted. A request of None tells the process to exit.
+def _workerMain(shm_name, slot_bytes, request_queue, reply_queue):
+	# The Dataset module doesn't import kivy, so it is safe to import here.
+	from Dataset import setupThumbnailBuffer
+
+	shm = shared_memory.SharedMemory(name=shm_name)
+
+	try:
+		while True:
+			request = request_queue.get()
+			if request is None:
+				break
+
+			request_id, path, slot, thumbnail_size = request
+			reply = {
+				'request_id' : request_id,
+				'error'      : None,
+				'block'      : None,
+				'shape'      : None,
+				'dtype'      : None,
+				'thumbnail'  : None
+			}
+
+			try:
+				# When only the thumbnail is wanted, the image can be decoded
+				# at a reduced size (see ImageDecoders.decodeThumbnail).
+				if slot < 0 and thumbnail_size is not None:
+					img, shape = decodeThumbnail(path, thumbnail_size)
+				else:
+					img = decodeImage(path)
+					if img is not None:
+						shape = img.shape
+
+				if img is None:
+					raise Exception("None of the decoders could decode the file")
+
+				reply['shape'] = shape
+				reply['dtype'] = img.dtype.str
+
+				if thumbnail_size is not None:
+					reply['thumbnail'] = setupThumbnailBuffer(img, thumbnail_size)
+
+				if slot >= 0:
+					if img.nbytes > slot_bytes:
+						# The block is unlinked by the lease that the 
+						# requesting process wraps it in.
+						block = shared_memory.SharedMemory(
+							create=True, size=max(img.nbytes, 1)
+						)
+						view  = np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)
+						reply['block'] = block.name
+					else:
+						block = None
+						view  = np.ndarray(
+							img.shape,
+							dtype=img.dtype,
+							buffer=shm.buf,
+							offset=slot * slot_bytes
+						)
+					view[...] = img
+					del view
+
+					if block is not None:
+						_unregisterBlock(block)
+						block.close()
+			except Exception as ex:
+				reply['error'] = str(ex)
+
+			reply_queue.put(reply)
+	finally:
+		shm.close()
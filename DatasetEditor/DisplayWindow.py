@@ -0,0 +1,129 @@
+# Author:      Adam Robinson
+# Description: This class maps the pixel values of an image to the 8 bit
+#              values that are displayed. Images are kept at their native
+#              bit depth (8 or 16 bit integers, or floats), so the range of
+#              values that is shown has to be chosen. The initial range is
+#              taken from a histogram of a downsampled view of the image, so
+#              the full image is never copied. Brightness and contrast then
+#              move and scale that range.
+#
+#              Only the part of an image that is about to be uploaded to a
+#              texture is passed through the window (see ImageManager), so
+#              changing the brightness or contrast doesn't touch the rest of
+#              the image.
+
+import cv2
+import numpy as np
+
+# The histogram is built from roughly this many pixels.
+_histogram_samples = 1 << 18
+
+# The number of bins in the histogram of an image that isn't 8 bit.
+_histogram_bins = 4096
+
+class DisplayWindow:
+	def __init__(self, histogram, value_range, dtype):
+		self.histogram   = histogram
+		self.value_range = value_range
+		self.dtype       = np.dtype(dtype)
+
+		self.brightness = 0.0
+		self.contrast   = 1.0
+
+		# 8 bit images are shown as they are by default. Anything else is
+		# stretched to cover the bulk of its histogram.
+		if self.dtype == np.uint8:
+			self.base_low, self.base_high = 0.0, 255.0
+		else:
+			self.base_low, self.base_high = self.percentileRange(0.5, 99.5)
+
+		self._lut = None
+		self._updateRange()
+
+	# Builds the window for an image from a strided view of it. Only the
+	# sampled pixels are copied.
+	@staticmethod
+	def fromImage(img):
+		n_pixels = img.shape[0] * img.shape[1]
+		step     = max(1, int(np.sqrt(n_pixels / _histogram_samples)))
+		sample   = img[::step, ::step].ravel()
+
+		if img.dtype == np.uint8:
+			histogram   = np.bincount(sample, minlength=256)
+			value_range = (0.0, 256.0)
+		else:
+			# NaN and inf would break the range of the histogram.
+			if sample.dtype.kind == 'f':
+				sample = sample[np.isfinite(sample)]
+
+			low, high = 0.0, 1.0
+			if sample.size > 0:
+				low, high = float(sample.min()), float(sample.max())
+			if high <= low:
+				high = low + 1.0
+
+			histogram, _ = np.histogram(sample, bins=_histogram_bins, range=(low, high))
+			value_range  = (low, high)
+
+		return DisplayWindow(histogram.astype(np.int32), value_range, img.dtype)
+
+	# Returns the pixel values at the given percentiles of the histogram.
+	def percentileRange(self, low_percentile, high_percentile):
+		cdf = np.cumsum(self.histogram, dtype=np.float64)
+		if cdf[-1] == 0:
+			return self.value_range
+
+		cdf       /= cdf[-1]
+		bin_width  = (self.value_range[1] - self.value_range[0]) / len(self.histogram)
+
+		low_bin  = int(np.searchsorted(cdf, low_percentile / 100))
+		high_bin = int(np.searchsorted(cdf, high_percentile / 100))
+
+		low  = self.value_range[0] + low_bin * bin_width
+		high = self.value_range[0] + (high_bin + 1) * bin_width
+		return low, max(high, low + bin_width)
+
+	# brightness moves the window by a fraction of its initial width,
+	# contrast divides its width.
+	def setAdjustment(self, brightness, contrast):
+		self.brightness = float(brightness)
+		self.contrast   = max(float(contrast), 1e-3)
+		self._updateRange()
+
+	def _updateRange(self):
+		width  = self.base_high - self.base_low
+		center = (self.base_low + self.base_high) / 2 - self.brightness * width
+
+		half      = width / (2 * self.contrast)
+		self.low  = center - half
+		self.high = center + half
+		self._lut = None
+
+	# Whether the window leaves the image as it is, in which case it
+	# doesn't need to be applied at all.
+	def isIdentity(self):
+		return self.dtype == np.uint8 and self.low == 0.0 and self.high == 255.0
+
+	# For 8 and 16 bit images, every possible value is mapped once and the
+	# image is then mapped with a table lookup.
+	def _getLUT(self):
+		if self._lut is None:
+			n_values  = 256 if self.dtype == np.uint8 else 65536
+			values    = np.arange(n_values, dtype=np.float32)
+			scale     = 255 / (self.high - self.low)
+			self._lut = np.clip((values - self.low) * scale, 0, 255).astype(np.uint8)
+
+		return self._lut
+
+	# Returns the 8 bit version of an image (or a region of one) that is
+	# displayed.
+	def apply(self, img):
+		if self.dtype == np.uint8:
+			return cv2.LUT(img, self._getLUT())
+
+		if self.dtype == np.uint16:
+			return self._getLUT()[img]
+
+		scale = 255 / (self.high - self.low)
+		out   = (img.astype(np.float32) - self.low) * scale
+		return np.clip(out, 0, 255, out=out).astype(np.uint8)
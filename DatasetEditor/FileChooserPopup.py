@@ -1,25 +1,66 @@
 # Author:      Adam Robinson
 # Description: This class acts as a folder chooser dialog that enforces the
 #              requirement that the user choose a folder and not a file.
+#              Only sub-directories are listed, so folders containing huge
+#              numbers of images can be browsed without listing every file.
 
 
 from kivy.uix.button      import Button
 from kivy.uix.label       import Label
-from kivy.uix.filechooser import FileChooserListView
 from kivy.uix.popup       import Popup
+from kivy.uix.recycleview import RecycleView
+from kivy.clock           import Clock
+
+from kivy.uix.recycleboxlayout  import RecycleBoxLayout
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
 from CustomBoxLayout import CustomBoxLayout
+from Dataset         import image_extensions
 
 import os
+import threading
+
+# Directories are sent to the interface in batches of this size as they
+# are found.
+_batch_size = 256
 
 class FileChooserPopup(Popup):
 	def __init__(self, *args, **kwargs):
 		self.main_layout    = CustomBoxLayout(
 			orientation='vertical', padding=[3, 3, 3, 3]
 		)
-		self.chooser = FileChooserListView(
-			path='~/', dirselect=True
+
+		self.path_bar    = CustomBoxLayout(
+			orientation='horizontal',
+			size_hint_y=None,
+			height=30,
+			spacing=5
+		)
+		self.up_button   = Button(text='Up', size_hint_x=None, width=60)
+		self.path_label  = Label(
+			text='', halign='left', valign='middle', shorten=True
+		)
+		self.path_label.bind(size=self.path_label.setter('text_size'))
+		self.path_bar.add_widget(self.up_button)
+		self.path_bar.add_widget(self.path_label)
+
+		self.folder_view   = RecycleView(do_scroll_x=False)
+		self.folder_layout = RecycleBoxLayout(
+			orientation='vertical',
+			default_size=(None, 30),
+			default_size_hint=(1, None),
+			size_hint_y=None
+		)
+		self.folder_layout.bind(
+			minimum_height=self.folder_layout.setter('height')
+		)
+		self.folder_view.add_widget(self.folder_layout)
+		self.folder_view.viewclass = FolderItem
+
+		self.info_label = Label(
+			text='', size_hint_y=None, height=30
 		)
+
 		self.bottom_buttons = CustomBoxLayout(
 			orientation='horizontal',
 			size_hint_y=None,
@@ -32,9 +73,12 @@ class FileChooserPopup(Popup):
 		self.bottom_buttons.add_widget(self.cancel_button)
 		self.bottom_buttons.add_widget(self.load_button)
 
-		self.main_layout.add_widget(self.chooser)
+		self.main_layout.add_widget(self.path_bar)
+		self.main_layout.add_widget(self.folder_view)
+		self.main_layout.add_widget(self.info_label)
 		self.main_layout.add_widget(self.bottom_buttons)
 
+		self.up_button.bind(on_press=self._up_pressed)
 		self.cancel_button.bind(on_press=self._cancel_pressed)
 		self.load_button.bind(on_press=self._load_pressed)
 
@@ -45,37 +89,190 @@ class FileChooserPopup(Popup):
 
 		super(FileChooserPopup, self).__init__(*args, **kwargs)
 
-		# Create a popup for notifying the user that they need to select
-		# a directory (not a file).
-		self.notify_layout = CustomBoxLayout(orientation='vertical')
-		self.close_button  = Button(text="Ok", size_hint_y=1)
-		self.label         = Label(
-			text='Please Choose a Directory (Not a file)', 
-			size_hint_y=5, font_size=20
+		# Every listing and every folder summary is tagged with the value of
+		# these counters when it was started. Results from a listing or
+		# summary that has since been superseded are dropped.
+		self.listing_generation = 0
+		self.summary_generation = 0
+
+		# path -> (n_images, total_bytes)
+		self.folder_summaries = {}
+
+		self.selected_path = None
+		self.setPath(os.path.expanduser('~'))
+
+	# Navigates to the given directory. Its sub-directories are listed on a
+	# background thread and added to the list as they are found.
+	def setPath(self, path):
+		self.path             = os.path.abspath(path)
+		self.path_label.text  = self.path
+		self.folder_view.data = []
+
+		self.listing_generation += 1
+		thread = threading.Thread(
+			target=self._listDirectories,
+			args=(self.path, self.listing_generation),
+			daemon=True
 		)
-		self.notify_layout.add_widget(self.label)
-		self.notify_layout.add_widget(self.close_button)
-		self.close_button.bind(on_press=self._close_notify_pressed)
-
-		self.notify_popup = Popup(
-			title='Invalid Choice', 
-			content=self.notify_layout,
-			size_hint=(None, None),
-			size=(400, 200)
+		thread.start()
+
+		self.selectFolder(None)
+
+	def _listDirectories(self, path, generation):
+		batch = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					if generation != self.listing_generation:
+						return
+
+					# On most platforms is_dir doesn't need to stat the file,
+					# so this stays fast even with 100k images in the folder.
+					if entry.name.startswith('.'):
+						continue
+					if not entry.is_dir():
+						continue
+
+					batch.append(entry.name)
+					if len(batch) == _batch_size:
+						self._scheduleAdd(generation, batch)
+						batch = []
+		except OSError:
+			pass
+
+		self._scheduleAdd(generation, batch, finished=True)
+
+	def _scheduleAdd(self, generation, names, finished=False):
+		Clock.schedule_once(
+			lambda dt: self._addDirectories(generation, names, finished)
+		)
+
+	def _addDirectories(self, generation, names, finished):
+		if generation != self.listing_generation:
+			return
+
+		self.folder_view.data.extend(
+			{'text': name, 'path': os.path.join(self.path, name), 'chooser': self}
+			for name in names
 		)
 
+		# Directories are shown in the order they are found while the listing
+		# is running, and sorted once it is done.
+		if finished:
+			self.folder_view.data = sorted(
+				self.folder_view.data, key=lambda row: row['text'].lower()
+			)
+
+	# Highlights a folder and shows its image count and total size. These
+	# are computed on a background thread the first time a folder is
+	# highlighted.
+	def selectFolder(self, path):
+		self.selected_path = path
+		self.summary_generation += 1
+
+		if path is None:
+			self.info_label.text = ''
+		elif path in self.folder_summaries:
+			self._showSummary(path, *self.folder_summaries[path], True)
+		else:
+			self.info_label.text = 'Counting images...'
+			thread = threading.Thread(
+				target=self._summarizeFolder,
+				args=(path, self.summary_generation),
+				daemon=True
+			)
+			thread.start()
+
+		self.folder_view.refresh_from_data()
+
+	def _summarizeFolder(self, path, generation):
+		n_images    = 0
+		total_bytes = 0
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					if generation != self.summary_generation:
+						return
+
+					if entry.name.split('.')[-1] not in image_extensions:
+						continue
+					if not entry.is_file():
+						continue
+
+					n_images    += 1
+					total_bytes += entry.stat().st_size
+
+					# Show partial counts for very large folders.
+					if n_images % 10000 == 0:
+						self._scheduleSummary(
+							path, generation, n_images, total_bytes, False
+						)
+		except OSError:
+			pass
+
+		self._scheduleSummary(path, generation, n_images, total_bytes, True)
+
+	def _scheduleSummary(self, path, generation, n_images, total_bytes, finished):
+		def _update(dt):
+			if finished:
+				self.folder_summaries[path] = (n_images, total_bytes)
+
+			if generation == self.summary_generation:
+				self._showSummary(path, n_images, total_bytes, finished)
+
+		Clock.schedule_once(_update)
+
+	def _showSummary(self, path, n_images, total_bytes, finished):
+		self.info_label.text = '%s: %d images, %1.1f MB%s'%(
+			os.path.basename(path),
+			n_images,
+			total_bytes / (1024 * 1024),
+			'' if finished else ' (counting)'
+		)
+
+	def _up_pressed(self, instance):
+		self.setPath(os.path.dirname(self.path))
+
 	def _cancel_pressed(self, instance):
 		self.dismiss()
 
-	def _close_notify_pressed(self, instance):
-		self.notify_popup.dismiss()
-
 	def _load_pressed(self, instance):
-		# self.chooser.path is the path to the directory that they selected.
-		print(self.chooser.path)
-		print(self.chooser.selection)
-		if not os.path.isdir(self.chooser.selection[0]):
-			self.notify_popup.open()
+		# If no folder is highlighted, the folder being viewed is loaded.
+		path = self.selected_path
+		if path is None:
+			path = self.path
+
+		self.dismiss()
+		self.directory_chosen_callback(path)
+
+# A row in the folder list. Clicking a folder highlights it, double
+# clicking it opens it.
+class FolderItem(RecycleDataViewBehavior, Button):
+	def __init__(self, *args, **kwargs):
+		super(FolderItem, self).__init__(*args, **kwargs)
+
+		self.path    = None
+		self.chooser = None
+
+		self.halign = 'left'
+		self.valign = 'middle'
+		self.bind(size=self.setter('text_size'))
+
+	def refresh_view_attrs(self, rv, index, data):
+		self.text    = data['text']
+		self.path    = data['path']
+		self.chooser = data['chooser']
+
+		if self.path == self.chooser.selected_path:
+			self.background_color = (0.4, 0.6, 1, 1)
+		else:
+			self.background_color = (1, 1, 1, 1)
+
+	def on_release(self):
+		if self.chooser is None:
+			return
+
+		if self.last_touch is not None and self.last_touch.is_double_tap:
+			self.chooser.setPath(self.path)
 		else:
-			self.dismiss()
-			self.directory_chosen_callback(self.chooser.selection[0])
\ No newline at end of file
+			self.chooser.selectFolder(self.path)
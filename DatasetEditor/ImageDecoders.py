@@ -0,0 +1,372 @@
+# Author:      Adam Robinson
+# Description: This file contains the image decoders used to read the images
+#              in a dataset, and the registry that chooses between them.
+#              Every decoder produces three channel BGR arrays. cv2 is
+#              always available and handles every format. The other
+#              decoders are only used if the package they need is installed.
+#
+#              Decoders declare what they can do cheaply:
+#
+#                  scales       - The 1/N reductions the decoder can produce
+#                                 without decoding the full image first.
+#                  reads_header - Whether the decoder can get the shape of
+#                                 an image without decoding it.
+#                  native_depth - Whether 16 bit and float images keep their
+#                                 bit depth, rather than being truncated to
+#                                 8 bits.
+#
+#              JPEG images are rotated and flipped according to their EXIF
+#              orientation, the same way cv2 does it, so that every decoder
+#              produces the same upright image.
+#
+#              Paths can refer to a single page of a multi-page tiff (see
+#              ImageHeader.splitPage). Only that page is decoded.
+#
+#              decodeImage and decodeThumbnail pick the first registered
+#              decoder for the extension that can do what is needed. The
+#              verify-decoders command in DatasetCLI.py checks the output
+#              of every available decoder against cv2.
+
+import os
+import cv2
+import numpy as np
+
+from ImageHeader import readImageSize, readOrientation, splitPage
+
+# Turns an image stored with the given EXIF orientation upright.
+def applyOrientation(img, orientation):
+	if orientation == 2:
+		img = img[:, ::-1]
+	elif orientation == 3:
+		img = img[::-1, ::-1]
+	elif orientation == 4:
+		img = img[::-1]
+	elif orientation == 5:
+		img = img.swapaxes(0, 1)
+	elif orientation == 6:
+		img = img.swapaxes(0, 1)[:, ::-1]
+	elif orientation == 7:
+		img = img.swapaxes(0, 1)[::-1, ::-1]
+	elif orientation == 8:
+		img = img.swapaxes(0, 1)[::-1]
+	else:
+		return img
+
+	return np.ascontiguousarray(img)
+
+# Swaps the height and width of a shape for the orientations that rotate
+# the image by 90 degrees.
+def _orientedShape(shape, orientation):
+	if orientation >= 5:
+		return (shape[1], shape[0])
+
+	return shape
+
+class CV2Decoder:
+	name         = 'cv2'
+	extensions   = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff']
+	reads_header = True
+	native_depth = True
+
+	# libjpeg can skip most of the work for a reduced decode. For the other
+	# formats, cv2 decodes the full image and then shrinks it. Reduced 
+	# decodes are always 8 bit, but they are only used for jpeg images.
+	_reduced_flags = {
+		1 : cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH,
+		2 : cv2.IMREAD_REDUCED_COLOR_2,
+		4 : cv2.IMREAD_REDUCED_COLOR_4,
+		8 : cv2.IMREAD_REDUCED_COLOR_8
+	}
+
+	@staticmethod
+	def available():
+		return True
+
+	def scales(self, ext):
+		if ext in ('jpg', 'jpeg'):
+			return [1, 2, 4, 8]
+
+		return [1]
+
+	def decode(self, path, scale=1):
+		path, page = splitPage(path)
+		if page is None:
+			return cv2.imread(path, self._reduced_flags[scale])
+
+		ok, pages = cv2.imreadmulti(path, page, 1, flags=self._reduced_flags[scale])
+		if not ok or len(pages) == 0:
+			return None
+
+		return pages[0]
+
+	# The headers are parsed directly (see ImageHeader.py), since cv2 has no
+	# way to read them.
+	def readShape(self, path):
+		return readImageSize(path)
+
+# Uses the libjpeg-turbo bindings from the PyTurboJPEG package.
+class TurboJPEGDecoder:
+	name         = 'turbojpeg'
+	extensions   = ['jpg', 'jpeg']
+	reads_header = True
+
+	# Baseline jpeg is always 8 bit.
+	native_depth = True
+
+	def __init__(self):
+		from turbojpeg import TurboJPEG
+		self.jpeg = TurboJPEG()
+
+	@staticmethod
+	def available():
+		try:
+			from turbojpeg import TurboJPEG
+			TurboJPEG()
+		except Exception:
+			# Either the package or the library it wraps is missing.
+			return False
+
+		return True
+
+	def scales(self, ext):
+		return [1, 2, 4, 8]
+
+	def decode(self, path, scale=1):
+		with open(path, 'rb') as file:
+			data = file.read()
+
+		# The default pixel format of the bindings is BGR.
+		img = self.jpeg.decode(data, scaling_factor=(1, scale))
+		return applyOrientation(img, readOrientation(path))
+
+	def readShape(self, path):
+		with open(path, 'rb') as file:
+			data = file.read()
+
+		width, height = self.jpeg.decode_header(data)[:2]
+		return _orientedShape((height, width), readOrientation(path))
+
+# Uses Pillow. Its draft mode lets the jpeg decoder produce a reduced image
+# directly.
+class PillowDecoder:
+	name         = 'pillow'
+	extensions   = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff']
+	reads_header = True
+	native_depth = False
+
+	@staticmethod
+	def available():
+		try:
+			import PIL.Image
+		except ImportError:
+			return False
+
+		return True
+
+	def scales(self, ext):
+		if ext in ('jpg', 'jpeg'):
+			return [1, 2, 4, 8]
+
+		return [1]
+
+	def decode(self, path, scale=1):
+		from PIL import Image
+
+		path, page = splitPage(path)
+		with Image.open(path) as img:
+			if page is not None:
+				img.seek(page)
+
+			if scale != 1:
+				img.draft('RGB', (
+					(img.size[0] + scale - 1) // scale,
+					(img.size[1] + scale - 1) // scale
+				))
+
+			arr = np.asarray(img.convert('RGB'))
+
+		arr = np.ascontiguousarray(arr[:, :, ::-1])
+		return applyOrientation(arr, readOrientation(path))
+
+	# Opening an image only reads its header.
+	def readShape(self, path):
+		from PIL import Image
+
+		path, page = splitPage(path)
+		with Image.open(path) as img:
+			if page is not None:
+				img.seek(page)
+
+			shape = (img.size[1], img.size[0])
+
+		return _orientedShape(shape, readOrientation(path))
+
+# The decoder classes in order of preference. The first one that is
+# installed and can do what is needed is used. cv2 comes before Pillow,
+# since it is faster at full size decodes and also supports reduced jpeg
+# decodes.
+_decoder_classes = [TurboJPEGDecoder, CV2Decoder, PillowDecoder]
+
+# ext -> [decoder instance], built the first time it is needed.
+_registry = None
+
+def _buildRegistry():
+	registry = {}
+	for _class in _decoder_classes:
+		if not _class.available():
+			continue
+
+		decoder = _class()
+		for ext in _class.extensions:
+			registry.setdefault(ext, []).append(decoder)
+
+	return registry
+
+# Adds a decoder to the registry. It is preferred over the decoders that
+# are already registered for its extensions.
+def registerDecoder(decoder):
+	for ext in decoder.extensions:
+		decodersFor(ext).insert(0, decoder)
+
+# Returns the decoders that can read files with the given extension, in
+# order of preference.
+def decodersFor(ext):
+	global _registry
+	if _registry is None:
+		_registry = _buildRegistry()
+
+	return _registry.setdefault(ext.lower(), [])
+
+def _extension(path):
+	return os.path.splitext(splitPage(path)[0])[1][1:].lower()
+
+# Decodes an image at full size and native bit depth, or returns None if it
+# can't be decoded. Decoders that would truncate the image to 8 bits are
+# only used if none of the others can decode it.
+def decodeImage(path):
+	decoders = decodersFor(_extension(path))
+	decoders = sorted(decoders, key=lambda d: not d.native_depth)
+
+	for decoder in decoders:
+		img = decoder.decode(path)
+		if img is not None:
+			return img
+
+	return None
+
+# Returns the (height, width, channels) of an image without decoding it, if
+# possible. Returns None if no decoder could read the header.
+def readImageShape(path):
+	for decoder in decodersFor(_extension(path)):
+		if not decoder.reads_header:
+			continue
+
+		try:
+			shape = decoder.readShape(path)
+		except Exception:
+			shape = None
+
+		if shape is not None:
+			return (shape[0], shape[1], 3)
+
+	return None
+
+# Decodes an image at the smallest 1/N scale that is still at least as large
+# as the thumbnail. Returns the decoded image and the shape of the full
+# image, or (None, None) if it can't be decoded.
+def decodeThumbnail(path, thumbnail_size):
+	ext   = _extension(path)
+	shape = readImageShape(path)
+
+	if shape is not None:
+		# The cheapest option is the largest reduction that any decoder 
+		# supports. Ties go to the preferred decoder.
+		best_decoder, best_scale = None, 1
+		for decoder in decodersFor(ext):
+			for scale in decoder.scales(ext):
+				fits = (
+					shape[1] // scale >= thumbnail_size[0] and
+					shape[0] // scale >= thumbnail_size[1]
+				)
+				if fits and scale > best_scale:
+					best_decoder, best_scale = decoder, scale
+
+		if best_decoder is not None:
+			img = best_decoder.decode(path, best_scale)
+			if img is not None:
+				return img, shape
+
+	img = decodeImage(path)
+	if img is None:
+		return None, None
+
+	return img, img.shape
+
+# Decodes the given images with every available decoder and compares the
+# results to cv2. Lossless formats have to match exactly. JPEG decoders are
+# allowed to differ slightly, since they use different IDCT implementations.
+# Returns one result per image, decoder and scale.
+def verifyDecoders(paths, jpeg_tolerance=4.0):
+	reference = CV2Decoder()
+	results   = []
+
+	for path in paths:
+		ext      = _extension(path)
+		lossless = ext not in ('jpg', 'jpeg')
+
+		for decoder in decodersFor(ext):
+			for scale in decoder.scales(ext):
+				result = {
+					'path'    : path,
+					'decoder' : decoder.name,
+					'scale'   : scale,
+					'passed'  : False,
+					'error'   : None
+				}
+				results.append(result)
+
+				if scale not in reference.scales(ext):
+					result['error'] = 'cv2 has no reference for this scale'
+					continue
+
+				try:
+					img      = decoder.decode(path, scale)
+					expected = reference.decode(path, scale)
+				except Exception as ex:
+					result['error'] = str(ex)
+					continue
+
+				if img is None or img.shape != expected.shape:
+					result['error'] = 'shape %s does not match cv2 (%s)'%(
+						None if img is None else img.shape, expected.shape
+					)
+					continue
+
+				if img.dtype != expected.dtype:
+					result['error'] = 'dtype %s does not match cv2 (%s)'%(
+						img.dtype, expected.dtype
+					)
+					continue
+
+				diff = np.abs(img.astype(np.float64) - expected.astype(np.float64))
+				result['mean_difference'] = float(diff.mean())
+				result['max_difference']  = float(diff.max())
+
+				if lossless:
+					result['passed'] = result['max_difference'] == 0
+				else:
+					result['passed'] = result['mean_difference'] <= jpeg_tolerance
+
+			if decoder.reads_header:
+				shape = decoder.readShape(path)
+				full  = reference.decode(path)
+				results.append({
+					'path'    : path,
+					'decoder' : decoder.name,
+					'scale'   : 'header',
+					'passed'  : shape is not None and full is not None and
+					            tuple(shape) == full.shape[:2],
+					'error'   : None
+				})
+
+	return results
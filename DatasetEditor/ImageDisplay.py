@@ -3,27 +3,29 @@
 #              handling resizing, events, zooming, panning and drawing
 #              geometry on the image.
 
-from kivy.uix.label        import Label
-from kivy.uix.image        import Image
-from kivy.uix.gridlayout   import GridLayout
 from kivy.uix.behaviors    import ButtonBehavior
-from kivy.core.image       import Image as CoreImage
 from kivy.graphics.texture import Texture
 from kivy.graphics         import Rectangle, Color, Line, InstructionGroup
-from kivy.uix.scrollview   import ScrollView
+from kivy.graphics.opengl  import glGetIntegerv, GL_MAX_TEXTURE_SIZE
 from kivy.uix.button       import Button
-from kivy.uix.floatlayout  import FloatLayout
 from kivy.core.window      import Window
 
 from kivy.graphics.stencil_instructions import StencilPush, StencilUse
 from kivy.graphics.stencil_instructions import StencilPop, StencilUnUse
 from kivy.utils                         import get_color_from_hex as hex_color
 
-from Dataset           import Dataset
 from CustomBoxLayout   import CustomBoxLayout
+from ImagePyramid      import (
+	ImagePyramid, needsTiles, tile_pixel_threshold, default_max_texture_size
+)
+from TextureCache      import TextureCache
+from Contour           import Contour, snapCoordinate
+from MaskRasterizer    import rasterizeContours, relativeBoundingRect
+from Tracing           import span, traced
+
+from collections import OrderedDict
 
 import numpy as np
-import code
 
 # Relative Coordinates: Coordinates in the range [0.0, 1.0], that correspond
 # to positions in the image being displayed.
@@ -48,6 +50,15 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 		else:
 			self.padding = [0, 0, 0, 0]
 
+		# Controls whether images are displayed as a single texture or as
+		# tiles from a multi-resolution pyramid. 'auto' will use tiles when
+		# the image is too large for a single texture.
+		if 'tiled' in kwargs:
+			self.tiled_mode = kwargs['tiled']
+			del kwargs['tiled']
+		else:
+			self.tiled_mode = 'auto'
+
 		super(ImageManager, self).__init__(*args, **kwargs)
 
 		# Make sure the background is white. When you don't, images draw
@@ -59,6 +70,20 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 				size=self.size
 			)
 
+		# When displaying a tiled image, the image_rect above is left 
+		# without a texture and the tiles covering the current view are 
+		# drawn in this group instead. It is created here so that it always
+		# draws underneath the contours.
+		self.tile_group = InstructionGroup()
+		self.canvas.add(self.tile_group)
+
+		# The filled mask overlay (see MaskOverlay) is a single textured
+		# rectangle drawn in this group, over the image and under the
+		# contours.
+		self.overlay_group   = InstructionGroup()
+		self.overlay_texture = None
+		self.canvas.add(self.overlay_group)
+
 		# Flag for whether or not an image is currently loaded. 
 		# Zooming events are invalid when this is false.
 		self.is_loaded = False
@@ -91,6 +116,40 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 		# indices, not float32 coordinates.
 		self.current_zoom_subarray = None
 
+		# The full resolution pixels of the current image and its 
+		# (height, width, channels). When an image is displayed from a cached
+		# texture, the pixels aren't acquired until something needs them
+		# (see the img property).
+		self._img       = None
+		self.img_loader = None
+		self.img_shape  = None
+
+		# The (height, width) of the region of the image that is currently
+		# displayed. This is tracked separately from the subarray because
+		# tiled images never slice the full resolution data.
+		self.current_zoom_shape = None
+
+		# State for tiled display. Tile textures are kept in least recently
+		# used order so that panning back over an area doesn't require a
+		# new upload.
+		self.is_tiled          = False
+		self.pyramid           = None
+		self.tile_size         = 512
+		self.tile_textures     = OrderedDict()
+		self.max_tile_textures = 256
+		self.max_texture_size  = None
+		self.base_texture      = None
+
+		# The DisplayWindow (see DisplayWindow.py) that maps the pixel values
+		# of the image to the displayed values, or None to display 8 bit
+		# images as they are. Only the data that is uploaded to a texture is
+		# passed through it.
+		self.display_window = None
+
+		# Images with more pixels than this are displayed with tiles, even
+		# if they would fit in a single texture.
+		self.tile_pixel_threshold = tile_pixel_threshold
+
 		# These are the position and dimensions of the rectangle
 		# that displays the image. They are updated every time the
 		# pos and size events fire.
@@ -213,12 +272,12 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 			x0_idx, x1_idx, y0_idx, y1_idx = self.last_zoom
 			xr  = ((x - self.display_x) / self.display_width) * self.img_size[0]
 			xr += x0_idx
-			xr /= self.img.shape[1]
+			xr /= self.img_shape[1]
 
-			y0_idx = self.img.shape[0] - y0_idx
+			y0_idx = self.img_shape[0] - y0_idx
 			yr  = ((y - self.display_y) / self.display_height) * self.img_size[1]
 			yr += y0_idx
-			yr /= self.img.shape[0]
+			yr /= self.img_shape[0]
 		else:
 			xr = (x - self.display_x) / self.display_width
 			yr = (y - self.display_y) / self.display_height
@@ -231,11 +290,11 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 	def relativeCoordinatesToScreenCoordinates(self, x, y):
 		if self.last_zoom is not None:
 			x0_idx, x1_idx, y0_idx, y1_idx = self.last_zoom
-			xs = (x * self.img.shape[1]) - x0_idx
+			xs = (x * self.img_shape[1]) - x0_idx
 			xs = (xs / self.img_size[0]) * self.display_width + self.display_x
 
-			y0_idx = self.img.shape[0] - y0_idx
-			ys = (y * self.img.shape[0]) - y0_idx
+			y0_idx = self.img_shape[0] - y0_idx
+			ys = (y * self.img_shape[0]) - y0_idx
 			ys = (ys / self.img_size[1]) * self.display_height + self.display_y
 		else:
 			xs = (x * self.display_width)  + self.display_x
@@ -243,35 +302,10 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 
 		return xs, ys
 
-	# Adds a new line onto the stack.
+	# Adds a new line onto the stack. The geometry can be a list of [x, y]
+	# pairs or an (N, 2) array of relative coordinates.
 	def pushLine(self, color, geometry):
-		isg = InstructionGroup()
-		converted_coordinates = []
-		for x, y in geometry:
-			converted_coordinates.extend(
-				self.relativeCoordinatesToScreenCoordinates(x, y)
-			)
-
-		# The stencil operations referenced here ensure that the contours do not
-		# draw outside the image. Without these, the contours would be all over the 
-		# place when zooming in (unless manual clipping was implemented).
-		isg.add(StencilPush())
-		isg.add(Rectangle(
-			pos=(self.display_x, self.display_y),
-			size=(self.display_width, self.display_height)
-		))
-		isg.add(StencilUse())		
-		isg.add(Color(*color))
-		isg.add(Line(
-			points=converted_coordinates,
-			width=1.0
-		))
-		isg.add(StencilUnUse())
-		isg.add(Rectangle(
-			pos=(self.display_x, self.display_y),
-			size=(self.display_width, self.display_height)
-		))
-		isg.add(StencilPop())
+		isg = self._buildLineGroup(color, geometry)
 
 		self.lines.append(geometry)
 		self.colors.append(color)
@@ -281,19 +315,31 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 	# Pops the most recent line off of the stack.
 	def popLine(self):
 		self.canvas.remove(self.instruction_groups[-1])
-		self.instruction_groups.remove(self.instruction_groups[-1])
-		self.colors.remove(self.colors[-1])
-		self.lines.remove(self.lines[-1])
+		self.instruction_groups.pop()
+		self.colors.pop()
+		self.lines.pop()
 
 	def clearLines(self):
 		# Get rid of the existing graphics objects.
-		for g in range(len(self.instruction_groups)):
-			self.canvas.remove(self.instruction_groups[-1])
+		for isg in self.instruction_groups:
+			self.canvas.remove(isg)
 
 		self.instruction_groups = []
 		self.colors             = []
 		self.lines              = []
 
+	# Returns the number of graphics instructions in this widget's canvas,
+	# including the ones inside of instruction groups.
+	def countInstructions(self):
+		count  = 0
+		groups = [self.canvas.before, self.canvas, self.canvas.after]
+		while len(groups) > 0:
+			children = groups.pop().children
+			count   += len(children)
+			groups.extend(c for c in children if isinstance(c, InstructionGroup))
+
+		return count
+
 	def setContourColor(self, index, color):
 		self.colors[index] = color
 		self.updateContoursForZoom()
@@ -301,51 +347,55 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 	# Updates the graphics objects used to render the contours. Does not 
 	# update the underlying "lines" array. This is meant to store ground
 	# truth coordinates, not on screen coordinates.
+	@traced('ImageManager.updateContoursForZoom')
 	def updateContoursForZoom(self):
 		# We need to update all of the rectangles in the canvas that pertain
 		# to drawing contours.
 
 		# Get rid of the existing graphics objects.
-		for g in range(len(self.instruction_groups)):
-			self.canvas.remove(self.instruction_groups[-1])
-			self.instruction_groups.remove(self.instruction_groups[-1])
+		for isg in self.instruction_groups:
+			self.canvas.remove(isg)
 
 		# Add new graphics instructions with appropriate coordinates.
-		
-		# Redraw them normally.
+		self.instruction_groups = []
 		for geo, color in zip(self.lines, self.colors):
-			isg = InstructionGroup()
-			converted_coordinates = []
-			for x, y in geo:
-				converted_coordinates.extend([
-					self.relativeCoordinatesToScreenCoordinates(x, y)
-				])
-
-			# The stencil operations referenced here ensure that the contours 
-			# do not draw outside the image. Without these, the contours would 
-			# be all over the place when zooming in (unless manual clipping was
-			# implemented).
-			isg.add(StencilPush())
-			isg.add(Rectangle(
-				pos=(self.display_x, self.display_y),
-				size=(self.display_width, self.display_height)
-			))
-			isg.add(StencilUse())		
-			isg.add(Color(*color))
-			isg.add(Line(
-				points=converted_coordinates,
-				width=1.0
-			))
-			isg.add(StencilUnUse())
-			isg.add(Rectangle(
-				pos=(self.display_x, self.display_y),
-				size=(self.display_width, self.display_height)
-			))
-			isg.add(StencilPop())
+			isg = self._buildLineGroup(color, geo)
 			self.instruction_groups.append(isg)
 			self.canvas.add(isg)
-		
 
+	# Creates the graphics instructions that draw a single line. The 
+	# coordinate conversion functions only do arithmetic, so they convert
+	# every point of the line at once when given arrays.
+	def _buildLineGroup(self, color, geometry):
+		points = np.asarray(geometry, dtype=np.float64).reshape(-1, 2)
+		xs, ys = self.relativeCoordinatesToScreenCoordinates(
+			points[:, 0], points[:, 1]
+		)
+		converted_coordinates = np.column_stack((xs, ys)).ravel().tolist()
+
+		# The stencil operations referenced here ensure that the contours do not
+		# draw outside the image. Without these, the contours would be all over the 
+		# place when zooming in (unless manual clipping was implemented).
+		isg = InstructionGroup()
+		isg.add(StencilPush())
+		isg.add(Rectangle(
+			pos=(self.display_x, self.display_y),
+			size=(self.display_width, self.display_height)
+		))
+		isg.add(StencilUse())		
+		isg.add(Color(*color))
+		isg.add(Line(
+			points=converted_coordinates,
+			width=1.0
+		))
+		isg.add(StencilUnUse())
+		isg.add(Rectangle(
+			pos=(self.display_x, self.display_y),
+			size=(self.display_width, self.display_height)
+		))
+		isg.add(StencilPop())
+
+		return isg
 
 	# Handles updating of the zoom rectangle (dashed line) and updating
 	# of the coordinates that indicate the current zoom rectangle.
@@ -438,6 +488,10 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 			self.display_x = pos[0] + self.padding[0]
 			self.display_y = pos[1] + self.padding[1]
 
+		if self.is_tiled:
+			self._updateTiles()
+
+		self._updateOverlay()
 		self.updateContoursForZoom()
 
 	def _update_dims(self, inst, val):
@@ -449,50 +503,62 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 	# sub array and create a new texture object to display the zoomed image.
 	# This call stacks properly onto previous zoom calls, allowing the user
 	# to make multiple successive zooms.
+	@traced('ImageManager.zoomTo')
 	def zoomTo(self, x0, x1, y0, y1):
 		# First, select the part of the image data that corresponds to the zoom
 		# rectangle.
-		if self.current_zoom_subarray is not None:
-			to_zoom = self.current_zoom_subarray
-		else:
-			to_zoom = self.img
+		to_zoom = self.current_zoom_shape
 
 		# Convert screen coordinates to array indices
-		x0_idx = int(round((x0 / self.display_width) * to_zoom.shape[1]))
-		x1_idx = int(round((x1 / self.display_width) * to_zoom.shape[1]))
-		y0_idx = int(round((y0 / self.display_height) * to_zoom.shape[0]))
-		y1_idx = int(round((y1 / self.display_height) * to_zoom.shape[0]))
+		x0_idx = int(round((x0 / self.display_width) * to_zoom[1]))
+		x1_idx = int(round((x1 / self.display_width) * to_zoom[1]))
+		y0_idx = int(round((y0 / self.display_height) * to_zoom[0]))
+		y1_idx = int(round((y1 / self.display_height) * to_zoom[0]))
 
 		# Account for the different coordinate system. Arrays grow
 		# from top to bottom in their first dimension, while kivy screen
 		# coordinates are in the first cartesian quandrant.
-		y0_idx = to_zoom.shape[0] - y0_idx - 1
-		y1_idx = to_zoom.shape[0] - y1_idx - 1
+		y0_idx = to_zoom[0] - y0_idx - 1
+		y1_idx = to_zoom[0] - y1_idx - 1
 
-		self.current_zoom_subarray = to_zoom[
-			y1_idx:y0_idx + 1,
-			x0_idx:x1_idx + 1,
-			:
-		]
+		# Python slicing clips to the array bounds, so the shape does too.
+		self.current_zoom_shape = (
+			min(y0_idx + 1, to_zoom[0]) - max(y1_idx, 0),
+			min(x1_idx + 1, to_zoom[1]) - max(x0_idx, 0)
+		)
+
+		# Tiled images never slice the full resolution data, the tiles that
+		# cover the new view are fetched when the resize below happens.
+		if not self.is_tiled:
+			if self.current_zoom_subarray is not None:
+				to_zoom_arr = self.current_zoom_subarray
+			else:
+				to_zoom_arr = self.img
+
+			self.current_zoom_subarray = to_zoom_arr[
+				y1_idx:y0_idx + 1,
+				x0_idx:x1_idx + 1,
+				:
+			]
 
 		# This is ugly, but necessary to ensure that successive zoom operations
 		# are tracked. The self.last_zoom variable produced by this block is used
 		# to calculate conversions between screen and relative coordinates.
 		if self.last_zoom is not None:
-			x0_idx = int(round((x0 / self.display_width)  * to_zoom.shape[1]))
-			y0_idx = int(round((y0 / self.display_height) * to_zoom.shape[0]))
+			x0_idx = int(round((x0 / self.display_width)  * to_zoom[1]))
+			y0_idx = int(round((y0 / self.display_height) * to_zoom[0]))
 			old_x0_idx, old_x1_idx, old_y0_idx, old_y1_idx = self.last_zoom
 
 			x0_idx += old_x0_idx
-			y0_idx  = y0_idx + (self.img.shape[0] - old_y0_idx)
-			y0_idx  = self.img.shape[0] - y0_idx
+			y0_idx  = y0_idx + (self.img_shape[0] - old_y0_idx)
+			y0_idx  = self.img_shape[0] - y0_idx
 			self.last_zoom = [
 				x0_idx, x1_idx, y0_idx, y1_idx
 			]
 		else:
-			x0_idx = int(round((x0 / self.display_width)  * to_zoom.shape[1]))
-			y0_idx = int(round((y0 / self.display_height) * to_zoom.shape[0]))
-			y0_idx = to_zoom.shape[0] - y0_idx
+			x0_idx = int(round((x0 / self.display_width)  * to_zoom[1]))
+			y0_idx = int(round((y0 / self.display_height) * to_zoom[0]))
+			y0_idx = to_zoom[0] - y0_idx
 			self.last_zoom = [
 				x0_idx, x1_idx, y0_idx, y1_idx
 			]
@@ -500,26 +566,32 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 		# Modify some variables that are necessary for the resize event to
 		# run properly.
 		self.img_size = (
-			self.current_zoom_subarray.shape[1],
-			self.current_zoom_subarray.shape[0]
-		)
-		self.aspect     = self.current_zoom_subarray.shape[1]
-		self.aspect    /= self.current_zoom_subarray.shape[0]
-		self.img_buffer = np.fliplr(np.rot90(np.rot90(self.current_zoom_subarray)))
-		self.img_buffer = memoryview(self.img_buffer.flatten())
-
-		# Load a new texture object into graphics memory so it can be displayed.
-		self.image_texture = Texture.create(
-			size=self.img_size, 
-			colorfmt='bgr'
-		)
-		self.image_texture.blit_buffer(
-			self.img_buffer, 
-			colorfmt='bgr', 
-			bufferfmt='ubyte'
+			self.current_zoom_shape[1],
+			self.current_zoom_shape[0]
 		)
-
-		self.image_rect.texture = self.image_texture
+		self.aspect     = self.current_zoom_shape[1]
+		self.aspect    /= self.current_zoom_shape[0]
+
+		if not self.is_tiled:
+			with span('ImageManager.bufferLayout'):
+				self.img_buffer = self._displayArray(self.current_zoom_subarray)
+				self.img_buffer = np.fliplr(np.rot90(np.rot90(self.img_buffer)))
+				self.img_buffer = memoryview(self.img_buffer.flatten())
+
+			# Load a new texture object into graphics memory so it can be 
+			# displayed.
+			with span('ImageManager.blit'):
+				self.image_texture = Texture.create(
+					size=self.img_size, 
+					colorfmt='bgr'
+				)
+				self.image_texture.blit_buffer(
+					self.img_buffer, 
+					colorfmt='bgr', 
+					bufferfmt='ubyte'
+				)
+
+			self.image_rect.texture = self.image_texture
 
 		# Here we force a resize. This will ensure that proper aspect ratio 
 		# is maintained.
@@ -530,31 +602,358 @@ class ImageManager(ButtonBehavior, CustomBoxLayout):
 		if self.is_loaded:
 			self.current_zoom_subarray = None
 			self.last_zoom             = None
-			self.setImage(self.img)
-
-
-	# Takes a numpy/cv2 image and displays it.
-	def setImage(self, img):
-		self.is_loaded  = True
-		self.img_size   = (img.shape[1], img.shape[0])
-		self.aspect     = img.shape[1] / img.shape[0]
-		self.img        = img
-		self.img_buffer = np.fliplr(np.rot90(np.rot90(img)))
-		self.img_buffer = memoryview(self.img_buffer.flatten())
-
-		self.image_texture = Texture.create(size=self.img_size, colorfmt='bgr')
-		self.image_texture.blit_buffer(
-			self.img_buffer, 
-			colorfmt='bgr', 
-			bufferfmt='ubyte'
-		)
 
-		self.image_rect.texture = self.image_texture
+			if self.is_tiled:
+				# The tiles for the full view are most likely still in the
+				# texture cache, so there is nothing to upload here.
+				self.current_zoom_shape = self.img_shape[:2]
+				self.img_size           = (self.img_shape[1], self.img_shape[0])
+				self.aspect             = self.img_shape[1] / self.img_shape[0]
+				self._resize(self.size, self.pos)
+			else:
+				# The texture for the whole image is still around, so it just
+				# needs to be bound again.
+				self.setImage(
+					self._img, 
+					texture=self.base_texture, 
+					window=self.display_window,
+					shape=self.img_shape,
+					loader=self.img_loader
+				)
+
+
+	# Takes a numpy/cv2 image and displays it. If the image is large enough
+	# to be displayed with tiles, a pyramid for it can optionally be provided
+	# (so that cached levels can be reused). Otherwise one is built here.
+	# If a texture that already contains the image is provided, it will be
+	# bound instead of uploading the image again. Images that aren't 8 bit
+	# need a DisplayWindow.
+	#
+	# When a texture is provided, img can be None. The shape of the image
+	# then has to be given, along with a function that returns its pixels.
+	# The function is only called if the pixels are needed later on.
+	@traced('ImageManager.setImage')
+	def setImage(self, img, pyramid=None, texture=None, window=None,
+		         shape=None, loader=None):
+		if img is not None:
+			shape  = img.shape
+			loader = None
+		# Any zoom state belongs to the previous image. Dropping the subarray
+		# here also ensures that nothing references the previous image's 
+		# pixel data once this returns.
+		self.current_zoom_subarray = None
+		self.last_zoom             = None
+
+		self.is_loaded          = True
+		self.img_size           = (shape[1], shape[0])
+		self.aspect             = shape[1] / shape[0]
+		self._img               = img
+		self.img_loader         = loader
+		self.img_shape          = shape
+		self.current_zoom_shape = shape[:2]
+
+		if self.pyramid is not None and self.pyramid is not pyramid:
+			self.tile_textures = OrderedDict()
+
+		if window is not self.display_window:
+			self.tile_textures = OrderedDict()
+		self.display_window = window
+
+		self.is_tiled = self.shouldTile(shape)
+
+		if self.is_tiled:
+			if pyramid is None:
+				pyramid = ImagePyramid(self.img, self.tile_size)
+
+			self.pyramid            = pyramid
+			self.image_texture      = None
+			self.base_texture       = None
+			self.image_rect.texture = None
+		else:
+			self.pyramid = None
+			self.tile_group.clear()
+
+			if texture is None:
+				with span('ImageManager.bufferLayout'):
+					self.img_buffer = self._displayArray(img)
+					self.img_buffer = np.fliplr(np.rot90(np.rot90(self.img_buffer)))
+					self.img_buffer = memoryview(self.img_buffer.flatten())
+
+				with span('ImageManager.blit'):
+					texture = Texture.create(size=self.img_size, colorfmt='bgr')
+					texture.blit_buffer(
+						self.img_buffer, 
+						colorfmt='bgr', 
+						bufferfmt='ubyte'
+					)
+
+			# The texture for the unzoomed image is kept separately so that 
+			# resetting the zoom doesn't require another upload.
+			self.base_texture       = texture
+			self.image_texture      = texture
+			self.image_rect.texture = texture
 
 		# Here we force a resize. This will ensure that the image does not get
 		# cut off at the edges of the layout it is in.
 		self._resize(self.size, self.pos)
 
+	@property
+	def img(self):
+		if self._img is None and self.img_loader is not None:
+			self._img       = self.img_loader()
+			self.img_loader = None
+
+		return self._img
+
+	# Redraws the image after the brightness or contrast of the current 
+	# DisplayWindow has changed. Only the part of the image that is in view
+	# is mapped and uploaded again.
+	@traced('ImageManager.refreshDisplayWindow')
+	def refreshDisplayWindow(self):
+		if not self.is_loaded:
+			return
+
+		if self.is_tiled:
+			self.tile_textures = OrderedDict()
+			self._updateTiles()
+			return
+
+		region = self.current_zoom_subarray
+		if region is None:
+			region = self.img
+
+		with span('ImageManager.bufferLayout'):
+			self.img_buffer = self._displayArray(region)
+			self.img_buffer = np.fliplr(np.rot90(np.rot90(self.img_buffer)))
+			self.img_buffer = memoryview(self.img_buffer.flatten())
+
+		with span('ImageManager.blit'):
+			texture = Texture.create(
+				size=(region.shape[1], region.shape[0]), 
+				colorfmt='bgr'
+			)
+			texture.blit_buffer(self.img_buffer, colorfmt='bgr', bufferfmt='ubyte')
+
+		# The texture for the unzoomed image no longer matches the window.
+		if self.current_zoom_subarray is None:
+			self.base_texture = texture
+		else:
+			self.base_texture = None
+
+		self.image_texture      = texture
+		self.image_rect.texture = texture
+
+	# Returns the 8 bit data that is displayed for an array of pixels.
+	def _displayArray(self, arr):
+		if self.display_window is None or self.display_window.isIdentity():
+			return arr
+
+		return self.display_window.apply(arr)
+
+	# Determines whether or not an image with the given shape needs to be
+	# displayed with tiles.
+	def shouldTile(self, shape):
+		if self.tiled_mode != 'auto':
+			return bool(self.tiled_mode)
+
+		return needsTiles(
+			shape, self.getMaxTextureSize(), self.tile_pixel_threshold
+		)
+
+	# The largest texture the graphics driver will accept. This can only
+	# be queried once there is an OpenGL context, so it is done lazily.
+	def getMaxTextureSize(self):
+		if self.max_texture_size is None:
+			try:
+				self.max_texture_size = int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)[0])
+			except Exception:
+				self.max_texture_size = 0
+
+			# Some drivers (and the mock backend) report nonsense, fall back
+			# to a size that every desktop GPU supports.
+			if self.max_texture_size <= 0:
+				self.max_texture_size = default_max_texture_size
+
+		return self.max_texture_size
+
+	# Rebuilds the tile rectangles so that they cover the current view, using
+	# the pyramid level that matches the current display scale. Tiles that 
+	# have been displayed recently are reused without uploading them again.
+	@traced('ImageManager.updateTiles')
+	def _updateTiles(self):
+		self.tile_group.clear()
+
+		if not self.is_tiled or self.display_width <= 0 or self.display_height <= 0:
+			return
+
+		row0, row1, col0, col1 = self.getViewRegion()
+		view_w, view_h         = self.img_size
+
+		level = self.pyramid.levelForScale(view_w / self.display_width)
+
+		self.tile_group.add(StencilPush())
+		self.tile_group.add(Rectangle(
+			pos=(self.display_x, self.display_y),
+			size=(self.display_width, self.display_height)
+		))
+		self.tile_group.add(StencilUse())
+		self.tile_group.add(Color(1, 1, 1, 1))
+
+		for ty, tx in self.pyramid.tilesInRegion(level, row0, row1, col0, col1):
+			r0, r1, c0, c1 = self.pyramid.tileBounds(level, ty, tx)
+
+			x = self.display_x + ((c0 - col0) / view_w) * self.display_width
+			y = self.display_y + ((row1 - r1) / view_h) * self.display_height
+			w = ((c1 - c0) / view_w) * self.display_width
+			h = ((r1 - r0) / view_h) * self.display_height
+
+			self.tile_group.add(Rectangle(
+				texture=self._getTileTexture(level, ty, tx),
+				pos=(x, y),
+				size=(w, h)
+			))
+
+		self.tile_group.add(StencilUnUse())
+		self.tile_group.add(Rectangle(
+			pos=(self.display_x, self.display_y),
+			size=(self.display_width, self.display_height)
+		))
+		self.tile_group.add(StencilPop())
+
+	# Returns the region of the full resolution image that is in view as
+	# (row0, row1, col0, col1) array indices, with exclusive ends. See the
+	# relative coordinate conversion functions for an explanation of the
+	# last_zoom values.
+	def getViewRegion(self):
+		view_w, view_h = self.img_size
+		if self.last_zoom is not None:
+			col0 = self.last_zoom[0]
+			row1 = self.last_zoom[2]
+		else:
+			col0 = 0
+			row1 = self.img_shape[0]
+
+		return row1 - view_h, row1, col0, col0 + view_w
+
+	# Sets the texture that is drawn over the image, or removes it if None.
+	# The texture covers the whole image. Only the part of it that is in 
+	# view is drawn.
+	def setOverlay(self, texture):
+		self.overlay_texture = texture
+		self._updateOverlay()
+
+	# Zooming only changes the texture coordinates of the overlay, so the 
+	# cost of this does not depend on what has been drawn into it.
+	def _updateOverlay(self):
+		self.overlay_group.clear()
+
+		if self.overlay_texture is None or not self.is_loaded:
+			return
+
+		row0, row1, col0, col1 = self.getViewRegion()
+		height, width          = self.img_shape[0], self.img_shape[1]
+
+		# Texture coordinates start at the bottom of the image.
+		u0 = col0 / width
+		u1 = col1 / width
+		v0 = (height - row1) / height
+		v1 = (height - row0) / height
+
+		self.overlay_group.add(Color(1, 1, 1, 1))
+		self.overlay_group.add(Rectangle(
+			texture=self.overlay_texture,
+			pos=(self.display_x, self.display_y),
+			size=(self.display_width, self.display_height),
+			tex_coords=(u0, v0, u1, v0, u1, v1, u0, v1)
+		))
+
+	def _getTileTexture(self, level, ty, tx):
+		key = (level, ty, tx)
+		if key in self.tile_textures:
+			self.tile_textures.move_to_end(key)
+			return self.tile_textures[key]
+
+		with span('ImagePyramid.getTile'):
+			tile = self.pyramid.getTile(level, ty, tx)
+
+		with span('ImageManager.bufferLayout'):
+			buffer = np.fliplr(np.rot90(np.rot90(self._displayArray(tile))))
+			buffer = memoryview(buffer.flatten())
+
+		with span('ImageManager.blit'):
+			texture = Texture.create(
+				size=(tile.shape[1], tile.shape[0]), 
+				colorfmt='bgr'
+			)
+			texture.blit_buffer(buffer, colorfmt='bgr', bufferfmt='ubyte')
+
+		self.tile_textures[key] = texture
+		if len(self.tile_textures) > self.max_tile_textures:
+			self.tile_textures.popitem(last=False)
+
+		return texture
+
+
+# Rasterizes every contour of an image into one RGBA texture, colored by
+# class, so that coverage can be checked at a glance. After the first 
+# rasterization only the rectangle touched by an edit is redrawn and 
+# uploaded. The mask is capped at max_size pixels on its longest side, since
+# it doesn't need to be more detailed than the screen.
+class MaskOverlay:
+	def __init__(self, alpha=110, max_size=4096):
+		self.alpha    = alpha
+		self.max_size = max_size
+		self.mask     = None
+		self.texture  = None
+
+	def setImageSize(self, width, height):
+		scale       = min(1.0, self.max_size / max(width, height))
+		self.width  = max(int(round(width  * scale)), 1)
+		self.height = max(int(round(height * scale)), 1)
+
+		self.mask    = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+		self.texture = Texture.create(
+			size=(self.width, self.height), colorfmt='rgba'
+		)
+
+	# Redraws the whole mask.
+	def rebuild(self, contours, classes):
+		region = rasterizeContours(self.mask, contours, self._classColors(classes))
+		self._upload(region)
+
+	# Redraws only the part of the mask covered by the given points (in 
+	# relative coordinates). This should be called with the points of any
+	# contour that was added, removed or changed class.
+	def updateRegion(self, contours, classes, points):
+		region = relativeBoundingRect(points, self.width, self.height)
+		region = rasterizeContours(
+			self.mask, contours, self._classColors(classes), region
+		)
+		self._upload(region)
+
+	def _classColors(self, classes):
+		colors = np.zeros((max(len(classes), 1), 4), dtype=np.uint8)
+		for idx, _class in enumerate(classes):
+			colors[idx, :3] = np.round(np.asarray(_class['color'][:3]) * 255)
+		colors[:, 3] = self.alpha
+
+		return colors
+
+	def _upload(self, region):
+		x0, y0, x1, y1 = region
+		if x1 <= x0 or y1 <= y0:
+			return
+
+		# Textures start at the bottom of the image, arrays at the top.
+		buffer = np.ascontiguousarray(self.mask[y0:y1, x0:x1][::-1])
+		self.texture.blit_buffer(
+			memoryview(buffer.reshape(-1)),
+			size=(x1 - x0, y1 - y0),
+			pos=(x0, self.height - y1),
+			colorfmt='rgba',
+			bufferfmt='ubyte'
+		)
+
 
 # High level class that contains buttons for zooming and reseting the current
 # view of an image. Also contains the more complicated child object that
@@ -593,17 +992,24 @@ class ImageDisplay(ButtonBehavior, CustomBoxLayout):
 			width=120
 		)
 
-		# This will store the geometry for any contours drawn on the image
-		# by the user. Each contour will be stored as 
-		# (color, [[x0, y0], [x1, y1, ...]])
-		# The image_manager object will internally manage the graphics
-		# objects necessary to draw these.
-		self.contours      = []
+		self.overlay_button = Button(
+			text='Show Mask',
+			size_hint_x=None,
+			size_hint_y=1,
+			width=120
+		)
+
+		# This is the ContourSet (see Contour.py) for the image being edited.
+		# Finished contours are appended to it directly. The image_manager 
+		# object will internally manage the graphics objects necessary to
+		# draw these.
+		self.contours      = None
 		self.current_entry = None
 
 		self.toolbar.add_widget(self.zoom_button)
 		self.toolbar.add_widget(self.reset_button)
 		self.toolbar.add_widget(self.contour_button)
+		self.toolbar.add_widget(self.overlay_button)
 
 		self.add_widget(self.toolbar)
 
@@ -619,6 +1025,7 @@ class ImageDisplay(ButtonBehavior, CustomBoxLayout):
 		self.zoom_button.bind(on_press=self._zoom_pressed)
 		self.reset_button.bind(on_press=self._reset_pressed)
 		self.contour_button.bind(on_press=self._contour_pressed)
+		self.overlay_button.bind(on_press=self._overlay_pressed)
 
 		self.is_zooming         = False
 		self.is_editing_contour = False
@@ -636,15 +1043,62 @@ class ImageDisplay(ButtonBehavior, CustomBoxLayout):
 		self.dataset       = None
 		self.current_entry = None
 
+		# Textures for recently viewed images, keyed by their key in the 
+		# dataset. This makes flipping back and forth between images cheap.
+		self.texture_cache = TextureCache()
+
+		# The lease on the pixel data of the image that is currently being
+		# displayed. It is released once another image has replaced it.
+		self.image_lease = None
+
+		# The filled mask overlay. overlay_key is the key of the image that
+		# the mask was rasterized for. While it matches the current image, 
+		# edits update the mask even when it is hidden, so that showing it
+		# again doesn't require rasterizing every contour.
+		self.overlay      = MaskOverlay()
+		self.show_overlay = False
+		self.overlay_key  = None
+
 	def _reset_pressed(self, inst):
 		self.image_manager.reset()
 
+	def _overlay_pressed(self, inst):
+		self.show_overlay = not self.show_overlay
+
+		if self.show_overlay:
+			self.overlay_button.text = 'Hide Mask'
+			if self.current_entry is not None:
+				if self.overlay_key != self.current_key:
+					self._rebuildOverlay()
+				self.image_manager.setOverlay(self.overlay.texture)
+		else:
+			self.overlay_button.text = 'Show Mask'
+			self.image_manager.setOverlay(None)
+
+	@traced('ImageDisplay.rebuildOverlay')
+	def _rebuildOverlay(self):
+		shape = self.image_manager.img_shape
+		self.overlay.setImageSize(shape[1], shape[0])
+		self.overlay.rebuild(
+			self.contours, self.dataset.meta_structure['classes']
+		)
+		self.overlay_key = self.current_key
+
+	# Redraws the part of the overlay covered by the given points, if the
+	# overlay is current.
+	def _updateOverlayRegion(self, points):
+		if self.overlay_key is not None and self.overlay_key == self.current_key:
+			self.overlay.updateRegion(
+				self.contours, self.dataset.meta_structure['classes'], points
+			)
+
 	def _contour_pressed(self, inst):
 		if self.is_editing_contour:
 			self.finishContour()
 		else:
 			self.newContour()
 
+	@traced('ImageDisplay.finishContour')
 	def finishContour(self):
 		# This closes the contour.
 		self.addPointToContour(*self.current_contour[0])
@@ -652,42 +1106,45 @@ class ImageDisplay(ButtonBehavior, CustomBoxLayout):
 		self.is_editing_contour  = False
 		self.contour_on_stack    = False
 		self.contour_button.text = 'New Contour'
-		self.contours.append((self.contour_color, self.current_contour))
 
-	def newContour(self, load=False, color=None):
-		self.is_editing_contour    = True
-		self.contour_button.text   = 'Close Contour'
-		self.current_contour       = []
-		
+		# New contours always start out with the first class.
+		self.contours.append(Contour(self.current_contour, 0))
 
-		if not load:
-			# We need to add this into the class summary as well.
-			self.parent.parent.class_summary.addContour({
-				'class_idx' : 0,
-				'name'      : '',
-				'comment'   : ''
-			})
+		# The image manager should reference the stored points, rather than
+		# the list that was used while editing.
+		self.image_manager.lines[-1] = self.contours.getPoints(len(self.contours) - 1)
 
-			self.contour_color = self.dataset.meta_structure['classes'][0]['color']
-		else:
-			self.contour_color = color
+		# We need to add this into the class summary as well.
+		self.parent.parent.class_summary.addContour(len(self.contours) - 1)
+
+		self._updateOverlayRegion(self.current_contour)
 
+	def newContour(self):
+		self.is_editing_contour    = True
+		self.contour_button.text   = 'Close Contour'
+		self.current_contour       = []
+		self.contour_color         = self.dataset.meta_structure['classes'][0]['color']
 
 	def clearContours(self):
-		self.contours           = []
+		self.contours           = None
 		self.current_contour    = []
 		self.is_editing_contour = False
+		self.contour_on_stack   = False
 		self.image_manager.clearLines()
 
 	def setContourColor(self, index, color):
 		self.image_manager.setContourColor(index, color)
+		self._updateOverlayRegion(self.contours.getPoints(index))
 
 
+	@traced('ImageDisplay.addPointToContour')
 	def addPointToContour(self, x, y):
 		if not self.is_editing_contour:
 			raise Exception("There is no contour being edited.")
 
-		self.current_contour.append([x, y])
+		# Points are rounded to float32 precision so that the contour can be
+		# stored compactly.
+		self.current_contour.append([snapCoordinate(x), snapCoordinate(y)])
 
 		if self.contour_on_stack:
 			self.image_manager.popLine()
@@ -712,35 +1169,112 @@ class ImageDisplay(ButtonBehavior, CustomBoxLayout):
 		if self.current_entry is None:
 			raise Exception("Nothing is currently being edited.")
 
-		self.dataset.meta_structure['entries'][self.current_key] = []
-		for contour in self.contours:
-			self.dataset.meta_structure['entries'][self.current_key].append({
-				'geometry': contour[1]
-			})
+		# Contours are only added to the set once they are closed, so a
+		# contour that is still being drawn is not written.
+		self.dataset.updateEntry(self.current_key, self.contours)
+
+	# Changes the brightness and contrast of the image being displayed (see
+	# DisplayWindow.setAdjustment). The image isn't decoded or copied again,
+	# only the part of it that is in view is mapped and uploaded.
+	def setDisplayAdjustment(self, brightness, contrast):
+		if self.current_entry is None:
+			return
+
+		window = self.image_manager.display_window
+		window.setAdjustment(brightness, contrast)
 
+		self.texture_cache.remove(self.current_key)
+		self.image_manager.refreshDisplayWindow()
 
+		base_texture = self.image_manager.base_texture
+		if not self.image_manager.is_tiled and base_texture is not None:
+			self.texture_cache.put(
+				self.current_key,
+				base_texture,
+				TextureCache.textureBytes(base_texture.width, base_texture.height)
+			)
+
+	# The image manager no longer references the pixels of the previous
+	# image once it has been given a new one, so the previous lease can be
+	# released (which lets its slot be reused).
+	def _replaceLease(self, lease):
+		if self.image_lease is not None:
+			self.image_lease.release()
+		self.image_lease = lease
+
+	# Acquires the pixels of an image that was displayed from a cached 
+	# texture, when the image manager first needs them.
+	def _acquirePixels(self, key):
+		lease = self.dataset.acquireImage(key)
+		self._replaceLease(lease)
+		return lease.array
+
+	@traced('ImageDisplay.setImage')
 	def setImage(self, img, dataset):
 		if self.current_entry is not None:
 			self.clearContours()
 
+		# Keys are only meaningful within a single dataset.
+		if dataset is not self.dataset:
+			self.texture_cache.clear()
+
 		self.dataset = dataset
-		self.image_manager.setImage(self.dataset.images[img])
+
+		# Switching back to an image whose texture is still cached only
+		# requires binding the texture again. The pixels are acquired later,
+		# if zooming or changing the display window needs them.
+		texture = self.texture_cache.get(img)
+		window  = self.dataset.display_windows.get(img)
+		if texture is not None and window is not None:
+			self.image_manager.setImage(
+				None,
+				texture=texture,
+				window=window,
+				shape=self.dataset.getImageShape(img),
+				loader=lambda: self._acquirePixels(img)
+			)
+			self._replaceLease(None)
+		else:
+			lease  = self.dataset.acquireImage(img)
+			image  = lease.array
+			window = self.dataset.getDisplayWindow(img, image)
+
+			# Very large images are displayed with tiles. The dataset keeps a
+			# cached pyramid for those so that it isn't rebuilt on every view.
+			if self.image_manager.shouldTile(image.shape):
+				self.image_manager.setImage(
+					image, 
+					self.dataset.getPyramid(img, self.image_manager.tile_size, image),
+					window=window
+				)
+			else:
+				self.image_manager.setImage(image, window=window)
+				self.texture_cache.put(
+					img, 
+					self.image_manager.base_texture,
+					TextureCache.textureBytes(image.shape[1], image.shape[0])
+				)
+
+			self._replaceLease(lease)
 
 		# Now we load the contour information out of the structure 
 		# (if there is any), and add it. 
 		self.current_entry = self.dataset.meta_structure['entries'][img]
 		self.current_key   = img
-
-		
-		# Add each of these to the internal structure, and therefore the
-		# image display.
-		for contour in self.current_entry:
-			idx   = contour['class_idx']
-			color = self.dataset.meta_structure['classes'][idx]['color']
-			self.newContour(load=True, color=color)
-			for point in contour['geometry']:
-				self.addPointToContour(*point)
-			self.finishContour()
+		self.contours      = self.current_entry
+
+		# Each contour only needs to be handed to the image display once. The
+		# points are views into the vertex array of the set.
+		classes = self.dataset.meta_structure['classes']
+		with span('ImageDisplay.pushContours'):
+			for idx in range(len(self.contours)):
+				color = classes[self.contours.class_idx[idx]]['color']
+				self.image_manager.pushLine(color, self.contours.getPoints(idx))
+
+		self.overlay_key = None
+		if self.show_overlay:
+			self._rebuildOverlay()
+			self.image_manager.setOverlay(self.overlay.texture)
 
 
 
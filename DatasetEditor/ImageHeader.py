@@ -0,0 +1,188 @@
+# Author:      Adam Robinson
+# Description: This file reads the dimensions of an image from its header,
+#              without decoding it. Only the few bytes of the file that hold
+#              the dimensions are read, so this is fast enough to run on
+#              every image in a dataset before deciding whether it will fit
+#              in memory. It also lists the pages of multi-page tiff files.
+#
+#              Like cv2, the size of a jpeg is the size after its EXIF
+#              orientation is applied, so images rotated by 90 degrees have
+#              their width and height swapped.
+
+import re
+import struct
+
+# Images in a multi-page tiff are referred to by the path (or key) of the
+# file with the index of the page appended, e.g. 'stack.tif#3'.
+_page_pattern = re.compile(r'^(.*\.tiff?)#(\d+)$', re.IGNORECASE)
+
+# Splits a path into the path of the file and the page index, which is None
+# if the path doesn't refer to a page.
+def splitPage(path):
+	match = _page_pattern.match(path)
+	if match is None:
+		return path, None
+
+	return match.group(1), int(match.group(2))
+
+def pagePath(path, page):
+	return '%s#%d'%(path, page)
+
+# Returns (height, width) for a png, jpeg, bmp or tiff file, or a page of a
+# tiff file, or None if the format isn't recognized or the header is
+# damaged.
+def readImageSize(path):
+	path, page = splitPage(path)
+	page       = 0 if page is None else page
+
+	try:
+		with open(path, 'rb') as file:
+			head = file.read(32)
+
+			if head.startswith(b'\x89PNG\r\n\x1a\n'):
+				width, height = struct.unpack('>II', head[16:24])
+				return (height, width)
+
+			if head.startswith(b'BM'):
+				width, height = struct.unpack('<ii', head[18:26])
+				return (abs(height), width)
+
+			if head.startswith(b'\xff\xd8'):
+				file.seek(2)
+				size, orientation = _jpegHeader(file)
+				if size is not None and orientation >= 5:
+					return (size[1], size[0])
+				return size
+
+			if head[:4] in (b'II*\x00', b'MM\x00*'):
+				file.seek(0)
+				pages = _tiffPages(file, max_pages=page + 1)
+				if pages is None or len(pages) <= page:
+					return None
+				return pages[page]
+	except (OSError, struct.error):
+		return None
+
+	return None
+
+# Returns the EXIF orientation (1 to 8) of a jpeg file, or 1 if it has none
+# or isn't a jpeg. 1 means the image is stored upright.
+def readOrientation(path):
+	try:
+		with open(path, 'rb') as file:
+			if file.read(2) != b'\xff\xd8':
+				return 1
+			return _jpegHeader(file)[1]
+	except (OSError, struct.error):
+		return 1
+
+# Walks the jpeg markers until a start of frame marker is found. Returns
+# ((height, width), orientation), where the size is None if no start of
+# frame was found. The EXIF segment always comes before the frame.
+def _jpegHeader(file):
+	orientation = 1
+	while True:
+		marker = file.read(2)
+		if len(marker) < 2 or marker[0] != 0xff:
+			return None, orientation
+
+		# Padding bytes.
+		while marker[1] == 0xff:
+			marker = marker[1:] + file.read(1)
+
+		code = marker[1]
+		if code in (0xd8, 0x01) or 0xd0 <= code <= 0xd7:
+			continue
+
+		length = struct.unpack('>H', file.read(2))[0]
+
+		# Every start of frame marker, excluding DHT (c4), JPG (c8) and
+		# DAC (cc).
+		if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+			height, width = struct.unpack('>xHH', file.read(5))
+			return (height, width), orientation
+
+		# APP1, which holds the EXIF data.
+		if code == 0xe1:
+			segment = file.read(length - 2)
+			if segment.startswith(b'Exif\x00\x00'):
+				orientation = _exifOrientation(segment[6:])
+			continue
+
+		file.seek(length - 2, 1)
+
+# Finds the orientation tag (274) in the first image directory of the tiff
+# structure that EXIF data is stored in. Returns 1 if it is missing or
+# damaged.
+def _exifOrientation(data):
+	try:
+		order  = '<' if data[:2] == b'II' else '>'
+		offset = struct.unpack(order + 'I', data[4:8])[0]
+		n_tags = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+
+		for i in range(n_tags):
+			entry = data[offset + 2 + i * 12:offset + 14 + i * 12]
+			tag   = struct.unpack(order + 'H', entry[:2])[0]
+			if tag == 274:
+				value = struct.unpack(order + 'H', entry[8:10])[0]
+				return value if 1 <= value <= 8 else 1
+	except struct.error:
+		pass
+
+	return 1
+
+# Returns [(height, width)] for every page of a tiff file, by following the
+# chain of image directories. Only the directories are read, none of the
+# image data. Returns None if the file isn't a (classic, not BigTIFF) tiff.
+def readTiffPages(path):
+	try:
+		with open(path, 'rb') as file:
+			head = file.read(4)
+			if head not in (b'II*\x00', b'MM\x00*'):
+				return None
+
+			file.seek(0)
+			return _tiffPages(file)
+	except (OSError, struct.error):
+		return None
+
+# Follows the chain of image directories, stopping after max_pages of them
+# if it is given.
+def _tiffPages(file, max_pages=None):
+	order  = '<' if file.read(2) == b'II' else '>'
+	file.seek(4)
+	offset = struct.unpack(order + 'I', file.read(4))[0]
+
+	pages   = []
+	visited = set()
+	while offset != 0 and offset not in visited:
+		if max_pages is not None and len(pages) == max_pages:
+			break
+
+		# A damaged file could point back at an earlier directory.
+		visited.add(offset)
+
+		file.seek(offset)
+		n_tags  = struct.unpack(order + 'H', file.read(2))[0]
+		entries = file.read(n_tags * 12)
+		offset  = struct.unpack(order + 'I', file.read(4))[0]
+
+		size = {}
+		for i in range(n_tags):
+			entry = entries[i * 12:(i + 1) * 12]
+			tag, _type = struct.unpack(order + 'HH', entry[:4])
+
+			# 256 is ImageWidth and 257 is ImageLength. Either can be a short
+			# (3) or a long (4).
+			if tag in (256, 257):
+				if _type == 3:
+					size[tag] = struct.unpack(order + 'H', entry[8:10])[0]
+				else:
+					size[tag] = struct.unpack(order + 'I', entry[8:12])[0]
+
+		if 256 not in size or 257 not in size:
+			return None
+
+		pages.append((size[257], size[256]))
+
+	return pages
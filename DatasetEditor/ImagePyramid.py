@@ -0,0 +1,183 @@
+# Author:      Adam Robinson
+# Description: This class builds a multi-resolution pyramid of an image and
+#              cuts each level into fixed size tiles. It allows images that
+#              are too large for a single texture to be displayed one piece
+#              at a time, at a resolution that matches the display.
+
+import os
+import cv2
+import numpy as np
+
+# Images with more pixels than this are displayed with tiles, even if they
+# would fit in a single texture.
+tile_pixel_threshold = 64 * 1024 * 1024
+
+# A texture size that every desktop GPU supports. The editor uses it when the
+# driver doesn't report its GL_MAX_TEXTURE_SIZE, and the commands in
+# DatasetCLI.py, which can't query the driver, use it to decide which images
+# need pyramids. Being conservative means that they may build a pyramid that
+# the editor doesn't need, but never skip one that it does.
+default_max_texture_size = 4096
+
+# Returns True if the editor displays an image with the given shape with
+# tiles (and so needs its pyramid). That is the case when the image is
+# larger than the largest texture the graphics driver accepts, or when it
+# has more than pixel_threshold pixels. Pyramids for other images are never
+# read, so there's no point in building them.
+def needsTiles(shape, max_texture_size, pixel_threshold=tile_pixel_threshold):
+	if max(shape[0], shape[1]) > max_texture_size:
+		return True
+
+	return shape[0] * shape[1] > pixel_threshold
+
+# Level 0 of the pyramid is the original image. Every level after that is
+# half the width and height of the previous one. Levels are only built when
+# they are first requested. If a cache path is provided, levels are written
+# to it as .npy files and memory mapped on subsequent loads, so that the
+# (slow) downsampling only ever happens once per image.
+class ImagePyramid:
+	def __init__(self, img, tile_size=512, cache_path=None):
+		self.tile_size  = tile_size
+		self.cache_path = cache_path
+		self.shape      = img.shape
+
+		self.n_levels = ImagePyramid.countLevels(img.shape, tile_size)
+		self.levels   = [img] + [None] * (self.n_levels - 1)
+
+	# Returns the number of levels in the pyramid of an image with the given
+	# shape. Levels are halved until the whole image fits in a single tile.
+	@staticmethod
+	def countLevels(shape, tile_size):
+		h, w     = shape[0], shape[1]
+		n_levels = 1
+		while max(h, w) > tile_size:
+			h, w = (h + 1) // 2, (w + 1) // 2
+			n_levels += 1
+
+		return n_levels
+
+	# Returns True if every downsampled level of the pyramid of an image with
+	# the given shape is already in the cache.
+	@staticmethod
+	def isCached(shape, tile_size, cache_path):
+		return all(
+			os.path.isfile(os.path.join(cache_path, 'level_%d.npy'%level))
+			for level in range(1, ImagePyramid.countLevels(shape, tile_size))
+		)
+
+	# Returns the image array for the requested level, building it (and any
+	# levels above it) if necessary.
+	def getLevel(self, level):
+		if self.levels[level] is None:
+			arr = self._loadLevel(level)
+			if arr is None:
+				previous = self.getLevel(level - 1)
+				arr      = cv2.resize(
+					previous,
+					((previous.shape[1] + 1) // 2, (previous.shape[0] + 1) // 2),
+					interpolation=cv2.INTER_AREA
+				)
+				self._saveLevel(level, arr)
+
+			self.levels[level] = arr
+
+		return self.levels[level]
+
+	# Builds every level. This is used to warm the cache ahead of time.
+	def buildAll(self):
+		for level in range(1, self.n_levels):
+			self.getLevel(level)
+
+	# Returns the number of bytes held in memory by the downsampled levels.
+	# Levels that are memory mapped from the cache are paged in and out by
+	# the operating system, so they aren't counted. The first level is the
+	# image itself, which belongs to whoever created the pyramid.
+	def residentBytes(self):
+		return sum(
+			level.nbytes for level in self.levels[1:]
+			if level is not None and not isinstance(level, np.memmap)
+		)
+
+	# Given the number of image pixels that each screen pixel covers,
+	# returns the coarsest level that still has at least one pixel per
+	# screen pixel.
+	def levelForScale(self, scale):
+		if scale <= 1:
+			return 0
+
+		level = int(np.floor(np.log2(scale)))
+		return min(level, self.n_levels - 1)
+
+	# Returns the bounds of a tile in full resolution array indices as
+	# (row0, row1, col0, col1). The end indices are exclusive.
+	def tileBounds(self, level, ty, tx):
+		factor = (2 ** level) * self.tile_size
+		row0   = ty * factor
+		col0   = tx * factor
+		row1   = min(row0 + factor, self.shape[0])
+		col1   = min(col0 + factor, self.shape[1])
+
+		return row0, row1, col0, col1
+
+	# Returns (ty, tx) for every tile of the given level that overlaps the
+	# region [row0, row1), [col0, col1), specified in full resolution array
+	# indices.
+	def tilesInRegion(self, level, row0, row1, col0, col1):
+		factor = (2 ** level) * self.tile_size
+
+		row0 = max(int(row0), 0)
+		col0 = max(int(col0), 0)
+		row1 = min(int(np.ceil(row1)), self.shape[0])
+		col1 = min(int(np.ceil(col1)), self.shape[1])
+
+		tiles = []
+		for ty in range(row0 // factor, (max(row1, row0 + 1) - 1) // factor + 1):
+			for tx in range(col0 // factor, (max(col1, col0 + 1) - 1) // factor + 1):
+				tiles.append((ty, tx))
+
+		return tiles
+
+	# Returns the pixel data for a single tile at the resolution of its
+	# level.
+	def getTile(self, level, ty, tx):
+		arr  = self.getLevel(level)
+		row0 = ty * self.tile_size
+		col0 = tx * self.tile_size
+
+		return arr[row0:row0 + self.tile_size, col0:col0 + self.tile_size]
+
+	def _levelPath(self, level):
+		return os.path.join(self.cache_path, 'level_%d.npy'%level)
+
+	def _loadLevel(self, level):
+		if self.cache_path is None:
+			return None
+
+		path = self._levelPath(level)
+		if not os.path.isfile(path):
+			return None
+
+		try:
+			return np.load(path, mmap_mode='r')
+		except Exception:
+			# A corrupt cache file is not fatal, the level will just be
+			# rebuilt and the file overwritten.
+			return None
+
+	def _saveLevel(self, level, arr):
+		if self.cache_path is None:
+			return
+
+		# Write to a temporary file and rename it so that a partially
+		# written level is never picked up by another process.
+		try:
+			os.makedirs(self.cache_path, exist_ok=True)
+			path     = self._levelPath(level)
+			tmp_path = path + '.%d.tmp'%os.getpid()
+			with open(tmp_path, 'wb') as file:
+				np.save(file, arr)
+			os.replace(tmp_path, path)
+		except OSError:
+			# The cache is optional (see DatasetCache.py). The levels are
+			# kept in memory instead.
+			self.cache_path = None
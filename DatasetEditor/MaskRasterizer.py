@@ -0,0 +1,153 @@
+# Author:      Adam Robinson
+# Description: This file contains functions for rasterizing the contours of
+#              an image into a mask. It doesn't depend on kivy, so it is used
+#              both by the editor overlay and by the headless exporters.
+
+import cv2
+import numpy as np
+
+# Number of fractional bits used for the points passed to cv2.fillPoly.
+# This keeps contours accurate to 1/16th of a pixel.
+_shift = 4
+
+# Converts relative coordinates (see ImageDisplay.py) into fixed point
+# pixel coordinates with the origin at the top left of the image.
+def relativeToFixedPoint(points, width, height):
+	scale  = float(1 << _shift)
+	pixels = np.empty(points.shape, dtype=np.int32)
+
+	pixels[:, 0] = np.round(points[:, 0] * (width * scale))
+	pixels[:, 1] = np.round((1.0 - points[:, 1]) * (height * scale))
+
+	return pixels
+
+# Returns the pixel rectangle (x0, y0, x1, y1) covered by the given relative
+# coordinates, padded by a pixel on every side and clipped to the image.
+def relativeBoundingRect(points, width, height):
+	points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+	if points.shape[0] == 0:
+		return (0, 0, 0, 0)
+
+	x0 = int(np.floor(points[:, 0].min() * width)) - 1
+	x1 = int(np.ceil(points[:, 0].max() * width)) + 2
+	y0 = int(np.floor((1.0 - points[:, 1].max()) * height)) - 1
+	y1 = int(np.ceil((1.0 - points[:, 1].min()) * height)) + 2
+
+	return (max(x0, 0), max(y0, 0), min(x1, width), min(y1, height))
+
+# Returns the indices of the contours that have any points, the fixed point
+# pixel coordinates of every vertex and the pixel bounding box 
+# (x0, y0, x1, y1) of each of the selected contours.
+def _pixelBounds(contours, width, height):
+	selected = np.nonzero(contours.lengths() > 0)[0]
+	if selected.shape[0] == 0:
+		empty = np.zeros(0, dtype=np.int32)
+		return selected, None, (empty, empty, empty, empty)
+
+	pixels = relativeToFixedPoint(contours.vertices, width, height)
+	starts = contours.offsets[selected]
+
+	bx0 = np.minimum.reduceat(pixels[:, 0], starts) >> _shift
+	by0 = np.minimum.reduceat(pixels[:, 1], starts) >> _shift
+	bx1 = (np.maximum.reduceat(pixels[:, 0], starts) >> _shift) + 2
+	by1 = (np.maximum.reduceat(pixels[:, 1], starts) >> _shift) + 2
+
+	return selected, pixels, (bx0, by0, bx1, by1)
+
+# cv2.fillPoly doesn't produce exactly the same pixels when a polygon is
+# translated or clipped. Each contour is always drawn into a buffer covering
+# just its own bounding box, so that it comes out the same no matter which
+# region of a mask is being drawn.
+def _fillLocal(polygon, bx0, by0, bx1, by1):
+	local   = np.zeros((by1 - by0, bx1 - bx0), dtype=np.uint8)
+	polygon = polygon - np.array([bx0 << _shift, by0 << _shift], dtype=np.int32)
+	cv2.fillPoly(local, [polygon], 1, cv2.LINE_8, _shift)
+
+	return local
+
+# Fills every contour in a ContourSet into mask. values is indexed by class
+# index and gives the value to fill with (a scalar for single channel masks
+# or a row of channel values). Pixels not covered by any contour are set to
+# zero.
+#
+# If region (x0, y0, x1, y1) is specified, only that rectangle of the mask
+# is cleared and redrawn, and only contours that overlap it are drawn. The
+# redrawn rectangle is returned.
+#
+# Contours are drawn in order, so later contours cover earlier ones. Each one
+# is filled separately, since cv2.fillPoly would cut holes where polygons
+# passed in the same call overlap. Redrawing a region produces exactly the
+# same pixels as redrawing the whole mask.
+def rasterizeContours(mask, contours, values, region=None):
+	height, width = mask.shape[0], mask.shape[1]
+	if region is None:
+		region = (0, 0, width, height)
+
+	x0, y0, x1, y1 = region
+	target = np.zeros((y1 - y0, x1 - x0) + mask.shape[2:], dtype=mask.dtype)
+
+	selected, pixels, (bx0, by0, bx1, by1) = _pixelBounds(contours, width, height)
+
+	if selected.shape[0] > 0 and target.size > 0:
+		# Only contours that overlap the region are drawn.
+		inside = (bx1 > x0) & (bx0 < x1) & (by1 > y0) & (by0 < y1)
+
+		# Converting the fill values up front keeps the loop below down to a
+		# single fill per contour.
+		fill_values = [np.asarray(v, dtype=mask.dtype) for v in values]
+
+		offsets = contours.offsets
+		for j in np.nonzero(inside)[0]:
+			i = selected[j]
+
+			local = _fillLocal(
+				pixels[offsets[i]:offsets[i + 1]], bx0[j], by0[j], bx1[j], by1[j]
+			)
+
+			ix0, iy0 = max(bx0[j], x0), max(by0[j], y0)
+			ix1, iy1 = min(bx1[j], x1), min(by1[j], y1)
+
+			covered = local[
+				iy0 - by0[j]:iy1 - by0[j], 
+				ix0 - bx0[j]:ix1 - bx0[j]
+			].astype(bool)
+			target[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0][covered] = fill_values[
+				contours.class_idx[i]
+			]
+
+	mask[y0:y1, x0:x1] = target
+
+	return region
+
+# Builds a single channel mask where each pixel is the class index of the
+# contour covering it plus one, or zero for the background.
+def classMask(contours, width, height, dtype=np.uint16):
+	mask   = np.zeros((height, width), dtype=dtype)
+	n      = int(contours.class_idx.max(initial=-1)) + 1
+	values = np.arange(1, n + 1)
+	rasterizeContours(mask, contours, values)
+
+	return mask
+
+# Rasterizes each contour in a ContourSet on its own, into a mask covering
+# just its bounding box. Yields (idx, x0, y0, mask) for every contour with
+# any points, where mask is a uint8 array of zeros and ones with its top
+# left corner at (x0, y0) in the image. Masks are clipped to the image and
+# have the same pixels that rasterizeContours fills for the contour.
+def contourMasks(contours, width, height):
+	selected, pixels, (bx0, by0, bx1, by1) = _pixelBounds(contours, width, height)
+
+	offsets = contours.offsets
+	for j, i in enumerate(selected):
+		local = _fillLocal(
+			pixels[offsets[i]:offsets[i + 1]], bx0[j], by0[j], bx1[j], by1[j]
+		)
+
+		ix0, iy0 = max(bx0[j], 0), max(by0[j], 0)
+		ix1, iy1 = min(bx1[j], width), min(by1[j], height)
+		ix1, iy1 = max(ix1, ix0), max(iy1, iy0)
+
+		yield int(i), int(ix0), int(iy0), local[
+			iy0 - by0[j]:iy1 - by0[j], 
+			ix0 - bx0[j]:ix1 - bx0[j]
+		]
@@ -0,0 +1,371 @@
+# Author:      Adam Robinson
+# Description: This file cuts the images in a dataset into fixed size,
+#              overlapping patches for training, along with the matching
+#              class masks (see MaskRasterizer.classMask). Each image is
+#              decoded once and its contours are rasterized once, no matter
+#              how many patches are taken from it. It doesn't depend on kivy,
+#              so it is run headlessly (see the export-patches command in
+#              DatasetCLI.py).
+#
+#              The patches are written to shard files that each hold a fixed
+#              number of patches, so that training code can read them
+#              sequentially. The layout of the output directory is:
+#
+#                  index.json
+#                  shard-<worker>-<n>.images.npy - (N, size, size, C)
+#                  shard-<worker>-<n>.masks.npy  - (N, size, size) uint16
+#
+#              index.json lists every shard along with the key, position and
+#              foreground fraction of each patch in it. Every shard holds
+#              shard_size patches, except for the last shard written by each
+#              worker process. Images with a different dtype or number of
+#              channels than the patches already in a shard also start a new
+#              one, so every shard has a single dtype and channel count.
+
+import os
+import json
+import queue
+import numpy as np
+import multiprocessing as mp
+
+# How long to wait for a reply before checking that the worker processes
+# are still running, in seconds.
+_reply_timeout = 1.0
+
+# Returns the positions of the windows along an axis of the given length.
+# The last window is always flush with the end of the axis, so every pixel
+# is covered even when the stride doesn't divide the length.
+def _windowStarts(length, size, stride):
+	if length <= size:
+		return np.zeros(1, dtype=np.int64)
+
+	starts = np.arange(0, length - size + 1, stride, dtype=np.int64)
+	if starts[-1] != length - size:
+		starts = np.append(starts, length - size)
+
+	return starts
+
+# Returns the (x, y) position and foreground fraction of every window of an
+# image that has at least min_foreground of its pixels covered by a
+# contour. The fractions of all windows are computed at once from an
+# integral image of the mask.
+def selectWindows(mask, size, stride, min_foreground):
+	import cv2
+
+	integral = cv2.integral((mask > 0).astype(np.uint8), sdepth=cv2.CV_64F)
+
+	xs = _windowStarts(mask.shape[1], size, stride)
+	ys = _windowStarts(mask.shape[0], size, stride)
+	x, y = np.meshgrid(xs, ys)
+	x, y = x.ravel(), y.ravel()
+
+	x1 = np.minimum(x + size, mask.shape[1])
+	y1 = np.minimum(y + size, mask.shape[0])
+
+	covered = (
+		integral[y1, x1] - integral[y, x1] -
+		integral[y1, x] + integral[y, x]
+	)
+	foreground = covered / (size * size)
+
+	keep = foreground >= min_foreground
+	return x[keep], y[keep], foreground[keep]
+
+# Accumulates the patches cut by one worker process and writes them out a
+# shard at a time.
+class _ShardWriter:
+	def __init__(self, output, worker, size, shard_size):
+		self.output     = output
+		self.worker     = worker
+		self.size       = size
+		self.shard_size = shard_size
+
+		self.n_shards = 0
+		self.images   = None
+		self.masks    = None
+		self.patches  = []
+
+	# Adds the patches of an image at the given positions. Returns the index
+	# entries of any shards that were written.
+	def add(self, key, img, mask, x, y, foreground):
+		if img.ndim == 2:
+			img = img[:, :, None]
+
+		records = []
+		if self.images is not None and (
+			self.images.dtype != img.dtype or self.images.shape[3] != img.shape[2]
+		):
+			record = self.flush()
+			if record is not None:
+				records.append(record)
+
+		if self.images is None:
+			self.images = np.zeros(
+				(self.shard_size, self.size, self.size, img.shape[2]),
+				dtype=img.dtype
+			)
+			self.masks = np.zeros(
+				(self.shard_size, self.size, self.size), dtype=mask.dtype
+			)
+
+		for i in range(x.shape[0]):
+			row = len(self.patches)
+
+			# Patches of images smaller than the patch size are zero padded.
+			region = (slice(y[i], y[i] + self.size), slice(x[i], x[i] + self.size))
+			patch  = img[region]
+			h, w   = patch.shape[:2]
+
+			if h < self.size or w < self.size:
+				self.images[row] = 0
+				self.masks[row]  = 0
+
+			self.images[row, :h, :w] = patch
+			self.masks[row, :h, :w]  = mask[region]
+
+			self.patches.append((key, int(x[i]), int(y[i]), float(foreground[i])))
+			if len(self.patches) == self.shard_size:
+				records.append(self.flush())
+
+		return records
+
+	# Writes the current shard, even if it isn't full, and returns its entry
+	# in the index. Returns None if the shard is empty.
+	def flush(self):
+		if len(self.patches) == 0:
+			self.images = None
+			self.masks  = None
+			return None
+
+		n    = len(self.patches)
+		name = 'shard-%02d-%05d'%(self.worker, self.n_shards)
+		self.n_shards += 1
+
+		images_file = name + '.images.npy'
+		masks_file  = name + '.masks.npy'
+		_saveArray(os.path.join(self.output, images_file), self.images[:n])
+		_saveArray(os.path.join(self.output, masks_file), self.masks[:n])
+
+		record = {
+			'images'     : images_file,
+			'masks'      : masks_file,
+			'n_patches'  : n,
+			'dtype'      : self.images.dtype.name,
+			'channels'   : self.images.shape[3],
+			'keys'       : [p[0] for p in self.patches],
+			'x'          : [p[1] for p in self.patches],
+			'y'          : [p[2] for p in self.patches],
+			'foreground' : [p[3] for p in self.patches]
+		}
+
+		self.patches = []
+		if n < self.shard_size:
+			# A partial shard is only written when the dtype or channel count
+			# changes or the worker is finished, so the buffers won't be
+			# reused.
+			self.images = None
+			self.masks  = None
+
+		return record
+
+# Written to a temporary file first, so that an interrupted export never
+# leaves a truncated shard behind.
+def _saveArray(path, arr):
+	tmp_path = path + '.%d.tmp'%os.getpid()
+	with open(tmp_path, 'wb') as file:
+		np.save(file, arr)
+	os.replace(tmp_path, path)
+
+# The main function of a worker process. Requests are (key, path, contours)
+# and None tells the worker to write its last shard and exit. Replies are
+# ('image', key, n_patches, error), ('shard', record) and ('done', worker).
+def _workerMain(worker, output, size, stride, min_foreground, shard_size,
+	            requests, replies):
+	import cv2
+	cv2.setNumThreads(1)
+
+	from ImageDecoders  import decodeImage
+	from MaskRasterizer import classMask
+
+	writer = _ShardWriter(output, worker, size, shard_size)
+
+	while True:
+		request = requests.get()
+		if request is None:
+			break
+
+		key, path, contours = request
+		try:
+			img = decodeImage(path)
+			if img is None:
+				raise Exception("Could not load file \'%s\'"%path)
+
+			height, width = img.shape[:2]
+			mask    = classMask(contours, width, height, dtype=np.uint16)
+			x, y, f = selectWindows(mask, size, stride, min_foreground)
+
+			for record in writer.add(key, img, mask, x, y, f):
+				replies.put(('shard', record))
+
+			replies.put(('image', key, int(x.shape[0]), None))
+		except Exception as ex:
+			replies.put(('image', key, 0, str(ex)))
+
+	record = writer.flush()
+	if record is not None:
+		replies.put(('shard', record))
+
+	replies.put(('done', worker))
+
+# Cuts the given images of a dataset (all images with an entry in meta.json
+# by default) into size x size patches, taken every stride pixels. Patches
+# with less than min_foreground of their pixels covered by a contour are
+# skipped. Writes the shards and index.json into output and returns the
+# index. progress_callback(n_done, n_images) is called after each image.
+# Raises an exception if a worker process dies.
+def exportPatches(dataset, output, size=256, stride=None, min_foreground=0.0,
+	              shard_size=1024, processes=None, keys=None,
+	              progress_callback=None):
+	from Contour import ContourSet
+
+	stride    = size if stride is None else stride
+	processes = os.cpu_count() if processes is None else processes
+	entries   = dataset.meta_structure['entries']
+	keys      = list(entries) if keys is None else list(keys)
+
+	if size <= 0 or stride <= 0 or shard_size <= 0:
+		raise Exception("The patch size, stride and shard size must be positive")
+
+	os.makedirs(output, exist_ok=True)
+
+	requests = mp.Queue()
+	replies  = mp.Queue()
+	workers  = []
+	for i in range(max(1, min(processes, len(keys)))):
+		process = mp.Process(
+			target=_workerMain,
+			args=(
+				i, output, size, stride, min_foreground, shard_size,
+				requests, replies
+			),
+			daemon=True
+		)
+		process.start()
+		workers.append(process)
+
+	for key in keys:
+		requests.put((
+			key, os.path.join(dataset.root_path, key),
+			entries.get(key, ContourSet())
+		))
+
+	for process in workers:
+		requests.put(None)
+
+	shards    = []
+	failed    = []
+	n_done    = 0
+	finished  = set()
+	while len(finished) < len(workers):
+		try:
+			reply = replies.get(timeout=_reply_timeout)
+		except queue.Empty:
+			# A worker that was killed (e.g. by running out of memory) never
+			# sends its last replies. Everything a worker sends is flushed
+			# before it exits, so one that is gone without saying that it is
+			# done has crashed.
+			for i, process in enumerate(workers):
+				if i not in finished and not process.is_alive():
+					for other in workers:
+						other.terminate()
+					raise Exception(
+						"Patch export worker %d exited with code %s"%(
+							i, process.exitcode
+						)
+					)
+			continue
+
+		if reply[0] == 'shard':
+			shards.append(reply[1])
+		elif reply[0] == 'image':
+			n_done += 1
+			if reply[3] is not None:
+				failed.append({'key': reply[1], 'error': reply[3]})
+			if progress_callback is not None:
+				progress_callback(n_done, len(keys))
+		else:
+			finished.add(reply[1])
+
+	for process in workers:
+		process.join()
+
+	shards.sort(key=lambda s: s['images'])
+	index = {
+		'patch_size'     : size,
+		'stride'         : stride,
+		'min_foreground' : min_foreground,
+		'shard_size'     : shard_size,
+		'classes'        : [c['name'] for c in dataset.meta_structure['classes']],
+		'n_images'       : len(keys) - len(failed),
+		'n_patches'      : sum(s['n_patches'] for s in shards),
+		'failed'         : failed,
+		'shards'         : shards
+	}
+
+	index_path = os.path.join(output, 'index.json')
+	tmp_path   = index_path + '.%d.tmp'%os.getpid()
+	with open(tmp_path, 'w') as file:
+		file.write(json.dumps(index))
+	os.replace(tmp_path, index_path)
+
+	return index
+
+# Reads the patches written by exportPatches and yields (images, masks)
+# batches of batch_size patches. Each shard is read in one go, from start
+# to end. If seed is given, the order of the shards and of the patches in
+# each shard is shuffled. Patches from shards with different dtypes or
+# channel counts are never put in the same batch, so a batch can be smaller
+# than batch_size when they change. The last batch can also be smaller.
+def readBatches(path, batch_size, seed=None):
+	with open(os.path.join(path, 'index.json'), 'r') as file:
+		index = json.loads(file.read())
+
+	shards = index['shards']
+	rng    = None
+	if seed is not None:
+		rng    = np.random.default_rng(seed)
+		shards = [shards[i] for i in rng.permutation(len(shards))]
+
+	images, masks = [], []
+	n_buffered    = 0
+	for shard in shards:
+		shard_images = np.load(os.path.join(path, shard['images']))
+		shard_masks  = np.load(os.path.join(path, shard['masks']))
+
+		if n_buffered > 0 and (
+			images[0].dtype != shard_images.dtype or
+			images[0].shape[1:] != shard_images.shape[1:]
+		):
+			yield np.concatenate(images), np.concatenate(masks)
+			images, masks = [], []
+			n_buffered    = 0
+
+		order = np.arange(shard_images.shape[0])
+		if rng is not None:
+			order = rng.permutation(order)
+
+		start = 0
+		while start < order.shape[0]:
+			take = order[start:start + batch_size - n_buffered]
+			images.append(shard_images[take])
+			masks.append(shard_masks[take])
+			n_buffered += take.shape[0]
+			start      += take.shape[0]
+
+			if n_buffered == batch_size:
+				yield np.concatenate(images), np.concatenate(masks)
+				images, masks = [], []
+				n_buffered    = 0
+
+	if n_buffered > 0:
+		yield np.concatenate(images), np.concatenate(masks)
@@ -0,0 +1,148 @@
+# Author:      Adam Robinson
+# Description: This file contains an overlay that shows frame time and
+#              memory statistics while the editor is running. It is toggled
+#              with F3 (see DatasetEditor.py). Nothing is sampled while it
+#              is hidden, so it costs nothing unless it is being used.
+
+from kivy.uix.label       import Label
+from kivy.core.window     import Window
+from kivy.clock           import Clock
+
+from collections import deque
+
+import numpy as np
+
+from CustomBoxLayout import CustomBoxLayout
+from PreviewPane     import live_thumbnails, live_textures
+
+# Frame times are recorded every frame, but the statistics are only
+# recomputed (and the text redrawn) at this interval.
+_sample_interval = 0.5
+
+# The percentiles are computed over this many of the most recent frames.
+_n_frames = 600
+
+class PerformanceHUD(CustomBoxLayout):
+	def __init__(self, interface, *args, **kwargs):
+		kwargs.setdefault('color', (0, 0, 0, 0.75))
+		kwargs.setdefault('size_hint', (None, None))
+		kwargs.setdefault('size', (340, 165))
+		kwargs.setdefault('padding', [8, 4, 8, 4])
+		super(PerformanceHUD, self).__init__(*args, **kwargs)
+
+		self.interface   = interface
+		self.frame_times = deque(maxlen=_n_frames)
+		self.visible     = False
+
+		self.frame_event  = None
+		self.sample_event = None
+
+		self.label = Label(
+			text='',
+			halign='left',
+			valign='top',
+			font_name='RobotoMono-Regular',
+			font_size=13
+		)
+		self.label.bind(size=self.label.setter('text_size'))
+		self.add_widget(self.label)
+
+		Window.bind(size=self._update_pos)
+		self._update_pos(Window, Window.size)
+
+	def _update_pos(self, inst, size):
+		self.pos = (size[0] - self.width - 5, size[1] - self.height - 5)
+
+	def toggle(self):
+		if self.visible:
+			self.hide()
+		else:
+			self.show()
+
+	def show(self):
+		if self.visible:
+			return
+
+		self.visible = True
+		self.frame_times.clear()
+		Window.add_widget(self)
+
+		self.frame_event  = Clock.schedule_interval(self._recordFrame, 0)
+		self.sample_event = Clock.schedule_interval(self._sample, _sample_interval)
+		self._sample(0)
+
+	def hide(self):
+		if not self.visible:
+			return
+
+		self.visible = False
+		self.frame_event.cancel()
+		self.sample_event.cancel()
+		Window.remove_widget(self)
+
+	def _recordFrame(self, dt):
+		self.frame_times.append(dt)
+
+	# Returns the statistics shown in the overlay. Sizes are in bytes and
+	# frame times are in seconds.
+	def sample(self):
+		stats = {}
+
+		if len(self.frame_times) > 0:
+			times = np.array(self.frame_times)
+			p50, p95, p99 = np.percentile(times, [50, 95, 99])
+			stats['frame_time'] = {
+				'p50' : float(p50),
+				'p95' : float(p95),
+				'p99' : float(p99),
+				'max' : float(times.max())
+			}
+
+		image_manager = self.interface.editor.display.image_display.image_manager
+		stats['canvas_instructions'] = image_manager.countInstructions()
+
+		textures = list(live_textures)
+		stats['thumbnail_widgets']  = len(live_thumbnails)
+		stats['thumbnail_textures'] = len(textures)
+		stats['texture_bytes']      = sum(t.width * t.height * 3 for t in textures)
+
+		dataset = getattr(self.interface.preview_pane, 'dataset', None)
+		if dataset is not None:
+			stats['dataset'] = dataset.memoryUsage()
+
+		return stats
+
+	def _sample(self, dt):
+		stats = self.sample()
+		lines = []
+
+		if 'frame_time' in stats:
+			ft = stats['frame_time']
+			lines.append('frame ms  p50 %5.1f  p95 %5.1f'%(
+				ft['p50'] * 1000, ft['p95'] * 1000
+			))
+			lines.append('          p99 %5.1f  max %5.1f'%(
+				ft['p99'] * 1000, ft['max'] * 1000
+			))
+		else:
+			lines.append('frame ms  -')
+
+		lines.append('canvas    %d instructions'%stats['canvas_instructions'])
+		lines.append('previews  %d widgets, %d textures'%(
+			stats['thumbnail_widgets'], stats['thumbnail_textures']
+		))
+		lines.append('textures  %s'%_formatBytes(stats['texture_bytes']))
+
+		if 'dataset' in stats:
+			usage = stats['dataset']
+			lines.append('images    %s'%_formatBytes(usage['images']))
+			lines.append('thumbs    %s'%_formatBytes(usage['thumbnails']))
+			if usage['budget'] is not None:
+				lines.append('total     %s of %s'%(
+					_formatBytes(usage['total']), _formatBytes(usage['budget'])
+				))
+
+		self.label.text = '\n'.join(lines)
+
+def _formatBytes(n):
+	return '%1.1f MB'%(n / (1024 * 1024))
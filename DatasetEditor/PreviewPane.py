@@ -4,19 +4,27 @@
 #              classes used to control the sub-elements inside the pane.
 
 from kivy.uix.label        import Label
-from kivy.uix.image        import Image
-from kivy.uix.gridlayout   import GridLayout
 from kivy.uix.behaviors    import ButtonBehavior
-from kivy.core.image       import Image as CoreImage
 from kivy.graphics.texture import Texture
-from kivy.graphics         import Rectangle, Color, Line
-from kivy.uix.scrollview   import ScrollView
+from kivy.graphics         import Rectangle
+from kivy.uix.spinner      import Spinner
+from kivy.uix.textinput    import TextInput
+from kivy.uix.recycleview  import RecycleView
+
+from kivy.uix.recycleboxlayout  import RecycleBoxLayout
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 
-from Dataset         import Dataset
 from CustomBoxLayout import CustomBoxLayout
-from ImageDisplay    import ImageDisplay
+from Tracing         import traced
+
+import weakref
 
-import numpy as np
+# Every PreviewThumbnail and thumbnail texture that hasn't been garbage
+# collected yet. These are read by the performance HUD (see 
+# PerformanceHUD.py), so that widgets and textures that outlive the dataset
+# they were created for show up.
+live_thumbnails = weakref.WeakSet()
+live_textures   = weakref.WeakSet()
 
 # TODO: Figure out why this code is so ugly. There must be a better
 #       way to achieve the desired effect.
@@ -24,79 +32,224 @@ import numpy as np
 # This is the list of images at the left of the screen that
 # can be scrolled through to select an image to edit.
 class PreviewPane(CustomBoxLayout):
+	fixed_filters = ['All Images', 'Labeled', 'Unlabeled']
+	sort_orders   = ['Default Order', 'Most Contours', 'Fewest Contours']
+
 	def __init__(self, *args, **kwargs):
 		super(PreviewPane, self).__init__(*args, **kwargs)
 
-		self.scroll_view  = ScrollView(
+		# Controls for filtering and sorting the thumbnails. These are answered
+		# from the dataset's AnnotationIndex, so changing them doesn't require
+		# looking through every entry.
+		self.filter_box = CustomBoxLayout(
+			orientation='vertical',
+			size_hint_y=None,
+			height=100,
+			padding=[5, 5, 5, 5],
+			spacing=5
+		)
+		self.filter_spinner = Spinner(
+			text='All Images',
+			values=self.fixed_filters,
+			size_hint_y=None,
+			height=30
+		)
+		self.sort_spinner = Spinner(
+			text='Default Order',
+			values=self.sort_orders,
+			size_hint_y=None,
+			height=30
+		)
+		self.min_contours_input = TextInput(
+			hint_text='Min. Contours',
+			multiline=False,
+			input_filter='int',
+			size_hint_y=None,
+			height=30
+		)
+
+		self.filter_spinner.bind(on_press=self._filter_spinner_pressed)
+		self.filter_spinner.bind(text=self._filter_changed)
+		self.sort_spinner.bind(text=self._filter_changed)
+		self.min_contours_input.bind(on_text_validate=self._filter_changed)
+
+		self.filter_box.add_widget(self.filter_spinner)
+		self.filter_box.add_widget(self.sort_spinner)
+		self.filter_box.add_widget(self.min_contours_input)
+		self.add_widget(self.filter_box)
+
+		# Only the visible thumbnails are turned into widgets, which are
+		# reused as the list is scrolled or filtered (see PreviewThumbnail).
+		self.list_view   = RecycleView(
 			size_hint=(1, None),
 			do_scroll_y=True,
 			do_scroll_x=False,
 			size=self.size
 		)
-		self.layout = GridLayout(
-			cols=1, 
-			spacing=10, 
-			size_hint_y=None,
-			padding=[10, 10, 10, 10]
+		self.list_layout = RecycleBoxLayout(
+			orientation='vertical',
+			spacing=10,
+			padding=[10, 10, 10, 10],
+			default_size_hint=(1, None),
+			size_hint_y=None
 		)
-		self.layout.bind(minimum_height=self.layout.setter('height'))
+		self.list_layout.bind(minimum_height=self.list_layout.setter('height'))
+		self.list_view.add_widget(self.list_layout)
+		self.list_view.viewclass = PreviewThumbnail
 
-		self.scroll_view.add_widget(self.layout)
-		self.add_widget(self.scroll_view)
+		self.add_widget(self.list_view)
 
-		self.current_selected_obj = None
+		self.current_selected_key = None
+		self.dataset              = None
+		self.rows                 = {}
+		self.textures             = {}
+		self.class_filters        = {}
 
 		self.bind(size=self._update_size)
 
 	def _update_size(self, instance, value):
-		self.scroll_view.height = self.height
+		self.list_view.height = self.height - self.filter_box.height
 
 	def getCorrectImageWidth(self):
 		return self.size[0] - 22
 
 	# This loads thumbnails from a dataset and displays them inside itself.
+	# Only a row of data is created for each thumbnail. The widgets and
+	# textures are created as they are scrolled into view.
+	@traced('PreviewPane.loadThumbnails')
 	def loadThumbnails(self, dataset):
-		self.dataset = dataset
-		for k, v in dataset.thumbnails.items():
-			pt = PreviewThumbnail(
-				dataset, k, self,
-				orientation='vertical',
-				color=(0.2, 0.2, 0.2, 1),
-				border=(1, 1, 1, 1),
-				border_color=(0.5, 0.5, 0.5, 1),
-				size_hint_x=1,
-				size_hint_y=None,
-				height=dataset.thumbnail_size[1] + 20
+		self.current_selected_key = None
+
+		self.dataset  = dataset
+		self.textures = {}
+		self.rows     = {k: {'key': k, 'preview_pane': self} for k in dataset.thumbnails}
+
+		# The position of each entry in the order it was loaded in.
+		self.default_order = {k: i for i, k in enumerate(dataset.thumbnails)}
+
+		self.list_layout.default_size = (None, dataset.thumbnail_size[1] + 20)
+
+		self._updateClassFilters()
+		self.filter_spinner.text = 'All Images'
+		self.applyFilter()
+
+	# Returns the texture of a thumbnail, creating it the first time the
+	# thumbnail is shown.
+	def thumbnailTexture(self, key):
+		if key not in self.textures:
+			texture = Texture.create(size=self.dataset.thumbnail_size, colorfmt='bgr')
+			texture.blit_buffer(
+				self.dataset.thumbnails[key],
+				colorfmt='bgr',
+				bufferfmt='ubyte'
 			)
-			self.layout.add_widget(pt)
-
-	def setSelected(self, inst, key):
-		if self.current_selected_obj is not None:
-			# The order of these calls is important
+			live_textures.add(texture)
+			self.textures[key] = texture
+
+		return self.textures[key]
+
+	# The filters are keyed by the class index, since names don't have to
+	# be unique.
+	def _updateClassFilters(self):
+		self.class_filters = {}
+		for idx, _class in enumerate(self.dataset.meta_structure['classes']):
+			self.class_filters['Class %d: %s'%(idx, _class['name'])] = idx
+
+		self.filter_spinner.values = self.fixed_filters + list(self.class_filters)
+
+	# Classes can be added while editing, so the list is refreshed whenever
+	# it is about to be opened.
+	def _filter_spinner_pressed(self, inst):
+		if self.dataset is not None:
+			self._updateClassFilters()
+
+	def _filter_changed(self, *args):
+		if self.dataset is not None:
+			self.applyFilter()
+
+	# Returns the minimum number of contours entered, or None if nothing (or
+	# something that isn't a count, like a lone '-') has been entered.
+	def _minContours(self):
+		try:
+			value = int(self.min_contours_input.text)
+		except ValueError:
+			return None
+
+		return value if value >= 0 else None
+
+	# Shows only the thumbnails matching the current filter, in the current
+	# sort order. Only the rows of the list change. The widgets that are in
+	# view are reused for whichever thumbnails end up there.
+	@traced('PreviewPane.applyFilter')
+	def applyFilter(self):
+		index   = self.dataset.index
+		_filter = self.filter_spinner.text
+
+		if _filter == 'Labeled':
+			keys = index.labeledEntries()
+		elif _filter == 'Unlabeled':
+			keys = index.unlabeledEntries()
+		elif _filter in self.class_filters:
+			keys = index.entriesWithClass(self.class_filters[_filter])
+		else:
+			keys = index.allEntries()
+
+		min_contours = self._minContours()
+		if min_contours is not None:
+			keys &= index.entriesWithCount(min_contours)
+
+		if self.sort_spinner.text == 'Most Contours':
+			keys = index.sortByCount(keys, descending=True)
+		elif self.sort_spinner.text == 'Fewest Contours':
+			keys = index.sortByCount(keys)
+		else:
+			keys = sorted(keys, key=self.default_order.get)
+
+		self.list_view.data = [self.rows[key] for key in keys]
+
+	@traced('PreviewPane.setSelected')
+	def setSelected(self, key):
+		if self.current_selected_key is not None:
 			self.parent.editor.display.image_display.writeChangesToMemory()
-			self.parent.editor.class_summary.writeChangesToMemory()
-			self.current_selected_obj.changeBorderColor(None)
 		self.current_selected_key = key
-		self.current_selected_obj = inst
-		inst.changeBorderColor((1, 0, 0, 1))
+
+		# Only the thumbnails in view have widgets. The others pick up the
+		# selection when they are scrolled into view.
+		for view in self.list_layout.children:
+			view.updateSelected()
 
 		# This will handle the image editor setup.
-		self.parent.editor.display.image_display.setImage(key, self.dataset)
+		display = self.parent.editor.display
+		display.image_display.setImage(key, self.dataset)
+		display.toolbar.showAdjustment(
+			display.image_display.image_manager.display_window
+		)
 
 		# Next we update the list in the class summary.
 		self.parent.editor.class_summary.setCurrentEntry(key, self.dataset)
 
 
 
-class PreviewThumbnail(ButtonBehavior, CustomBoxLayout):
-	def __init__(self, dataset, key, parent, *args, **kwargs):
+# A thumbnail in the PreviewPane. These are created without a key by the
+# RecycleView, and then shown for whichever entries are scrolled into view
+# by refresh_view_attrs.
+class PreviewThumbnail(RecycleDataViewBehavior, ButtonBehavior, CustomBoxLayout):
+	def __init__(self, *args, **kwargs):
+		kwargs['orientation']  = 'vertical'
+		kwargs['color']        = (0.2, 0.2, 0.2, 1)
+		kwargs['border']       = (1, 1, 1, 1)
+		kwargs['border_color'] = (0.5, 0.5, 0.5, 1)
+		kwargs['size_hint_x']  = 1
+		kwargs['size_hint_y']  = None
+
 		super(PreviewThumbnail, self).__init__(*args, **kwargs)
 
-		self._parent_obj = parent
-		self.key         = key
+		self.key          = None
+		self.preview_pane = None
+		live_thumbnails.add(self)
 
 		self.label = Label(
-			text=key, 
+			text='', 
 			size_hint_y=None, 
 			height=20,
 			size_hint_x=1
@@ -106,56 +259,53 @@ class PreviewThumbnail(ButtonBehavior, CustomBoxLayout):
 		# its color from the background. We need to make it white for
 		# the image to display correctly.
 		self.image_holder = ImageHolder(
-			dataset.thumbnails[key], 
-			dataset.thumbnail_size,
 			size_hint_y = None,
 			size_hint_x = None,
-			height      = dataset.thumbnail_size[1],
-			width       = dataset.thumbnail_size[0],
 			color       = (1, 1, 1, 1)
 		)
 
 		self.add_widget(self.label)
 		self.add_widget(self.image_holder)
 
-		self.bind(on_release=self._clicked)
+	def refresh_view_attrs(self, rv, index, data):
+		self.key          = data['key']
+		self.preview_pane = data['preview_pane']
+
+		self.label.text = self.key
+		self.image_holder.setTexture(
+			self.preview_pane.thumbnailTexture(self.key),
+			self.preview_pane.dataset.thumbnail_size
+		)
+		self.updateSelected()
 
-	def _clicked(self, instance):
-		self._parent_obj.setSelected(self, self.key)
+	def updateSelected(self):
+		if self.key is not None and self.key == self.preview_pane.current_selected_key:
+			self.changeBorderColor((1, 0, 0, 1))
+		else:
+			self.changeBorderColor(None)
+
+	def on_release(self):
+		if self.preview_pane is not None:
+			self.preview_pane.setSelected(self.key)
 		
 
 
 class ImageHolder(CustomBoxLayout):
-	def __init__(self, image_buffer, size, *args, **kwargs):
+	def __init__(self, *args, **kwargs):
 		super(ImageHolder, self).__init__(*args, **kwargs)
 
-		self.image_size = size
-
-		self.image_texture = Texture.create(size=size, colorfmt='bgr')
-		self.image_texture.blit_buffer(
-			image_buffer, 
-			colorfmt='bgr', 
-			bufferfmt='ubyte'
-		)
-
 		with self.canvas:
-			self.image_rect = Rectangle(
-				texture=self.image_texture, 
-				pos=self.pos, 
-				size=self.image_size
-			)
+			self.image_rect = Rectangle(pos=self.pos, size=self.size)
 
 		self.bind(
 			size=self._update_rect, 
 			pos=self._update_rect
 		)
 
+	def setTexture(self, texture, size):
+		self.image_rect.texture = texture
+		self.width, self.height = size
+
 	def _update_rect(self, instance, value):
 		self.image_rect.pos  = (instance.pos[0] + 1, instance.pos[1] + 1) 
 		self.image_rect.size = instance.size
-
-
-
-
-
-	
@@ -0,0 +1,62 @@
+# Author:      Adam Robinson
+# Description: This class keeps recently used textures in graphics memory so
+#              that switching back to an image doesn't require uploading it
+#              again. The cache is bounded by an estimate of the video memory
+#              used by the textures it holds.
+
+from collections import OrderedDict
+
+# Textures are stored in least recently used order. When adding a texture
+# pushes the total size over the budget, the oldest textures are dropped
+# until it fits again. Kivy frees the graphics memory for a texture once
+# nothing references it anymore.
+class TextureCache:
+	def __init__(self, budget=512 * 1024 * 1024):
+		self.budget  = budget
+		self.used    = 0
+		self.entries = OrderedDict()
+
+	# Estimates the amount of video memory used by a texture with the given
+	# dimensions. Most drivers store three channel textures with four bytes
+	# per pixel, so that is assumed here.
+	@staticmethod
+	def textureBytes(width, height):
+		return width * height * 4
+
+	# Returns the texture stored for key, or None if it isn't cached.
+	def get(self, key):
+		if key not in self.entries:
+			return None
+
+		self.entries.move_to_end(key)
+		return self.entries[key][0]
+
+	def put(self, key, texture, nbytes):
+		self.remove(key)
+
+		# Something larger than the entire budget would just evict
+		# everything else and then itself.
+		if nbytes > self.budget:
+			return
+
+		self.entries[key] = (texture, nbytes)
+		self.used        += nbytes
+
+		while self.used > self.budget:
+			_, (_, evicted_bytes) = self.entries.popitem(last=False)
+			self.used -= evicted_bytes
+
+	def remove(self, key):
+		if key in self.entries:
+			_, nbytes  = self.entries.pop(key)
+			self.used -= nbytes
+
+	def clear(self):
+		self.entries = OrderedDict()
+		self.used    = 0
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def __len__(self):
+		return len(self.entries)
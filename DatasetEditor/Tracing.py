@@ -0,0 +1,146 @@
+# Author:      Adam Robinson
+# Description: This file contains a lightweight tracing layer. Named spans
+#              are placed around the expensive stages of loading and
+#              displaying images. When tracing is disabled (the default) a
+#              span costs a single flag check. When it is enabled, spans are
+#              recorded and can be exported as a Chrome trace (which can be
+#              opened in chrome://tracing or https://ui.perfetto.dev) along
+#              with summary statistics for each span.
+#
+#              with span('ImageManager.blit'):
+#                  texture.blit_buffer(...)
+#
+#              @traced('Dataset.loadDirectory')
+#              def loadDirectory(self, ...):
+
+import os
+import json
+import time
+import threading
+import functools
+import numpy as np
+
+_enabled = False
+
+# Each recorded span is (name, start, duration, thread id), with times in
+# nanoseconds. list.append is atomic, so spans from the loading threads
+# can be recorded without a lock.
+_events = []
+
+def enable():
+	global _enabled
+	_enabled = True
+
+def disable():
+	global _enabled
+	_enabled = False
+
+def isEnabled():
+	return _enabled
+
+def clear():
+	del _events[:]
+
+class _Span:
+	__slots__ = ('name', 'start')
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *args):
+		_events.append((
+			self.name,
+			self.start,
+			time.perf_counter_ns() - self.start,
+			threading.get_ident()
+		))
+
+# Returned by span when tracing is disabled. It is shared, since it doesn't
+# have any state.
+class _NullSpan:
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+_null_span = _NullSpan()
+
+# Returns a context manager that records the time spent inside of it under
+# the given name.
+def span(name):
+	if _enabled:
+		return _Span(name)
+
+	return _null_span
+
+# Decorator that records every call to a function as a span.
+def traced(name):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not _enabled:
+				return function(*args, **kwargs)
+
+			with _Span(name):
+				return function(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+# Returns {name: {count, total, mean, median, p95, max}} for every span that
+# has been recorded. Times are in seconds.
+def summary():
+	durations = {}
+	for name, start, duration, thread in list(_events):
+		durations.setdefault(name, []).append(duration)
+
+	results = {}
+	for name, values in durations.items():
+		values = np.array(values, dtype=np.float64) / 1e9
+		results[name] = {
+			'count'  : int(values.shape[0]),
+			'total'  : float(values.sum()),
+			'mean'   : float(values.mean()),
+			'median' : float(np.median(values)),
+			'p95'    : float(np.percentile(values, 95)),
+			'max'    : float(values.max())
+		}
+
+	return results
+
+# Writes every recorded span in the Chrome trace event format, with the
+# summary statistics included as metadata.
+def writeChromeTrace(path):
+	pid    = os.getpid()
+	events = [{
+		'name' : name,
+		'ph'   : 'X',
+		'ts'   : start / 1000,
+		'dur'  : duration / 1000,
+		'pid'  : pid,
+		'tid'  : thread
+	} for name, start, duration, thread in list(_events)]
+
+	with open(path, 'w') as file:
+		file.write(json.dumps({
+			'traceEvents'     : events,
+			'displayTimeUnit' : 'ms',
+			'otherData'       : {'summary': summary()}
+		}))
+
+def printSummary():
+	results = sorted(summary().items(), key=lambda item: -item[1]['total'])
+	print('%-36s %8s %10s %10s %10s'%('span', 'count', 'total', 'median', 'p95'))
+	for name, stats in results:
+		print('%-36s %8d %9.3fs %9.3fms %9.3fms'%(
+			name, stats['count'], stats['total'],
+			stats['median'] * 1000, stats['p95'] * 1000
+		))
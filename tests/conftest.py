@@ -0,0 +1,32 @@
+# Author:      Adam Robinson
+# Description: The modules in DatasetEditor import each other by name, the
+#              same way they do when the editor or the command line tools
+#              are run from that directory. This also holds the fixtures
+#              shared by the tests.
+
+import os
+import sys
+import pytest
+
+sys.path.insert(
+	0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DatasetEditor')
+)
+
+from Benchmark import generateDataset
+from Dataset   import Dataset
+
+# Returns a function that generates a dataset (see Benchmark.generateDataset)
+# in a new directory under tmp_path and returns it with its metadata loaded.
+# The images are named image_00000.png, image_00001.png and so on.
+@pytest.fixture
+def make_dataset(tmp_path):
+	def _make(n_images=3, width=64, height=48, contours_per_image=2,
+		      points_per_contour=8, name='dataset'):
+		path = str(tmp_path / name)
+		generateDataset(
+			path, n_images, width, height, contours_per_image,
+			points_per_contour
+		)
+		return Dataset().loadMetadata(path)
+
+	return _make
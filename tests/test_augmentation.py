@@ -0,0 +1,76 @@
+# Author:      Adam Robinson
+# Description: Tests for Augmentation.py. The same seed has to produce the
+#              same batches however they are augmented, and the masks have to
+#              stay aligned with their images.
+
+import cv2
+import numpy as np
+
+from Augmentation import Augmenter, augmentBatches, batchGenerator
+
+# Images where every class of the mask is a block of a single gray level.
+def _batches(n_batches=3, batch_size=4, size=64):
+	rng     = np.random.default_rng(1)
+	batches = []
+	for b in range(n_batches):
+		masks = np.zeros((batch_size, size, size), dtype=np.uint16)
+		for i in range(batch_size):
+			for c in range(1, 4):
+				x, y = rng.integers(0, size - 20, 2)
+				masks[i, y:y + 20, x:x + 20] = c
+
+		images = np.repeat((masks * 60).astype(np.uint8)[..., None], 3, axis=3)
+		batches.append((images, masks))
+
+	return batches
+
+def _augmenter(**kwargs):
+	return Augmenter((48, 40), noise=0.02, **kwargs)
+
+def _run(seed, processes=0):
+	return list(augmentBatches(_batches(), _augmenter(), seed, processes))
+
+def _assertSame(a, b):
+	assert len(a) == len(b)
+	for (images_a, masks_a), (images_b, masks_b) in zip(a, b):
+		assert np.array_equal(images_a, images_b)
+		assert np.array_equal(masks_a, masks_b)
+
+def test_the_same_seed_gives_the_same_batches():
+	_assertSame(_run(7), _run(7))
+
+	different = _run(8)
+	assert not all(
+		np.array_equal(a[0], b[0]) for a, b in zip(_run(7), different)
+	)
+
+def test_worker_processes_give_the_same_batches():
+	_assertSame(_run(7), _run(7, processes=2))
+
+def test_each_batch_only_depends_on_its_position():
+	batches   = _batches()
+	augmenter = _augmenter()
+	stream    = _run(7)
+
+	images, masks = batches[2]
+	alone         = augmenter.augmentBatch(images, masks, batchGenerator(7, 2))
+	_assertSame([stream[2]], [alone])
+
+def test_masks_stay_aligned_with_their_images():
+	augmenter = _augmenter(brightness=0, contrast=0, gamma=0)
+	augmenter.noise = 0.0
+
+	kernel = np.ones((5, 5), dtype=np.uint8)
+	for images, masks in augmentBatches(_batches(), augmenter, seed=3):
+		assert set(np.unique(masks)) <= {0, 1, 2, 3}
+
+		for image, mask in zip(images, masks):
+			for c in range(1, 4):
+				# Pixels near the edge of a block, or of the sample, are
+				# interpolated in the image, but not in the mask.
+				inside = cv2.erode(
+					(mask == c).astype(np.uint8), kernel,
+					borderType=cv2.BORDER_CONSTANT, borderValue=0
+				) > 0
+				values = image[inside].astype(np.int64)
+				assert np.all(np.abs(values - c * 60) <= 1)
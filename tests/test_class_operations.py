@@ -0,0 +1,94 @@
+# Author:      Adam Robinson
+# Description: Tests for the dataset wide class operations in
+#              ClassOperations.py and the commands that run them.
+
+import os
+import json
+import pytest
+import numpy as np
+
+from ClassOperations import renameClass, mergeClasses, deleteClasses
+from DatasetCLI      import main
+
+# The class index of every contour, per entry.
+def _classIndices(dataset):
+	return {
+		k: v.class_idx.astype(np.int64).copy()
+		for k, v in dataset.meta_structure['entries'].items()
+	}
+
+def _names(dataset):
+	return [c['name'] for c in dataset.meta_structure['classes']]
+
+def test_rename_keeps_every_contour(make_dataset):
+	dataset = make_dataset(4, contours_per_image=6)
+	before  = _classIndices(dataset)
+
+	renameClass(dataset, 'class_1', 'cell')
+
+	assert _names(dataset) == ['class_0', 'cell', 'class_2', 'class_3']
+	for key, indices in _classIndices(dataset).items():
+		assert np.array_equal(indices, before[key])
+
+	with pytest.raises(Exception, match='already has'):
+		renameClass(dataset, 'class_0', 'cell')
+
+def test_merge_moves_contours_and_renumbers(make_dataset):
+	dataset = make_dataset(4, contours_per_image=6)
+	before  = _classIndices(dataset)
+	assert 1 in np.concatenate(list(before.values()))
+
+	assert mergeClasses(dataset, 'class_3', ['class_1']) == 0
+
+	# class_0, class_2 and class_3 are left, and class_1 became class_3.
+	lut = np.array([0, 2, 1, 2])
+	assert _names(dataset) == ['class_0', 'class_2', 'class_3']
+	for key, indices in _classIndices(dataset).items():
+		assert np.array_equal(indices, lut[before[key]])
+
+def test_delete_removes_contours_and_renumbers(make_dataset):
+	dataset = make_dataset(4, contours_per_image=6)
+	before  = _classIndices(dataset)
+	n_class = sum(int((v == 2).sum()) for v in before.values())
+	assert n_class > 0
+
+	assert deleteClasses(dataset, ['class_2']) == n_class
+
+	lut = np.array([0, 1, -1, 2])
+	assert _names(dataset) == ['class_0', 'class_1', 'class_3']
+	for key, indices in _classIndices(dataset).items():
+		expected = lut[before[key]]
+		assert np.array_equal(indices, expected[expected >= 0])
+
+def test_ambiguous_names_change_nothing(make_dataset):
+	dataset = make_dataset(4, contours_per_image=6)
+	dataset.meta_structure['classes'][3]['name'] = 'class_0'
+	before  = _classIndices(dataset)
+
+	for operation in (
+		lambda: renameClass(dataset, 'class_0', 'cell'),
+		lambda: mergeClasses(dataset, 'class_1', ['class_0']),
+		lambda: deleteClasses(dataset, ['class_0'])
+	):
+		with pytest.raises(Exception, match='2 classes named'):
+			operation()
+
+	assert len(dataset.meta_structure['classes']) == 4
+	for key, indices in _classIndices(dataset).items():
+		assert np.array_equal(indices, before[key])
+
+def test_commands_save_meta_json(make_dataset):
+	dataset = make_dataset(4, contours_per_image=6)
+	path    = dataset.root_path
+	before  = _classIndices(dataset)
+
+	assert main(['delete-classes', path, 'class_0']) == 0
+	assert main(['merge-classes', path, 'class_1', 'class_2', 'class_3']) == 0
+	assert main(['rename-class', path, 'missing', 'cell']) == 1
+
+	with open(os.path.join(path, 'meta.json')) as file:
+		meta = json.load(file)
+
+	assert [c['name'] for c in meta['classes']] == ['class_1']
+	for key, entry in meta['entries'].items():
+		assert [c['class_idx'] for c in entry] == [0] * int((before[key] != 0).sum())
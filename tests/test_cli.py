@@ -0,0 +1,43 @@
+# Author:      Adam Robinson
+# Description: Tests for the commands in DatasetCLI.py.
+
+import os
+import cv2
+import numpy as np
+
+import DatasetCache
+
+from DatasetCLI import main
+
+def test_export_masks_writes_every_tiff_page(tmp_path, make_dataset):
+	dataset = make_dataset(1, contours_per_image=1).root_path
+	output  = tmp_path / 'masks'
+
+	pages = [np.zeros((48 + 8 * i, 64, 3), dtype=np.uint8) for i in range(3)]
+	cv2.imwritemulti(os.path.join(dataset, 'stack.tif'), pages)
+
+	assert main(['export-masks', dataset, str(output), '--include-empty']) == 0
+
+	names = sorted(os.listdir(output))
+	assert names == ['image_00000.png', 'stack_p0.png', 'stack_p1.png', 'stack_p2.png']
+	for i in range(3):
+		mask = cv2.imread(str(output / ('stack_p%d.png'%i)), cv2.IMREAD_UNCHANGED)
+		assert mask.shape == (48 + 8 * i, 64)
+
+_warmImage = DatasetCache.warmImage
+
+# Stands in for warmImage on an image that can't be warmed.
+def _failingWarm(img_path, *args):
+	if img_path.endswith('image_00001.png'):
+		raise OSError('No space left on device')
+
+	return _warmImage(img_path, *args)
+
+def test_warm_cache_keeps_going_after_a_failed_image(make_dataset, monkeypatch):
+	dataset = make_dataset(3).root_path
+	monkeypatch.setattr(DatasetCache, 'warmImage', _failingWarm)
+
+	assert main(['--json', 'warm-cache', dataset, '--processes', '2']) == 1
+
+	cache = DatasetCache.DatasetCache(os.path.join(dataset, '.cache'))
+	assert cache.headers.keys() == {'image_00000.png', 'image_00002.png'}
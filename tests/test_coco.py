@@ -0,0 +1,80 @@
+# Author:      Adam Robinson
+# Description: Tests for the run length encoding in CocoExporter.py, checked
+#              against the masks that MaskRasterizer.py draws.
+
+import json
+import numpy as np
+
+from CocoExporter   import encodeRLE, exportCOCO
+from Contour        import ContourSet
+from MaskRasterizer import classMask, contourMasks
+
+# The reference decoder. Runs alternate between zeros and ones, in column
+# major order.
+def _decodeRLE(counts, width, height):
+	flat  = np.zeros(width * height, dtype=np.uint8)
+	start = 0
+	for i, count in enumerate(counts):
+		if i % 2 == 1:
+			flat[start:start + count] = 1
+		start += count
+
+	assert start == width * height
+	return flat.reshape(width, height).T
+
+def _contours():
+	return ContourSet.fromEntry([
+		# Inside the image.
+		{'geometry': [[0.2, 0.2], [0.4, 0.25], [0.3, 0.45]], 'class_idx': 0},
+		# Covers the whole height, so runs continue into the next column.
+		{'geometry': [[0.6, -0.1], [0.7, -0.1], [0.7, 1.1], [0.6, 1.1]], 'class_idx': 1},
+		# Clipped by the corner of the image.
+		{'geometry': [[0.9, 0.9], [1.2, 0.9], [1.2, 1.2], [0.9, 1.2]], 'class_idx': 2}
+	])
+
+def test_rle_matches_the_rasterized_masks():
+	width, height = 53, 37
+	contours      = _contours()
+
+	n_masks = 0
+	for i, x0, y0, mask in contourMasks(contours, width, height):
+		counts, area = encodeRLE(mask, x0, y0, width, height)
+		decoded      = _decodeRLE(counts, width, height)
+
+		single = ContourSet.fromEntry([{
+			'geometry'  : contours.vertices[
+				contours.offsets[i]:contours.offsets[i + 1]
+			].tolist(),
+			'class_idx' : 0
+		}])
+		expected = classMask(single, width, height) > 0
+
+		assert np.array_equal(decoded > 0, expected)
+		assert area == int(expected.sum())
+		assert all(c > 0 for c in counts[1:])
+		n_masks += 1
+
+	assert n_masks == 3
+
+def test_rle_of_empty_and_full_masks():
+	counts, area = encodeRLE(np.zeros((4, 5), dtype=np.uint8), 2, 3, 10, 8)
+	assert counts == [80] and area == 0
+
+	counts, area = encodeRLE(np.ones((8, 10), dtype=np.uint8), 0, 0, 10, 8)
+	assert counts[:2] == [0, 80] and area == 80
+	assert _decodeRLE(counts, 10, 8).all()
+
+def test_exported_areas_match_the_masks(tmp_path, make_dataset):
+	dataset = make_dataset(2, contours_per_image=3)
+	path    = str(tmp_path / 'coco.json')
+
+	summary = exportCOCO(dataset, path, rle=True, processes=1)
+	with open(path) as file:
+		coco = json.load(file)
+
+	assert summary['failed'] == []
+	assert len(coco['annotations']) == summary['n_annotations'] == 6
+	for annotation in coco['annotations']:
+		height, width = annotation['segmentation']['size']
+		decoded       = _decodeRLE(annotation['segmentation']['counts'], width, height)
+		assert annotation['area'] == decoded.sum()
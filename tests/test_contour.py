@@ -0,0 +1,81 @@
+# Author:      Adam Robinson
+# Description: Tests for the columnar ContourSet (see Contour.py), and its
+#              conversion to and from the meta.json schema.
+
+import json
+import numpy as np
+
+from Contour import Contour, ContourSet, snapCoordinate
+
+def _entry():
+	return [
+		{
+			'geometry'  : [[0.25, 0.5], [0.75, 0.5], [0.5, 0.125]],
+			'class_idx' : 1,
+			'name'      : 'a',
+			'comment'   : 'first'
+		},
+		{
+			'geometry'  : [[0.1, 0.2], [0.3, 0.4], [0.5, 0.6], [0.7, 0.8]],
+			'class_idx' : 0,
+			'name'      : 'b',
+			'comment'   : '',
+			'score'     : 0.9
+		}
+	]
+
+def test_round_trip_preserves_every_value():
+	entry       = _entry()
+	contour_set = ContourSet.fromEntry(entry)
+
+	assert len(contour_set) == 2
+	assert contour_set.offsets.tolist() == [0, 3, 7]
+	assert contour_set.class_idx.tolist() == [1, 0]
+	assert contour_set.toEntry() == entry
+
+	# The json that is written has to match what was read.
+	assert json.dumps(contour_set.toEntry()) == json.dumps(entry)
+
+def test_exact_coordinates_are_stored_as_float32():
+	entry = [{'geometry': [[0.25, 0.5], [0.75, 0.5], [0.5, 0.125]]}]
+	assert ContourSet.fromEntry(entry).vertices.dtype == np.float32
+
+def test_inexact_coordinates_fall_back_to_float64():
+	contour_set = ContourSet.fromEntry(_entry())
+
+	# 0.1 can't be represented exactly as float32.
+	assert contour_set.vertices.dtype == np.float64
+	assert contour_set.getPoints(1)[0].tolist() == [0.1, 0.2]
+
+def test_append_falls_back_to_float64():
+	contour_set = ContourSet()
+	contour_set.append(Contour([[0.25, 0.5], [0.5, 0.5], [0.5, 0.25]]))
+	assert contour_set.vertices.dtype == np.float32
+
+	contour_set.append(Contour([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]], class_idx=2))
+	assert contour_set.vertices.dtype == np.float64
+	assert contour_set.getPoints(0).tolist() == [[0.25, 0.5], [0.5, 0.5], [0.5, 0.25]]
+	assert contour_set.getPoints(1).tolist() == [[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]]
+	assert contour_set.class_idx.tolist() == [0, 2]
+
+def test_snapped_points_stay_float32():
+	contour_set = ContourSet()
+	points      = [[snapCoordinate(0.1), snapCoordinate(0.3)]] * 3
+	contour_set.append(Contour(points))
+
+	assert contour_set.vertices.dtype == np.float32
+	assert ContourSet.fromEntry(contour_set.toEntry()).vertices.dtype == np.float32
+
+def test_remove_and_remap_keep_offsets_consistent():
+	contour_set = ContourSet.fromEntry(_entry() + _entry())
+
+	contour_set.remove(1)
+	assert contour_set.offsets.tolist() == [0, 3, 6, 10]
+	assert contour_set.names == ['a', 'a', 'b']
+
+	# Class 1 is removed, class 0 becomes class 3.
+	n_removed = contour_set.remapClasses(np.array([3, -1]))
+	assert n_removed == 2
+	assert contour_set.class_idx.tolist() == [3]
+	assert contour_set.getPoints(0).shape == (4, 2)
+	assert contour_set.extras == [{'score': 0.9}]
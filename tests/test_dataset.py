@@ -0,0 +1,70 @@
+# Author:      Adam Robinson
+# Description: Tests for the image cache of Dataset.
+
+import os
+import numpy as np
+
+from Dataset      import Dataset
+from ImagePyramid import ImagePyramid
+
+def test_acquired_images_are_kept_without_a_worker(make_dataset):
+	dataset = make_dataset(2, contours_per_image=1)
+	dataset.images.clear()
+	dataset.image_bytes = 0
+
+	lease = dataset.acquireImage('image_00000.png')
+	lease.release()
+
+	assert 'image_00000.png' in dataset.images
+	assert dataset.image_bytes == 64 * 48 * 3
+
+	lease = dataset.acquireImage('image_00000.png')
+	assert lease.array is dataset.images['image_00000.png']
+	lease.release()
+
+def test_acquired_images_respect_the_memory_budget(make_dataset):
+	dataset = make_dataset(2, contours_per_image=1)
+	dataset.images.clear()
+	dataset.image_bytes   = 0
+	dataset.memory_budget = 0
+
+	lease = dataset.acquireImage('image_00000.png')
+	lease.release()
+
+	assert lease.array.shape == (48, 64, 3)
+	assert 'image_00000.png' not in dataset.images
+
+def test_datasets_load_when_the_cache_is_read_only(make_dataset, monkeypatch):
+	import errno
+	import DatasetCache
+
+	def readOnly(path, *args, **kwargs):
+		raise OSError(errno.EROFS, 'Read-only file system', path)
+
+	path = make_dataset(2).root_path
+	monkeypatch.setattr(DatasetCache.os, 'makedirs', readOnly)
+
+	dataset = Dataset().loadDirectory(path, (32, 24), lambda progress: None)
+
+	assert sorted(dataset.image_shapes) == ['image_00000.png', 'image_00001.png']
+	assert not dataset.cache.writable
+	assert not os.path.exists(os.path.join(path, '.cache'))
+
+def test_memory_mapped_pyramid_levels_are_not_counted(make_dataset, tmp_path):
+	dataset = make_dataset(1)
+	img     = np.zeros((1024, 1536, 3), dtype=np.uint8)
+
+	built = ImagePyramid(img, 256, str(tmp_path / 'pyramid'))
+	built.buildAll()
+	assert built.residentBytes() == sum(l.nbytes for l in built.levels[1:])
+
+	# The same pyramid opened from the cache memory maps its levels.
+	loaded = ImagePyramid(img, 256, str(tmp_path / 'pyramid'))
+	loaded.buildAll()
+	assert loaded.residentBytes() == 0
+
+	dataset.pyramids['image_00000.png'] = loaded
+	assert dataset.memoryUsage()['pyramids'] == 0
+
+	dataset.pyramids['image_00000.png'] = built
+	assert dataset.memoryUsage()['pyramids'] == built.residentBytes() > 0
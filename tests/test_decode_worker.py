@@ -0,0 +1,25 @@
+# Author:      Adam Robinson
+# Description: Tests for the shared memory decoder in DecodeWorker.py.
+
+import os
+import signal
+import pytest
+
+from DecodeWorker import DecodeWorker
+
+def test_decodes_fail_when_the_worker_process_dies(make_dataset):
+	path   = make_dataset(2).root_path
+	worker = DecodeWorker(n_slots=2, slot_bytes=1024 * 1024).start()
+
+	try:
+		lease = worker.decode(os.path.join(path, 'image_00000.png'))
+		assert lease.array.shape == (48, 64, 3)
+		lease.release()
+
+		os.kill(worker.processes[0].pid, signal.SIGKILL)
+		worker.processes[0].join()
+
+		with pytest.raises(Exception, match='exited with code'):
+			worker.decode(os.path.join(path, 'image_00001.png'))
+	finally:
+		worker.stop()
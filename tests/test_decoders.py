@@ -0,0 +1,126 @@
+# Author:      Adam Robinson
+# Description: Tests for the image decoders (see ImageDecoders.py) and the
+#              header parsing in ImageHeader.py, checked against cv2. The
+#              decoders that need optional packages are skipped when those
+#              packages aren't installed.
+
+import os
+import cv2
+import struct
+import pytest
+import numpy as np
+
+from ImageDecoders import (
+	CV2Decoder, PillowDecoder, TurboJPEGDecoder, applyOrientation,
+	verifyDecoders
+)
+from ImageHeader   import pagePath, readImageSize, readOrientation, readTiffPages
+
+# Inserts an APP1 segment with the given EXIF orientation right after the
+# start of image marker.
+def _withOrientation(data, orientation):
+	tiff = (
+		b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', 1) +
+		struct.pack('<HHIHH', 274, 3, 1, orientation, 0) + struct.pack('<I', 0)
+	)
+	segment = b'Exif\x00\x00' + tiff
+	return (
+		data[:2] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) +
+		segment + data[2:]
+	)
+
+# A smooth image, so that different jpeg decoders stay close to each other.
+def _image(width=128, height=96):
+	x, y = np.meshgrid(np.arange(width), np.arange(height))
+	img  = np.stack([x * 2, y * 2, (x + y)], axis=2)
+	return (img % 256).astype(np.uint8)
+
+def _writeJPEG(path, orientation=None):
+	ok, data = cv2.imencode('.jpg', _image(), [cv2.IMWRITE_JPEG_QUALITY, 95])
+	data     = data.tobytes()
+	if orientation is not None:
+		data = _withOrientation(data, orientation)
+
+	with open(path, 'wb') as file:
+		file.write(data)
+
+	return str(path)
+
+@pytest.fixture
+def images(tmp_path):
+	png_path = str(tmp_path / 'image.png')
+	cv2.imwrite(png_path, _image())
+
+	tif_path = str(tmp_path / 'stack.tif')
+	cv2.imwritemulti(tif_path, [_image(128, 96), _image(64, 48), _image(32, 80)])
+
+	return {
+		'png'     : png_path,
+		'tif'     : tif_path,
+		'jpg'     : _writeJPEG(tmp_path / 'image.jpg'),
+		'rotated' : _writeJPEG(tmp_path / 'rotated.jpg', 6)
+	}
+
+def _assertMatches(decoder, path, scale, tolerance):
+	img      = decoder.decode(path, scale)
+	expected = CV2Decoder().decode(path, scale)
+
+	assert img is not None
+	assert img.shape == expected.shape
+	assert img.dtype == expected.dtype
+
+	diff = np.abs(img.astype(np.float64) - expected.astype(np.float64))
+	assert diff.mean() <= tolerance
+
+@pytest.mark.parametrize('orientation', range(1, 9))
+def test_orientation_matches_cv2(tmp_path, orientation):
+	path = _writeJPEG(tmp_path / 'image.jpg', orientation)
+	raw  = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+	img  = cv2.imread(path)
+
+	assert readOrientation(path) == orientation
+	assert readImageSize(path) == img.shape[:2]
+	assert np.array_equal(applyOrientation(raw, orientation), img)
+
+def test_headers_match_cv2(images):
+	for key in ('png', 'jpg', 'rotated'):
+		assert readImageSize(images[key]) == cv2.imread(images[key]).shape[:2]
+
+	ok, pages = cv2.imreadmulti(images['tif'])
+	assert readTiffPages(images['tif']) == [p.shape[:2] for p in pages]
+	for i, page in enumerate(pages):
+		assert readImageSize(pagePath(images['tif'], i)) == page.shape[:2]
+
+def test_pillow_matches_cv2(images):
+	pytest.importorskip('PIL')
+	decoder = PillowDecoder()
+
+	_assertMatches(decoder, images['png'], 1, 0)
+	for i in range(3):
+		_assertMatches(decoder, pagePath(images['tif'], i), 1, 0)
+
+	for key in ('jpg', 'rotated'):
+		for scale in decoder.scales('jpg'):
+			_assertMatches(decoder, images[key], scale, 4.0)
+
+	for key in ('png', 'jpg', 'rotated'):
+		assert decoder.readShape(images[key]) == readImageSize(images[key])
+
+def test_turbojpeg_matches_cv2(images):
+	pytest.importorskip('turbojpeg')
+	if not TurboJPEGDecoder.available():
+		pytest.skip('libjpeg-turbo is not installed')
+	decoder = TurboJPEGDecoder()
+
+	for key in ('jpg', 'rotated'):
+		for scale in decoder.scales('jpg'):
+			_assertMatches(decoder, images[key], scale, 4.0)
+
+		assert decoder.readShape(images[key]) == readImageSize(images[key])
+
+def test_every_installed_decoder_passes_verification(images):
+	paths   = [images['png'], images['jpg'], images['rotated']]
+	paths  += [pagePath(images['tif'], i) for i in range(3)]
+	failed  = [r for r in verifyDecoders(paths) if not r['passed']]
+
+	assert failed == []
@@ -0,0 +1,108 @@
+# Author:      Adam Robinson
+# Description: Tests for the patch export in PatchExporter.py.
+
+import os
+import cv2
+import pytest
+import numpy as np
+
+import PatchExporter
+
+from MaskRasterizer import classMask
+
+def _export(tmp_path, dataset, **kwargs):
+	output = str(tmp_path / 'patches')
+	return output, PatchExporter.exportPatches(dataset, output, **kwargs)
+
+def _loadShards(output, index):
+	images = [np.load(os.path.join(output, s['images'])) for s in index['shards']]
+	masks  = [np.load(os.path.join(output, s['masks'])) for s in index['shards']]
+	return images, masks
+
+def test_patches_match_the_images_and_masks(tmp_path, make_dataset):
+	dataset        = make_dataset(4)
+	output, index  = _export(tmp_path, dataset, size=32, stride=24, processes=2)
+	images, masks  = _loadShards(output, index)
+	entries        = dataset.meta_structure['entries']
+
+	assert index['n_images'] == 4
+	assert index['failed'] == []
+
+	positions = {}
+	for shard, shard_images, shard_masks in zip(index['shards'], images, masks):
+		assert shard_images.shape == (shard['n_patches'], 32, 32, 3)
+		assert shard['channels'] == 3
+
+		for i, key in enumerate(shard['keys']):
+			x, y = shard['x'][i], shard['y'][i]
+			img  = cv2.imread(os.path.join(dataset.root_path, key))
+			mask = classMask(entries[key], 64, 48, dtype=np.uint16)[y:y + 32, x:x + 32]
+
+			assert np.array_equal(shard_images[i], img[y:y + 32, x:x + 32])
+			assert np.array_equal(shard_masks[i], mask)
+			assert shard['foreground'][i] == pytest.approx((mask > 0).mean())
+			positions.setdefault(key, set()).add((x, y))
+
+	# The last window along each axis is flush with the edge of the image.
+	windows = {(x, y) for x in (0, 24, 32) for y in (0, 16)}
+	assert positions == {key: windows for key in entries}
+
+def test_min_foreground_and_shard_size(tmp_path, make_dataset):
+	dataset       = make_dataset(4, contours_per_image=4)
+	output, index = _export(
+		tmp_path, dataset, size=16, min_foreground=0.05, shard_size=3,
+		processes=1
+	)
+
+	expected = 0
+	for key, contours in dataset.meta_structure['entries'].items():
+		mask      = classMask(contours, 64, 48) > 0
+		fractions = mask.reshape(3, 16, 4, 16).mean(axis=(1, 3))
+		expected += int((fractions >= 0.05).sum())
+
+	assert 0 < index['n_patches'] == expected < 4 * 12
+	assert all(f >= 0.05 for s in index['shards'] for f in s['foreground'])
+	assert [s['n_patches'] for s in index['shards'][:-1]] == [3] * (len(index['shards']) - 1)
+	assert 0 < index['shards'][-1]['n_patches'] <= 3
+
+def test_read_batches_round_trip(tmp_path, make_dataset):
+	dataset       = make_dataset(3)
+	output, index = _export(tmp_path, dataset, size=16, shard_size=5, processes=1)
+	images, masks = _loadShards(output, index)
+	images, masks = np.concatenate(images), np.concatenate(masks)
+
+	batches = list(PatchExporter.readBatches(output, 4))
+	assert [b[0].shape[0] for b in batches[:-1]] == [4] * (len(batches) - 1)
+	assert np.array_equal(np.concatenate([b[0] for b in batches]), images)
+	assert np.array_equal(np.concatenate([b[1] for b in batches]), masks)
+
+	# Shuffling keeps every image with its mask.
+	shuffled = list(PatchExporter.readBatches(output, 4, seed=1))
+	pairs    = lambda i, m: sorted(a.tobytes() + b.tobytes() for a, b in zip(i, m))
+	assert pairs(
+		np.concatenate([b[0] for b in shuffled]),
+		np.concatenate([b[1] for b in shuffled])
+	) == pairs(images, masks)
+
+def test_channel_changes_start_a_new_shard(tmp_path):
+	writer = PatchExporter._ShardWriter(str(tmp_path), 0, 8, 16)
+	mask   = np.zeros((8, 8), dtype=np.uint16)
+	x, y   = np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+	f      = np.ones(1)
+
+	assert writer.add('color', np.ones((8, 8, 3), np.uint8), mask, x, y, f) == []
+	records = writer.add('gray', np.ones((8, 8), np.uint8), mask, x, y, f)
+
+	assert [(r['keys'], r['channels']) for r in records] == [(['color'], 3)]
+	assert writer.flush()['channels'] == 1
+
+# Stands in for a worker that is killed before it replies.
+def _crashingWorker(worker, *args):
+	os._exit(3)
+
+def test_export_raises_when_a_worker_dies(tmp_path, make_dataset, monkeypatch):
+	dataset = make_dataset(4)
+	monkeypatch.setattr(PatchExporter, '_workerMain', _crashingWorker)
+
+	with pytest.raises(Exception, match='exited with code 3'):
+		PatchExporter.exportPatches(dataset, str(tmp_path / 'patches'), processes=2)
@@ -0,0 +1,108 @@
+# Author:      Adam Robinson
+# Description: Tests for the contour geometry in DatasetStatistics.py, and
+#              for the statistics of datasets with missing images.
+
+import os
+import json
+import pytest
+import numpy as np
+
+from Dataset           import Dataset
+from DatasetStatistics import DatasetStatistics, computeGeometry
+
+def test_entries_without_contours_never_read_their_image(make_dataset):
+	path      = make_dataset().root_path
+	meta_path = os.path.join(path, 'meta.json')
+	with open(meta_path) as file:
+		meta = json.load(file)
+	meta['entries']['not_on_disk.png'] = []
+	with open(meta_path, 'w') as file:
+		json.dump(meta, file)
+
+	summary = DatasetStatistics(Dataset().loadMetadata(path)).summary()
+
+	assert summary['n_images'] == 4
+	assert summary['n_contours'] == 6
+	assert summary['unreadable'] == []
+
+def test_unreadable_images_are_reported_and_skipped(make_dataset):
+	dataset = make_dataset()
+	os.remove(os.path.join(dataset.root_path, 'image_00001.png'))
+
+	statistics = DatasetStatistics(dataset)
+	summary    = statistics.summary()
+
+	assert [u['key'] for u in summary['unreadable']] == ['image_00001.png']
+	assert summary['n_contours'] == 4
+
+	# The number of readable images that have each class.
+	entries  = dataset.meta_structure['entries']
+	expected = [
+		sum(
+			int(idx in entries[k].class_idx)
+			for k in entries if k != 'image_00001.png'
+		)
+		for idx in range(len(summary['classes']))
+	]
+	assert [c['images'] for c in summary['classes']] == expected
+	assert sum(expected) > 0
+	assert statistics.entryStatistics('image_00001.png')['area'].shape == (0,)
+
+def test_relative_units_need_no_images(make_dataset):
+	dataset = make_dataset()
+	for i in range(3):
+		os.remove(os.path.join(dataset.root_path, 'image_%05d.png'%i))
+
+	summary = DatasetStatistics(dataset, pixel_units=False).summary()
+	assert summary['n_contours'] == 6
+	assert summary['unreadable'] == []
+
+# A square and a right triangle, in relative coordinates (y up), followed by
+# a polygon without any points.
+def _polygons():
+	vertices = np.array([
+		[0.25, 0.75], [0.75, 0.75], [0.75, 0.25], [0.25, 0.25],
+		[0.0, 1.0], [0.6, 1.0], [0.0, 0.2]
+	])
+	return vertices, np.array([0, 4, 7, 7])
+
+def test_geometry_in_pixels():
+	vertices, offsets = _polygons()
+	geometry = computeGeometry(vertices, offsets, [[100, 200]] * 3)
+
+	# The square covers x 25 to 75 and y 50 to 150. The triangle has its
+	# right angle at the top left corner, with legs of 60 and 160.
+	assert np.array_equal(geometry['n_vertices'], [4, 3, 0])
+	assert geometry['area'][:2] == pytest.approx([5000, 4800])
+	assert geometry['perimeter'][:2] == pytest.approx([300, 220 + np.hypot(60, 160)])
+	assert geometry['x_min'][:2] == pytest.approx([25, 0])
+	assert geometry['y_min'][:2] == pytest.approx([50, 0])
+	assert geometry['x_max'][:2] == pytest.approx([75, 60])
+	assert geometry['y_max'][:2] == pytest.approx([150, 160])
+	assert geometry['centroid_x'][:2] == pytest.approx([50, 20])
+	assert geometry['centroid_y'][:2] == pytest.approx([100, 160 / 3])
+
+	assert geometry['area'][2] == 0
+	assert np.isnan(geometry['x_min'][2]) and np.isnan(geometry['centroid_x'][2])
+
+def test_geometry_in_relative_units():
+	vertices, offsets = _polygons()
+	geometry = computeGeometry(vertices, offsets)
+
+	assert geometry['area'][:2] == pytest.approx([0.25, 0.24])
+	assert geometry['perimeter'][:2] == pytest.approx([2.0, 2.4])
+	assert geometry['x_min'][:2] == pytest.approx([0.25, 0])
+	assert geometry['y_min'][:2] == pytest.approx([0.25, 0])
+	assert geometry['x_max'][:2] == pytest.approx([0.75, 0.6])
+	assert geometry['y_max'][:2] == pytest.approx([0.75, 0.8])
+	assert geometry['centroid_x'][:2] == pytest.approx([0.5, 0.2])
+	assert geometry['centroid_y'][:2] == pytest.approx([0.5, 0.8 / 3])
+
+def test_degenerate_polygons_use_the_mean_of_their_points():
+	vertices = np.array([[0.2, 0.5], [0.6, 0.5]])
+	geometry = computeGeometry(vertices, [0, 2])
+
+	assert geometry['area'][0] == 0
+	assert geometry['perimeter'][0] == pytest.approx(0.8)
+	assert geometry['centroid_x'][0] == pytest.approx(0.4)
+	assert geometry['centroid_y'][0] == pytest.approx(0.5)